@@ -5,16 +5,30 @@ import logging
 import os
 
 # Custom imports
-import quizbot.runner
 from quizbot.utils import str2bool
-from quizbot.handlers.handlers import handlers
 
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s\n', level=logging.INFO)
 
 if __name__ == '__main__':
     token = os.environ['TELEGRAM_TOKEN']
-    if str2bool(os.environ.get('USE_TELEGRAM_WEBHOOK', 'False')):
-        raise NotImplementedError()
+    use_webhook = str2bool(os.environ.get('USE_TELEGRAM_WEBHOOK', 'False'))
+    workers = int(os.environ.get('WORKER_PROCESSES', '0'))
+
+    if workers > 0:
+        # handlers are imported by the worker processes
+        import quizbot.supervisor as runner
+        params = dict(workers=workers)
+    elif str2bool(os.environ.get('USE_ASYNCIO', 'False')):
+        import quizbot.aio.runner as runner
+        from quizbot.aio.handlers import handlers
+        params = dict(handlers=handlers)
+    else:
+        import quizbot.runner as runner
+        from quizbot.handlers.handlers import handlers
+        params = dict(handlers=handlers)
+
+    if use_webhook:
+        runner.run_webhook(token=token, **params)
     else:
-        quizbot.runner.run_get_updates(token=token, handlers=handlers)
+        runner.run_get_updates(token=token, **params)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Compares MongoDB round trips and latency of a quiz button click handled with
+the legacy sequence of queries (find post, upsert user, check answer, update
+post and user) and with `quizbot.db.models.record_click`.
+
+Needs a running MongoDB, e.g. the one from `docker-compose.yml`:
+
+    MONGO_HOST=localhost:27017 python benchmarks/click_pipeline.py --clicks 2000
+
+The benchmark works in a separate database, which is dropped afterwards.
+"""
+
+# Generic imports
+import argparse
+import datetime
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List
+
+# Mongo imports
+from bson import ObjectId
+from pymongo import ReturnDocument, monitoring
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+class RoundTripCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# must be registered before `quizbot.db.mongo` creates the client
+ROUND_TRIPS = RoundTripCounter()
+monitoring.register(ROUND_TRIPS)
+
+# Custom imports
+import quizbot.db.mongo  # noqa: E402
+import quizbot.db.models as models  # noqa: E402
+from quizbot.db.mongo import get_collection  # noqa: E402
+
+BUTTONS = ['A', 'B', 'C', 'D']
+
+
+def legacy_click(post_id: ObjectId, telegram_id: int, index: int) -> None:
+    post = get_collection('posts').find_one({'_id': post_id})
+    user_id = get_collection('users').find_one_and_update(
+        {'telegram_id': telegram_id},
+        {'$set': {'telegram_id': telegram_id}},
+        {},
+        return_document=ReturnDocument.AFTER,
+        upsert=True)['_id']
+
+    field = f'posts_clicked.{post_id}.answer'
+    clicked = get_collection('users').find_one(
+        {'_id': user_id, field: {'$exists': True}}, {field: 1})
+    if clicked:
+        return
+
+    timestamp = datetime.datetime.now()
+    get_collection('posts').update_one(
+        {'_id': post_id},
+        {'$inc': {f'buttons.{index}.clicks_count': 1,
+                  'clicks_count': 1,
+                  'correct_clicks_count': int(post['buttons'][index]['is_correct'])}})
+    get_collection('users').update_one(
+        {'_id': user_id},
+        {'$set': {'last_click': timestamp,
+                  f'posts_clicked.{post_id}.timestamp': timestamp,
+                  f'posts_clicked.{post_id}.answer': post['buttons'][index]['text']}})
+
+
+def record_click(post_id: ObjectId, telegram_id: int, index: int) -> None:
+    models.record_click(post_id=post_id, telegram_id=telegram_id, button=index)
+
+
+def create_post() -> ObjectId:
+    author_id = models.find_or_create_user(0)
+    buttons = {text: {'alert_text': f'Answer {text}', 'clicks_count': 0,
+                      'is_correct': text == BUTTONS[0]}
+               for text in BUTTONS}
+    return models.create_post(text='Benchmark quiz', photo=None,
+                              buttons=buttons, user_id=author_id)
+
+
+def run(name: str, click: Callable, clicks: int, users: int) -> Dict:
+    post_id = create_post()
+    latencies: List[float] = []
+    round_trips = ROUND_TRIPS.count
+
+    for i in range(clicks):
+        telegram_id = 1 + i % users
+        start = time.perf_counter()
+        click(post_id, telegram_id, random.randrange(len(BUTTONS)))
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    return {
+        'name': name,
+        'round_trips': (ROUND_TRIPS.count - round_trips) / clicks,
+        'p50': statistics.median(latencies) * 1000,
+        'p99': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clicks', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=500,
+                        help="Number of distinct users; the rest of clicks are repeated taps")
+    parser.add_argument('--database', default='quiz_posts_benchmark')
+    args = parser.parse_args()
+
+    os.environ['MONGO_DATABASE'] = args.database
+    try:
+        models.ensure_indexes()
+        results = [run('legacy', legacy_click, args.clicks, args.users),
+                   run('record_click', record_click, args.clicks, args.users)]
+    finally:
+        quizbot.db.mongo.get_client().drop_database(args.database)
+
+    print(f"{'pipeline':<14}{'round trips':>12}{'p50, ms':>10}{'p99, ms':>10}")
+    for result in results:
+        print(f"{result['name']:<14}{result['round_trips']:>12.2f}"
+              f"{result['p50']:>10.2f}{result['p99']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
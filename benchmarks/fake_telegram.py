@@ -0,0 +1,121 @@
+"""
+Local stand-in for the Telegram Bot API, answering the methods used by the bot
+and recording when each answer arrives.
+"""
+
+# Generic imports
+import itertools
+import json
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Hashable, List, Optional
+from urllib.parse import parse_qsl
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Quiz', 'username': 'quiz_bot'}
+
+
+class FakeTelegramAPI:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.calls: Dict[str, int] = defaultdict(int)
+        # response key -> times the bot has called the API with this key
+        self.responses: Dict[Hashable, List[float]] = defaultdict(list)
+
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._message_ids = itertools.count(1)
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections of the bot's connection pool alive
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately, don't wait for delayed ACKs
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                result = api.handle(self.path.rsplit('/', 1)[-1], params)
+
+                response = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            # bursts must not overflow the listen backlog, or clients wait for SYN retries
+            request_queue_size = 1024
+            daemon_threads = True
+
+        self.server = Server((host, port), Handler)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name='fake-telegram-api', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method: str, params: Dict):
+        now = time.perf_counter()
+
+        if method == 'answerCallbackQuery':
+            key, result = ('callback', params['callback_query_id']), True
+        elif method == 'answerInlineQuery':
+            key, result = ('inline', params['inline_query_id']), True
+        elif method in ('sendMessage', 'sendPhoto'):
+            chat_id = int(params['chat_id'])
+            key = ('chat', chat_id)
+            result = {'message_id': next(self._message_ids), 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'from': BOT_USER,
+                      'text': params.get('text', '')}
+        elif method == 'getMe':
+            key, result = None, BOT_USER
+        else:
+            key, result = None, True
+
+        with self._condition:
+            self.calls[method] += 1
+            if key is not None:
+                self.responses[key].append(now)
+                self._condition.notify_all()
+
+        return result
+
+    def first_response_after(self, key: Hashable, since: float) -> Optional[float]:
+        with self._lock:
+            return next((t for t in self.responses.get(key, []) if t >= since), None)
+
+    def wait_for(self, keys: List[Hashable], since: float, timeout: float = 60) -> bool:
+        deadline = time.monotonic() + timeout
+        pending = set(keys)
+        with self._condition:
+            while True:
+                pending = {key for key in pending
+                           if not any(t >= since for t in self.responses.get(key, []))}
+                if not pending:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
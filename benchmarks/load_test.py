@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Offline load test of the bot: runs the real `quizbot.handlers.handlers` in the
+production dispatcher setup against a local fake Telegram Bot API and replays
+synthetic workloads:
+ - clicks: a burst of users clicking the buttons of one post
+ - inline: inline queries for `#<post_id>`
+ - conversations: users creating posts concurrently
+
+For every workload it reports throughput, p50/p95/p99 latency from putting an
+update into the dispatcher queue until the bot answers it, and MongoDB
+operations per update.
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/load_test.py --mongo memory
+
+`--mongo server` uses the MongoDB at `MONGO_HOST` instead, in a separate
+database dropped afterwards. The bot settings (`TELEGRAM_WORKERS`,
+`USE_CLICK_BUFFER`, ...) are taken from the environment as usual.
+"""
+
+# Generic imports
+import argparse
+import itertools
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Tuple
+
+# Mongo imports
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_telegram import FakeTelegramAPI  # noqa: E402
+
+TOKEN = '123456:LOAD-TEST'
+BUTTONS = ['A', 'B', 'C', 'D']
+CONVERSATION = ['/start', 'Which one?', '/addbutton', 'A', 'Alert A',
+                '/addbutton', 'B', 'Alert B', '/finish', 'A']
+
+
+class OpsCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self) -> None:
+        with self._lock:
+            self.count += 1
+
+    def started(self, event):
+        self.add()
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+OPS = OpsCounter()
+
+
+def setup_mongo(kind: str, database: str) -> Callable[[], None]:
+    """Points `quizbot.db.mongo` to the benchmark database, returns a cleanup function."""
+    if kind == 'memory':
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("In-memory MongoDB needs mongomock: "
+                     "pip install -r benchmarks/requirements.txt")
+
+        # mongomock doesn't support command monitoring, count collection calls
+        # instead, ignoring the ones made by mongomock itself (e.g. find_one -> find).
+        # mongomock isn't thread-safe either, so the calls are serialized
+        lock = threading.RLock()
+        nested = threading.local()
+        for name in ['find', 'find_one', 'insert_one', 'insert_many', 'update_one',
+                     'update_many', 'replace_one', 'delete_one', 'delete_many',
+                     'find_one_and_update', 'bulk_write', 'aggregate', 'count_documents']:
+            method = getattr(mongomock.Collection, name)
+
+            def counted(*args, __method=method, **kwargs):
+                if getattr(nested, 'active', False):
+                    return __method(*args, **kwargs)
+                OPS.add()
+                with lock:
+                    nested.active = True
+                    try:
+                        return __method(*args, **kwargs)
+                    finally:
+                        nested.active = False
+
+            setattr(mongomock.Collection, name, counted)
+
+        os.environ.setdefault('MONGO_HOST', 'localhost:27017')
+        os.environ['MONGO_DATABASE'] = database
+        import quizbot.db.mongo
+        client = mongomock.MongoClient()
+        quizbot.db.mongo.get_client = lambda: client
+        return lambda: None
+
+    monitoring.register(OPS)
+    os.environ['MONGO_DATABASE'] = database
+    import quizbot.db.mongo
+    return lambda: quizbot.db.mongo.get_client().drop_database(database)
+
+
+class LoadTest:
+    def __init__(self, api: FakeTelegramAPI):
+        import quizbot.runner
+        from quizbot.handlers.handlers import handlers
+
+        self.api = api
+        self.update_ids = itertools.count(1)
+
+        os.environ['TELEGRAM_BASE_URL'] = api.base_url
+        self.updater = quizbot.runner.create_updater(TOKEN, handlers)
+        self.dispatcher = self.updater.dispatcher
+        self._thread = threading.Thread(target=self.dispatcher.start, name='dispatcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        from quizbot.db import buffer
+
+        self.dispatcher.stop()
+        buffer.click_buffer.stop()
+
+    @staticmethod
+    def user(user_id: int) -> Dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+
+    def callback_query(self, user_id: int, data: str) -> Tuple[Dict, Hashable]:
+        update_id = next(self.update_ids)
+        return ({'update_id': update_id,
+                 'callback_query': {'id': str(update_id), 'from': self.user(user_id),
+                                    'chat_instance': '1', 'data': data}},
+                ('callback', str(update_id)))
+
+    def inline_query(self, user_id: int, query: str) -> Tuple[Dict, Hashable]:
+        update_id = next(self.update_ids)
+        return ({'update_id': update_id,
+                 'inline_query': {'id': str(update_id), 'from': self.user(user_id),
+                                  'query': query, 'offset': ''}},
+                ('inline', str(update_id)))
+
+    def message(self, user_id: int, text: str) -> Tuple[Dict, Hashable]:
+        update_id = next(self.update_ids)
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}] \
+            if text.startswith('/') else []
+        return ({'update_id': update_id,
+                 'message': {'message_id': update_id, 'date': int(time.time()),
+                             'chat': {'id': user_id, 'type': 'private'},
+                             'from': self.user(user_id), 'text': text,
+                             'entities': entities}},
+                ('chat', user_id))
+
+    def replay(self, updates: List[Tuple[Dict, Hashable]]) -> Tuple[float, List[float]]:
+        """Puts all the updates into the queue at once and waits for the answers."""
+        from telegram import Update
+
+        start = time.perf_counter()
+        for data, _ in updates:
+            self.dispatcher.update_queue.put(Update.de_json(data, self.updater.bot))
+
+        keys = [key for _, key in updates]
+        if not self.api.wait_for(keys, since=start):
+            print(f"Warning: some of {len(keys)} updates have not been answered in time")
+        elapsed = time.perf_counter() - start
+
+        latencies = []
+        for key in keys:
+            answered = self.api.first_response_after(key, start)
+            if answered is not None:
+                latencies.append(answered - start)
+        return elapsed, latencies
+
+    def create_post(self):
+        import quizbot.db.models as models
+
+        author_id = models.find_or_create_user(0)
+        buttons = {text: {'alert_text': f'Answer {text}', 'clicks_count': 0,
+                          'is_correct': text == BUTTONS[0]}
+                   for text in BUTTONS}
+        return models.create_post(text='Load test quiz', photo=None,
+                                  buttons=buttons, user_id=author_id)
+
+    def clicks(self, count: int, users: int) -> Tuple[int, float, List[float]]:
+        import quizbot.handlers.post as postutils
+        import quizbot.db.models as models
+
+        post_id = self.create_post()
+        keyboard = postutils.get_post_keyboard(models.find_post(post_id)['buttons'], post_id)
+        datas = [button.callback_data for button in keyboard[0]]
+
+        updates = [self.callback_query(1 + i % users, random.choice(datas))
+                   for i in range(count)]
+        return (len(updates), *self.replay(updates))
+
+    def inline(self, count: int, users: int) -> Tuple[int, float, List[float]]:
+        post_id = self.create_post()
+        updates = [self.inline_query(1 + i % users, f'#{post_id}') for i in range(count)]
+        return (len(updates), *self.replay(updates))
+
+    def conversations(self, users: int) -> Tuple[int, float, List[float]]:
+        # users start at a high ID not to clash with clicking users
+        user_ids = range(10 ** 6, 10 ** 6 + users)
+        elapsed, latencies = 0.0, []
+        for text in CONVERSATION:
+            step_elapsed, step_latencies = self.replay(
+                [self.message(user_id, text) for user_id in user_ids])
+            elapsed += step_elapsed
+            latencies += step_latencies
+        return len(CONVERSATION) * users, elapsed, latencies
+
+
+def percentile(values: List[float], q: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo', choices=['memory', 'server'], default='memory')
+    parser.add_argument('--database', default='quiz_posts_load_test')
+    parser.add_argument('--clicks', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=1000,
+                        help="Number of distinct clicking users; the rest are repeated taps")
+    parser.add_argument('--inline', type=int, default=1000)
+    parser.add_argument('--conversations', type=int, default=50)
+    args = parser.parse_args()
+
+    # each workload is put into the queue at once, which would otherwise be
+    # bounded and shed inline queries, see `quizbot.ingress`
+    os.environ.setdefault('INGRESS_MAX_PENDING_UPDATES', '0')
+    cleanup = setup_mongo(args.mongo, args.database)
+    api = FakeTelegramAPI()
+    api.start()
+    test = LoadTest(api)
+
+    workloads = [
+        ('clicks', lambda: test.clicks(args.clicks, args.users)),
+        ('inline', lambda: test.inline(args.inline, args.users)),
+        ('conversations', lambda: test.conversations(args.conversations)),
+    ]
+
+    print(f"{'workload':<15}{'updates':>9}{'upd/s':>10}{'p50, ms':>10}{'p95, ms':>10}"
+          f"{'p99, ms':>10}{'ops/upd':>9}")
+    try:
+        for name, workload in workloads:
+            ops = OPS.count
+            updates, elapsed, latencies = workload()
+            latencies.sort()
+            if not latencies:
+                print(f"{name:<15}{updates:>9}  no answers")
+                continue
+            print(f"{name:<15}{updates:>9}{updates / elapsed:>10.0f}"
+                  f"{statistics.median(latencies) * 1000:>10.1f}"
+                  f"{percentile(latencies, 0.95) * 1000:>10.1f}"
+                  f"{percentile(latencies, 0.99) * 1000:>10.1f}"
+                  f"{(OPS.count - ops) / updates:>9.2f}")
+    finally:
+        test.stop()
+        api.stop()
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
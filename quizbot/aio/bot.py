@@ -0,0 +1,171 @@
+"""
+Telegram Bot API client of the asyncio mode.
+
+Handlers keep using python-telegram-bot objects (`update.message.reply_text(...)`,
+`query.answer(...)` and so on), but their bot doesn't send anything: the calls
+are recorded per update by `RecordingRequest` and sent with aiohttp once the
+handler returns, see `quizbot.aio.runner`. Like in the threaded mode, they are
+sent by `OUTBOUND_SENDERS` tasks in the order of `quizbot.outbound`.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import contextvars
+import logging
+import os
+import time
+
+import aiohttp
+import telegram
+from telegram.error import RetryAfter
+
+from quizbot.outbound import Call, OutboundScheduler, UNSCHEDULED
+
+LOGGER = logging.getLogger(__name__)
+
+# Bot API calls made by the handler of the current update: [(method, params)]
+OUTGOING: contextvars.ContextVar = contextvars.ContextVar('OUTGOING')
+
+
+class RecordingRequest:
+    """Stands in for `telegram.utils.request.Request`, recording the calls instead of sending."""
+
+    con_pool_size = 1
+
+    def post(self, url: str, data: Dict, timeout: Optional[float] = None) -> bool:
+        OUTGOING.get().append((url.rsplit('/', 1)[-1], data))
+        # what the API returns to the methods which don't return a message,
+        # the ones which do return it as is then
+        return True
+
+    def stop(self) -> None:
+        pass
+
+
+class BotAPI:
+    def __init__(self, token: str, base_url: Optional[str] = None,
+                 base_file_url: Optional[str] = None):
+        base_url = base_url or 'https://api.telegram.org/bot'
+        self.url = f'{base_url}{token}'
+        self.file_url = f"{base_file_url or 'https://api.telegram.org/file/bot'}{token}"
+        # python-telegram-bot objects of the updates are bound to this bot
+        self.bot = telegram.Bot(token, base_url=base_url, request=RecordingRequest())
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.scheduler = OutboundScheduler.from_env()
+        self._senders: List[asyncio.Task] = []
+        self._condition: Optional[asyncio.Condition] = None
+        self._stopped = False
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    def start(self) -> None:
+        self._condition = asyncio.Condition()
+        self._senders = [asyncio.ensure_future(self._send())
+                         for _ in range(int(os.environ.get('OUTBOUND_SENDERS', '100')))]
+
+    async def close(self) -> None:
+        """Sends the queued calls and closes the session."""
+        if self._senders:
+            async with self._condition:
+                self._stopped = True
+                self._condition.notify_all()
+            await asyncio.wait(self._senders)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get_me(self) -> telegram.User:
+        # command handlers check the bot's username, which is then known without a request
+        self.bot.bot = telegram.User.de_json(await self.call('getMe'), self.bot)
+        return self.bot.bot
+
+    async def request(self, url: str, params: Dict, timeout: Optional[float] = None) -> Any:
+        async with self.session.post(url, json=params,
+                                     timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            result = await response.json()
+
+        if result.get('ok'):
+            return result['result']
+
+        retry_after = result.get('parameters', {}).get('retry_after')
+        if retry_after is not None:
+            raise RetryAfter(retry_after)
+        raise telegram.error.TelegramError(f"{url.rsplit('/', 1)[-1]}: "
+                                           f"{result.get('description')}")
+
+    async def call(self, method: str, params: Optional[Dict] = None,
+                   timeout: Optional[float] = None) -> Any:
+        """Calls the Bot API method, waiting for its turn in the outbound queue."""
+        url = f'{self.url}/{method}'
+        if method in UNSCHEDULED or not self._senders:
+            return await self.request(url, params or {}, timeout=timeout)
+
+        call = Call(url, params or {}, timeout, asyncio.Event())
+        async with self._condition:
+            call = self.scheduler.push(call)
+            self._condition.notify()
+
+        await call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def call_later(self, method: str, params: Dict) -> None:
+        """Queues the call without waiting for it to be sent, failures are logged."""
+        def log_failure(task: asyncio.Task) -> None:
+            if not task.cancelled() and task.exception() is not None:
+                LOGGER.warning(f"{method} failed: {task.exception()}")
+
+        asyncio.ensure_future(self.call(method, params, timeout=30)).add_done_callback(
+            log_failure)
+
+    async def _next(self) -> Optional[Call]:
+        async with self._condition:
+            while True:
+                call, wait = self.scheduler.pop(time.monotonic())
+                if call is not None:
+                    return call
+                if self._stopped and wait is None:
+                    return None
+                try:
+                    await asyncio.wait_for(self._condition.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _send(self) -> None:
+        while True:
+            call = await self._next()
+            if call is None:
+                return
+
+            try:
+                result = await self.request(call.url, call.params, timeout=call.timeout)
+            except RetryAfter as error:
+                LOGGER.warning(f"Flood limit exceeded on {call.method}, "
+                               f"retrying in {error.retry_after}s")
+                async with self._condition:
+                    self.scheduler.retry(call, error.retry_after, time.monotonic())
+                    self._condition.notify()
+            except Exception as error:
+                call.complete(error=error)
+            else:
+                call.complete(result=result)
+
+    async def download_file(self, file_id: str) -> bytes:
+        file = await self.call('getFile', {'file_id': file_id})
+        async with self.session.get(f"{self.file_url}/{file['file_path']}") as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def send(self, calls: List[Tuple[str, Dict]]) -> None:
+        """Sends the calls recorded while handling an update in order."""
+        for method, params in calls:
+            await self.call(method, params, timeout=30)
+
+    async def get_updates(self, offset: int, timeout: int) -> List[Dict]:
+        return await self.call('getUpdates', {'offset': offset, 'timeout': timeout},
+                               timeout=timeout + 10)
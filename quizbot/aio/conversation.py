@@ -0,0 +1,87 @@
+"""
+Minimal asyncio counterpart of `telegram.ext.ConversationHandler`.
+
+States are declared with the usual python-telegram-bot handlers, whose
+callbacks may be coroutines. User data and states are stored per update in
+the documents of `quizbot.db.persistence.MongoPersistence`.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import inspect
+import pickle
+
+import telegram
+from telegram import Update
+from telegram.ext import ConversationHandler, Handler
+
+import quizbot.db.aio_models as models
+
+
+class Context:
+    """The part of `telegram.ext.CallbackContext` used by the handlers."""
+
+    def __init__(self, bot: telegram.Bot, user_data: Optional[Dict] = None, api: Any = None):
+        self.bot = bot
+        # `quizbot.aio.bot.BotAPI` for the calls whose result is needed, e.g. downloads
+        self.api = api
+        self.user_data = user_data if user_data is not None else {}
+        self.chat_data = None
+        # words after the command, set for `CommandHandler`
+        self.args: Optional[List[str]] = None
+
+
+async def call_handler(handler: Handler, update: Update, context: Context) -> Any:
+    result = handler.callback(update, context)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+class Conversation:
+    def __init__(self, name: str, entry_points: List[Handler],
+                 states: Dict[Any, List[Handler]], fallbacks: List[Handler]):
+        self.name = name
+        self.entry_points = entry_points
+        self.states = states
+        self.fallbacks = fallbacks
+
+    @staticmethod
+    def get_key(update: Update) -> Optional[Tuple[int, int]]:
+        # same as the default `per_chat` and `per_user` ConversationHandler
+        if update.effective_chat is None or update.effective_user is None:
+            return None
+        return update.effective_chat.id, update.effective_user.id
+
+    def find_handler(self, state: Any, update: Update) -> Optional[Handler]:
+        candidates = self.entry_points if state is None else self.states.get(state, [])
+        if state is not None:
+            candidates = candidates + self.fallbacks
+        return next((handler for handler in candidates if handler.check_update(update)), None)
+
+    async def handle(self, update: Update, bot: telegram.Bot) -> bool:
+        """Handles the update if it belongs to the conversation, returns whether it did."""
+        key = self.get_key(update)
+        if key is None or update.message is None:
+            return False
+
+        user_id = update.effective_user.id
+        state, stored_data = await asyncio.gather(models.load_conversation(self.name, key),
+                                                  models.load_user_data(user_id))
+        handler = self.find_handler(state, update)
+        if handler is None:
+            return False
+
+        context = Context(bot, pickle.loads(stored_data))
+        new_state = await call_handler(handler, update, context)
+
+        pickled = pickle.dumps(context.user_data)
+        if pickled != stored_data:
+            await models.save_user_data(user_id, pickled)
+
+        if new_state == ConversationHandler.END:
+            await models.save_conversation(self.name, key, None)
+        elif new_state is not None and new_state != state:
+            await models.save_conversation(self.name, key, new_state)
+
+        return True
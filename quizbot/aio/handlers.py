@@ -0,0 +1,294 @@
+"""
+Handlers of the asyncio mode. The ones using the database are coroutines
+calling `quizbot.db.aio_models`, the rest are shared with the threaded mode.
+"""
+
+from typing import List, Union
+import asyncio
+
+from telegram import ReplyKeyboardRemove
+from telegram import InlineQuery, Update, ParseMode, CallbackQuery
+from telegram.ext import (CommandHandler, MessageHandler, InlineQueryHandler,
+                          CallbackQueryHandler)
+from telegram.ext import Filters
+from telegram.error import TelegramError
+from bson import ObjectId
+
+import quizbot.handlers.importer as importer
+import quizbot.handlers.post as postutils
+import quizbot.db.aio_models as models
+import quizbot.publisher as publisher
+from quizbot.ingress import ingress
+from quizbot.aio.bot import BotAPI
+from quizbot.aio.conversation import Context, Conversation
+from quizbot.db.publish_jobs import ChatId
+from quizbot.handlers.admin import (
+    start,
+    start_post_creation,
+    start_button_creation,
+    cancel_post_creation,
+    add_button_alert_text,
+    add_button_text,
+    display_keyboard_to_choose_correct_answer,
+    answer_author_posts,
+    check_import_document,
+    get_next_offset,
+    get_offset_post,
+    reply_with_cancelled_job,
+    reply_with_created_job,
+    reply_with_created_post,
+    reply_with_user_stats
+)
+from quizbot.handlers.inline import make_click_answer, make_statistics_answer
+from quizbot.handlers.state import State
+from quizbot.metrics import timed_handler as timed
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+async def process_inline_button_click(update: Update, context: Context) -> None:
+    query = update.callback_query
+    try:
+        post_id, button = postutils.decode_callback_data(query.data)
+        if button == postutils.STATS_BUTTON:
+            return await show_post_statistics(query, post_id)
+        else:
+            return await process_quiz_button_click(update, post_id, button)
+    finally:
+        ingress.release(query)
+
+
+async def show_post_statistics(query: CallbackQuery, post_id: ObjectId) -> None:
+    try:
+        post = await models.find_post(post_id)
+    except ValueError:
+        LOGGER.error(f"Could not find post {post_id} on statistics button click")
+        ingress.answer(query, text="Post has not been found. "
+                                   "Approach the developer.", show_alert=False)
+        return
+
+    ingress.answer(query, **make_statistics_answer(query, post))
+
+
+async def process_quiz_button_click(update: Update, post_id: ObjectId,
+                                    button: Union[int, str]) -> None:
+    query = update.callback_query
+
+    try:
+        click = await models.record_click(post_id=post_id,
+                                          telegram_id=update.effective_user.id,
+                                          button=button)
+    except ValueError:
+        LOGGER.error(f"Could not find post {post_id} on quiz button click")
+        ingress.answer(query, text="Пост не найден в базе данных. "
+                                   "Обратитесь к разработчику.", show_alert=False)
+        return
+
+    LOGGER.debug(f"Button `{click.button_text}` clicked for post {post_id}")
+    ingress.answer(query, **make_click_answer(query, click))
+
+
+async def finish_post_creation(update: Update, context: Context) -> str:
+    buttons = context.user_data['buttons']
+    correct_answer = update.message.text
+
+    if correct_answer not in buttons:
+        update.message.reply_text(f'No such button: {correct_answer}!')
+        return State.WAITING_CORRECT_ANSWER
+    else:
+        update.message.reply_text('Fine, here is your new post:',
+                                  reply_markup=ReplyKeyboardRemove())
+
+    buttons[correct_answer]['is_correct'] = True
+    photo = context.user_data['photo']
+
+    user_id = await models.find_or_create_user(update.effective_user.id)
+    post_id = await models.create_post(text=context.user_data['text'],
+                                       photo=photo,
+                                       buttons=buttons,
+                                       user_id=user_id)
+    post = await models.find_post(post_id)
+
+    LOGGER.info(f"Generated post: {post}")
+    reply_with_created_post(update.message, post)
+
+    return State.WAITING_POST
+
+
+async def inline_find_post(update: Update, context: Context) -> None:
+    inline_query = update.inline_query
+    query = inline_query.query.strip()
+
+    if query.startswith('#'):
+        return await inline_publish_post(inline_query, query[1:])
+
+    # the author's own posts: the recent ones, or the ones matching the query
+    user_id = await models.find_user_id(inline_query.from_user.id)
+    posts, next_offset = [], ''
+    if user_id is not None and not query:
+        posts = await models.find_author_posts(user_id, before=get_offset_post(inline_query),
+                                               limit=postutils.MAX_INLINE_RESULTS)
+        next_offset = get_next_offset(posts)
+    elif user_id is not None:
+        post_ids = await models.search_author_posts(user_id, query)
+        post_ids, next_offset = postutils.get_page(post_ids, inline_query.offset)
+        posts = await models.find_posts_content(post_ids)
+
+    answer_author_posts(inline_query, posts, next_offset)
+
+
+async def inline_publish_post(inline_query: InlineQuery, post_id: str) -> None:
+    LOGGER.info(f"Inline query with id {post_id}")
+
+    result = postutils.inline_result_cache.get(post_id)
+    if result is None:
+        try:
+            post = await models.find_post(post_id)
+        except Exception:
+            LOGGER.error(f"Error looking for ID {post_id} in inline query")
+            return
+        result = postutils.get_inline_result(post)
+
+    inline_query.answer([result], cache_time=postutils.INLINE_POST_CACHE_TIME)
+
+
+async def import_quizzes(update: Update, context: Context) -> None:
+    document = update.message.document
+    error = check_import_document(document)
+    if error is not None:
+        update.message.reply_text(error)
+        return
+
+    data = await context.api.download_file(document.file_id)
+    try:
+        quizzes = importer.load_quizzes(document.file_name, data)
+    except importer.QuizImportError as error:
+        update.message.reply_text(f"Nothing imported:\n{error.describe()}")
+        return
+
+    user_id = await models.find_or_create_user(update.effective_user.id)
+    post_ids = await models.create_posts(importer.to_posts(quizzes), user_id)
+    LOGGER.info(f"Imported {len(post_ids)} posts of user {user_id}")
+
+    for message in importer.make_publish_messages(quizzes, post_ids):
+        update.message.reply_text(**message)
+
+
+async def show_stats(update: Update, context: Context) -> None:
+    if context.args:
+        return await show_post_stats(update, context.args[0])
+
+    user_id = await models.find_or_create_user(update.effective_user.id)
+    reply_with_user_stats(update.message, *await models.get_user_stats(user_id))
+
+
+async def show_post_stats(update: Update, post_id: str) -> None:
+    """Shows the trend of a post to its author."""
+    user_id = await models.find_or_create_user(update.effective_user.id)
+    try:
+        post = await models.find_post(post_id) if ObjectId.is_valid(post_id) else None
+    except ValueError:
+        post = None
+
+    if post is None or post['author'] != user_id:
+        update.message.reply_text(f"You have no post with ID {post_id}")
+        return
+
+    trend = await models.get_post_trend(post['_id'])
+    update.message.reply_text(postutils.make_trend_text(post, trend),
+                              parse_mode=ParseMode.MARKDOWN)
+
+
+async def publish_post(update: Update, context: Context) -> None:
+    """Schedules sending the author's post to the given chats, see `quizbot.publisher`."""
+    try:
+        post_id, send_at, chat_ids = publisher.parse_publish_args(context.args)
+    except ValueError as error:
+        update.message.reply_text(str(error))
+        return
+
+    user_id = await models.find_or_create_user(update.effective_user.id)
+    try:
+        post = await models.find_post(post_id)
+    except ValueError:
+        post = None
+    if post is None or post['author'] != user_id:
+        update.message.reply_text(f"You have no post with ID {post_id}")
+        return
+
+    forbidden = await find_forbidden_chats(context.api, chat_ids, update.effective_user.id)
+    if forbidden:
+        update.message.reply_text(publisher.make_forbidden_text(forbidden))
+        return
+
+    job_id = await models.create_publish_job(post['_id'], user_id, chat_ids, send_at)
+    reply_with_created_job(update.message, job_id, post_id, chat_ids, send_at)
+
+
+async def find_forbidden_chats(api: BotAPI, chat_ids: List[ChatId],
+                               telegram_id: int) -> List[ChatId]:
+    """The chats the user may not publish to, see `quizbot.publisher.find_forbidden_chats`."""
+    async def is_forbidden(chat_id: ChatId) -> bool:
+        params = publisher.member_params(chat_id, telegram_id)
+        if params is None:
+            return False
+        try:
+            member = await api.call('getChatMember', params, timeout=30)
+        except TelegramError as error:
+            LOGGER.info(f"Failed to get user {telegram_id} in chat {chat_id}: {error}")
+            member = None
+        return not publisher.is_publishing_member(member)
+
+    forbidden = await asyncio.gather(*(is_forbidden(chat_id) for chat_id in chat_ids))
+    return [chat_id for chat_id, is_chat_forbidden in zip(chat_ids, forbidden)
+            if is_chat_forbidden]
+
+
+async def show_publish_jobs(update: Update, context: Context) -> None:
+    user_id = await models.find_or_create_user(update.effective_user.id)
+    jobs = await models.find_publish_jobs(user_id, publisher.JOBS_LISTED)
+    update.message.reply_text(publisher.make_jobs_text(jobs), parse_mode=ParseMode.MARKDOWN)
+
+
+async def cancel_publish_job(update: Update, context: Context) -> None:
+    if not context.args or not ObjectId.is_valid(context.args[0]):
+        update.message.reply_text("Usage: /canceljob <job id>")
+        return
+
+    user_id = await models.find_or_create_user(update.effective_user.id)
+    reply_with_cancelled_job(update.message, context.args[0],
+                             await models.cancel_publish_job(context.args[0], user_id))
+
+
+conversation = Conversation(
+    name='post_creating_handler',
+    entry_points=[CommandHandler('start', timed(start))],
+    states={
+        State.WAITING_POST: [MessageHandler(Filters.text | Filters.photo,
+                                            timed(start_post_creation))],
+        State.EDITING_POST: [CommandHandler('addbutton', timed(start_button_creation)),
+                             CommandHandler('finish',
+                                            timed(display_keyboard_to_choose_correct_answer))],
+        State.WAITING_BUTTON_TEXT: [MessageHandler(Filters.text, timed(add_button_text))],
+        State.WAITING_BUTTON_ALERT_TEXT: [MessageHandler(Filters.text,
+                                                         timed(add_button_alert_text))],
+        State.WAITING_CORRECT_ANSWER: [MessageHandler(Filters.text, timed(finish_post_creation))]
+    },
+    fallbacks=[CommandHandler('cancel', timed(cancel_post_creation)),
+               CommandHandler('start', timed(start))]
+)
+
+
+# Handlers tried in order, the first one accepting the update handles it
+handlers = [
+    CommandHandler('stats', timed(show_stats)),
+    CommandHandler('publish', timed(publish_post)),
+    CommandHandler('jobs', timed(show_publish_jobs)),
+    CommandHandler('canceljob', timed(cancel_publish_job)),
+    MessageHandler(Filters.document, timed(import_quizzes)),
+    CallbackQueryHandler(timed(process_inline_button_click)),
+    InlineQueryHandler(timed(inline_find_post)),
+    conversation
+]
@@ -0,0 +1,231 @@
+"""
+asyncio execution mode: updates are handled by coroutines on a single event
+loop, so thousands of clicks waiting on MongoDB or the Bot API don't need a
+thread each. Updates of a conversation (the same chat and user) are still
+handled one by one in order, everything else runs concurrently.
+"""
+
+# Generic imports
+import asyncio
+import logging
+import os
+import signal
+from typing import Dict, Hashable, List, Optional, Set
+
+# Telegram imports
+from aiohttp import web
+from telegram import Update
+
+# Custom imports
+from quizbot import metrics, startup
+from quizbot.aio.bot import BotAPI, OUTGOING
+from quizbot.aio.conversation import Context, Conversation, call_handler
+from quizbot.db import buffer, membership, timeseries
+from quizbot.ingress import ingress
+from quizbot.publisher import publisher
+from quizbot.runner import get_socks_proxy_params, register_state_metrics
+import quizbot.db.aio_models
+import quizbot.db.models
+
+
+LOGGER = logging.getLogger(__name__)
+
+UPDATES_IN_FLIGHT = metrics.Gauge('quizbot_updates_in_flight',
+                                  'Updates being handled in the asyncio mode')
+
+
+class AsyncDispatcher:
+    def __init__(self, api: BotAPI, handlers: List, max_concurrent_updates: int):
+        self.api = api
+        self.handlers = handlers
+        self.max_concurrent_updates = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._tasks: Set[asyncio.Task] = set()
+        # conversation key -> the task handling the last update of the conversation
+        self._last_tasks: Dict[Hashable, asyncio.Task] = {}
+        UPDATES_IN_FLIGHT.set_function(lambda: len(self._tasks))
+
+    async def dispatch(self, data: Dict) -> None:
+        """Starts handling the update, waiting while too many updates are in flight."""
+        update = Update.de_json(data, self.api.bot)
+        if not ingress.admit(update, len(self._tasks), self.max_concurrent_updates):
+            return
+        await self._slots.acquire()
+
+        key = Conversation.get_key(update) if update.message else None
+        previous = self._last_tasks.get(key)
+        task = asyncio.ensure_future(self._process(update, previous))
+        self._tasks.add(task)
+        if key is not None:
+            self._last_tasks[key] = task
+        task.add_done_callback(lambda task: self._done(task, key))
+
+    def _done(self, task: asyncio.Task, key: Optional[Hashable]) -> None:
+        self._tasks.discard(task)
+        self._slots.release()
+        if key is not None and self._last_tasks.get(key) is task:
+            del self._last_tasks[key]
+
+    async def _process(self, update: Update, previous: Optional[asyncio.Task]) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        calls = []
+        OUTGOING.set(calls)
+        try:
+            await self.handle(update)
+            await self.api.send(calls)
+        except Exception as error:
+            LOGGER.fatal(error, exc_info=True)
+
+    async def handle(self, update: Update) -> None:
+        for handler in self.handlers:
+            if isinstance(handler, Conversation):
+                if await handler.handle(update, self.api.bot):
+                    return
+            else:
+                check_result = handler.check_update(update)
+                if check_result:
+                    context = Context(self.api.bot, api=self.api)
+                    handler.collect_additional_context(context, update, None, check_result)
+                    await call_handler(handler, update, context)
+                    return
+
+    async def stop(self) -> None:
+        """Waits for the updates in flight to be handled."""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+
+async def start(token: str, handlers: List) -> AsyncDispatcher:
+    if get_socks_proxy_params() is not None:
+        raise RuntimeError("SOCKS5 proxy is not supported in the asyncio mode")
+
+    api = BotAPI(token, base_url=os.environ.get('TELEGRAM_BASE_URL'),
+                 base_file_url=os.environ.get('TELEGRAM_BASE_FILE_URL'))
+    await api.get_me()
+    api.start()
+    dispatcher = AsyncDispatcher(
+        api, handlers,
+        max_concurrent_updates=int(os.environ.get('ASYNCIO_MAX_CONCURRENT_UPDATES', '1000')))
+
+    register_state_metrics()
+    metrics.start_exporter()
+
+    ingress.start(lambda params: api.call_later('answerCallbackQuery', params))
+    # like the roll-up and the publish jobs below, the startup phases run on a
+    # thread with the synchronous client
+    loop = asyncio.get_running_loop()
+    # the filters of the users who answered the posts are seeded by a thread too
+    membership.answered_users.start(quizbot.db.models.read_answered_users)
+    await loop.run_in_executor(None, startup.prepare)
+    if buffer.is_enabled():
+        buffer.click_buffer.on_missing('posts', quizbot.db.models.restore_archived_posts)
+        buffer.click_buffer.start()
+    # the roll-up is a rare batch job, it runs on a thread with the synchronous client
+    timeseries.roll_up_job.start()
+    # publish jobs are sent from threads too, through the calls queue of the event loop
+    publisher.start(lambda method, params: asyncio.run_coroutine_threadsafe(
+        api.call(method, params, timeout=30), loop).result())
+
+    return dispatcher
+
+
+async def stop(dispatcher: AsyncDispatcher) -> None:
+    await dispatcher.stop()
+    # the publisher threads wait for calls sent by the event loop, so it's stopped off the loop
+    await asyncio.get_running_loop().run_in_executor(None, publisher.stop)
+    await dispatcher.api.close()
+    timeseries.roll_up_job.stop()
+    buffer.click_buffer.stop()
+    membership.answered_users.stop()
+    LOGGER.info(f"Post cache stats: {quizbot.db.models.post_cache.stats()}")
+    LOGGER.info(f"Answered users filter stats: {membership.answered_users.stats()}")
+
+
+async def wait_for_signal() -> None:
+    stopped = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    await stopped.wait()
+
+
+async def poll(dispatcher: AsyncDispatcher, timeout: int = 30) -> None:
+    api = dispatcher.api
+    await api.call('deleteWebhook')
+
+    offset = 0
+    try:
+        while True:
+            try:
+                updates = await api.get_updates(offset=offset, timeout=timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                LOGGER.exception("Failed to get updates, retrying")
+                await asyncio.sleep(1)
+                continue
+
+            for data in updates:
+                offset = data['update_id'] + 1
+                await dispatcher.dispatch(data)
+    finally:
+        # confirm the dispatched updates, the returned one (if any) remains pending
+        if offset:
+            await api.call('getUpdates', {'offset': offset, 'timeout': 0, 'limit': 1})
+
+
+async def serve_get_updates(token: str, handlers: List) -> None:
+    dispatcher = await start(token, handlers)
+    polling = asyncio.ensure_future(poll(dispatcher))
+    startup.report.finish()
+
+    signalled = asyncio.ensure_future(wait_for_signal())
+    await asyncio.wait([polling, signalled], return_when=asyncio.FIRST_COMPLETED)
+    polling.cancel()
+    signalled.cancel()
+    try:
+        await polling
+    except asyncio.CancelledError:
+        pass
+
+    await stop(dispatcher)
+
+
+async def serve_webhook(token: str, handlers: List) -> None:
+    listen = os.environ.get('TELEGRAM_WEBHOOK_LISTEN', '127.0.0.1')
+    port = int(os.environ.get('TELEGRAM_WEBHOOK_PORT', '8443'))
+    # see `quizbot.runner.run_webhook`
+    secret = os.environ['TELEGRAM_WEBHOOK_SECRET']
+    webhook_url = os.environ.get('TELEGRAM_WEBHOOK_URL')
+
+    dispatcher = await start(token, handlers)
+
+    async def receive_update(request: web.Request) -> web.Response:
+        await dispatcher.dispatch(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(f'/{secret}', receive_update)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, listen, port).start()
+    LOGGER.info(f"Listening for webhook updates on {listen}:{port}")
+
+    if webhook_url:
+        await dispatcher.api.call('setWebhook', {'url': f"{webhook_url.rstrip('/')}/{secret}"})
+        LOGGER.info(f"Webhook set to {webhook_url}")
+    startup.report.finish()
+
+    await wait_for_signal()
+    await runner.cleanup()
+    await stop(dispatcher)
+
+
+def run_get_updates(token: str, handlers: List) -> None:
+    asyncio.run(serve_get_updates(token, handlers))
+
+
+def run_webhook(token: str, handlers: List) -> None:
+    asyncio.run(serve_webhook(token, handlers))
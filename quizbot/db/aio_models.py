@@ -0,0 +1,306 @@
+"""
+Asynchronous counterpart of `quizbot.db.models` used in the asyncio mode.
+
+Documents, caches and the write-behind buffer are shared with `quizbot.db.models`,
+so both modes can serve the same database, and so are the functions building
+the filters and updates sent here. Independent round trips of a click (e.g. the
+post and author counters) are sent concurrently.
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+import asyncio
+import copy
+import datetime
+import logging
+
+from bson import Binary, ObjectId
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+from quizbot.db import archive
+from quizbot.db import buffer
+from quizbot.db import counters as counter_shards
+from quizbot.db import publish_jobs
+from quizbot.db import timeseries
+from quizbot.db.aio_mongo import get_collection
+from quizbot.db.membership import answered_users
+from quizbot.db.models import (ClickResult, POST_CONTENT_FIELDS, add_pending_counters,
+                               answer_query, author_posts_query, author_texts_query,
+                               buffer_click, click_incs, click_result, counters_target,
+                               find_button, in_given_order, index_author_posts, new_answer,
+                               new_post, post_cache, post_created_update, post_inc_update,
+                               refresh_counters, restore_post, sharding_enabled,
+                               sharding_update, user_found, user_query, user_stats,
+                               user_id_cache, user_stats_query, user_upsert)
+from quizbot.db.publish_jobs import ChatId
+from quizbot.db.search import post_index
+from quizbot.db.persistence import EMPTY_DATA, conversation_id
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+async def create_post(text: Optional[str],
+                      photo: Optional[str],
+                      buttons: Dict,
+                      user_id: ObjectId,
+                      shards: Optional[int] = None) -> ObjectId:
+    post = new_post(text=text, photo=photo, buttons=buttons, user_id=user_id, shards=shards)
+    post_id = (await get_collection('posts').insert_one(post)).inserted_id
+    post_cache.set(post_id, copy.deepcopy(post))
+    post_index.add(ObjectId(user_id), post_id, text)
+    if answered_users.is_enabled():
+        answered_users.seed(post_id, [])
+
+    await get_collection('users').update_one({'_id': ObjectId(user_id)},
+                                             post_created_update(post_id))
+
+    return post_id
+
+
+async def create_posts(posts: List[Dict], user_id: ObjectId) -> List[ObjectId]:
+    """See `quizbot.db.models.create_posts`."""
+    documents = [new_post(text=post['text'], photo=post.get('photo'), buttons=post['buttons'],
+                          user_id=ObjectId(user_id))
+                 for post in posts]
+    post_ids = (await get_collection('posts').insert_many(documents)).inserted_ids
+    for post_id, post in zip(post_ids, posts):
+        post_index.add(ObjectId(user_id), post_id, post['text'])
+
+    await get_collection('users').update_one({'_id': ObjectId(user_id)},
+                                             post_created_update(*post_ids))
+
+    return post_ids
+
+
+async def find_post(post_id: ObjectId) -> Dict:
+    """Returns the post document, which must not be modified by the caller."""
+    post_id = ObjectId(post_id)
+    post = post_cache.get(post_id)
+    if post is not None:
+        return post
+
+    post = await get_collection('posts').find_one({"_id": post_id})
+    if not post:
+        post = await get_collection(archive.POSTS_COLLECTION).find_one({"_id": post_id})
+        if not post:
+            raise ValueError(f"No post ID {post_id} in database")
+    add_pending_counters(post)
+    if post.get('counter_shards'):
+        ids = counter_shards.shard_ids(post_id, post['counter_shards'])
+        shards = await get_collection(counter_shards.SHARDS_COLLECTION).find(
+            {'_id': {'$in': ids}}).to_list(None)
+        counter_shards.apply_shards(post, shards)
+
+    post_cache.set(post_id, post)
+    return post
+
+
+async def enable_counter_sharding(post_id: ObjectId, shards: int) -> None:
+    await get_collection('posts').update_one(*sharding_update(post_id, shards))
+    sharding_enabled(post_id, shards)
+
+
+async def record_answer(user_id: ObjectId, post_id: ObjectId,
+                        user_answer: str) -> Tuple[bool, str]:
+    """See `quizbot.db.models.record_answer`."""
+    user_id, post_id = ObjectId(user_id), ObjectId(post_id)
+    answers = get_collection('answers')
+    answered_users.request_seeding(post_id)
+    if answered_users.might_contain(post_id, user_id.binary):
+        result = await answers.find_one(*answer_query(post_id, user_id))
+        if result:
+            return False, result['answer']
+        answered_users.count_false_positive()
+
+    try:
+        await answers.insert_one(new_answer(user_id, post_id, user_answer))
+        answered_users.add(post_id, user_id.binary)
+        return True, user_answer
+    except DuplicateKeyError:
+        answered_users.add(post_id, user_id.binary)
+        result = await answers.find_one(*answer_query(post_id, user_id))
+        return False, result['answer'] if result else ''
+
+
+async def find_user_id(telegram_id: str) -> Optional[ObjectId]:
+    user_id = user_id_cache.get(telegram_id)
+    if user_id is not None:
+        return user_id
+
+    return user_found(telegram_id,
+                      await get_collection('users').find_one(*user_query(telegram_id)))
+
+
+async def find_or_create_user(telegram_id: str) -> ObjectId:
+    user_id = await find_user_id(telegram_id)
+    if user_id is not None:
+        return user_id
+
+    users = get_collection('users')
+    try:
+        user = await users.find_one_and_update(**user_upsert(telegram_id))
+    except DuplicateKeyError:
+        # concurrent upsert of the same user won the race
+        user = await users.find_one(*user_query(telegram_id))
+
+    return user_found(telegram_id, user)
+
+
+async def update_stats_on_click(post: Dict, index: int, is_correct: bool) -> Dict:
+    """See `quizbot.db.models.update_stats_on_click`."""
+    post_id = post['_id']
+    post_inc, author_inc = click_incs(post, index, is_correct)
+
+    collection, doc_id, upsert = counters_target(post)
+    if not upsert and counter_shards.is_click_rate_exceeded(post_id):
+        await enable_counter_sharding(post_id, counter_shards.SHARDS)
+
+    if buffer.is_enabled():
+        buffer_click(post, is_correct, collection, doc_id, upsert, post_inc, author_inc)
+        return await find_post(post_id)
+
+    update_author = get_collection('users').update_one({'_id': post['author']},
+                                                       {'$inc': author_inc})
+    update_bucket = get_collection(timeseries.MINUTES_COLLECTION).update_one(
+        *timeseries.click_bucket_upsert(post_id, is_correct), upsert=True)
+
+    if upsert:
+        await asyncio.gather(
+            update_author,
+            update_bucket,
+            get_collection(collection).update_one({'_id': doc_id}, {'$inc': post_inc},
+                                                  upsert=True))
+        post_cache.update(post_id, lambda post: buffer.apply_incs(post, post_inc))
+        return await find_post(post_id)
+
+    def inc_post():
+        return get_collection('posts').find_one_and_update(
+            **post_inc_update(post, index, post_inc))
+
+    _, _, counters = await asyncio.gather(update_author, update_bucket, inc_post())
+    # archived since the post has been read, see `quizbot.db.archive`
+    if counters is None and await asyncio.get_running_loop().run_in_executor(
+            None, restore_post, post_id):
+        counters = await inc_post()
+    if counters is None:
+        raise ValueError(f"No post ID {post_id} in database")
+
+    post_cache.update(post_id, lambda post: refresh_counters(post, counters, index))
+    return counters
+
+
+async def record_click(post_id: ObjectId, telegram_id: str,
+                       button: Union[int, str]) -> ClickResult:
+    """
+    See `quizbot.db.models.record_click`, post and user lookups run concurrently.
+    A new user is only created once the post is found.
+    """
+    post, user_id = await asyncio.gather(find_post(post_id), find_user_id(telegram_id))
+    if 'archived_at' in post:
+        # a rare batch of writes, run on a thread with the synchronous client
+        await asyncio.get_running_loop().run_in_executor(None, restore_post, post_id)
+        post = await find_post(post_id)
+    if user_id is None:
+        user_id = await find_or_create_user(telegram_id)
+    index, button = find_button(post, button)
+
+    recorded, answer = await record_answer(user_id=user_id, post_id=post_id,
+                                           user_answer=button['text'])
+    counters = post
+    if recorded:
+        counters = await update_stats_on_click(post=post, index=index,
+                                               is_correct=button['is_correct'])
+
+    return click_result(recorded, answer, index, button, counters)
+
+
+async def get_post_trend(post_id: ObjectId) -> timeseries.Trend:
+    now = timeseries.utcnow()
+    query = timeseries.trend_query(post_id, now)
+    minute_buckets, hour_buckets = await asyncio.gather(
+        get_collection(timeseries.MINUTES_COLLECTION).find(query).to_list(None),
+        get_collection(timeseries.HOURS_COLLECTION).find(query).to_list(None))
+    return timeseries.build_trend(minute_buckets, hour_buckets, now)
+
+
+async def create_publish_job(post_id: ObjectId, user_id: ObjectId, chat_ids: List[ChatId],
+                             send_at: datetime.datetime) -> ObjectId:
+    job, deliveries = publish_jobs.job_documents(post_id, user_id, chat_ids, send_at)
+    if deliveries:
+        await get_collection(publish_jobs.DELIVERIES_COLLECTION).insert_many(deliveries)
+    # the job is only picked up once all its deliveries are saved
+    await get_collection(publish_jobs.JOBS_COLLECTION).insert_one(job)
+    return job['_id']
+
+
+async def cancel_publish_job(job_id: ObjectId, user_id: ObjectId) -> bool:
+    """Cancels the author's job unless it's over, returns whether it was."""
+    result = await get_collection(publish_jobs.JOBS_COLLECTION).update_one(
+        *publish_jobs.cancel_query(job_id, user_id))
+    return result.modified_count > 0
+
+
+async def find_publish_jobs(user_id: ObjectId, limit: int) -> List[Dict]:
+    return await (get_collection(publish_jobs.JOBS_COLLECTION)
+                  .find(publish_jobs.author_jobs_query(user_id))
+                  .sort('_id', DESCENDING).limit(limit).to_list(None))
+
+
+async def get_user_stats(user_id: ObjectId) -> Tuple[int, int, int]:
+    """Returns the number of posts created by the user and total clicks / correct clicks on them."""
+    return user_stats(await get_collection('users').find_one(*user_stats_query(user_id)))
+
+
+async def find_author_posts(user_id: ObjectId, before: Optional[ObjectId],
+                            limit: int) -> List[Dict]:
+    """See `quizbot.db.models.find_author_posts`."""
+    return await get_collection('posts').find(author_posts_query(user_id, before),
+                                              POST_CONTENT_FIELDS) \
+        .sort('_id', DESCENDING).limit(limit).to_list(None)
+
+
+async def find_posts_content(post_ids: Iterable[ObjectId]) -> List[Dict]:
+    """See `quizbot.db.models.find_posts_content`."""
+    post_ids = list(post_ids)
+    return in_given_order(await get_collection('posts').find(
+        {'_id': {'$in': post_ids}}, POST_CONTENT_FIELDS).to_list(None), post_ids)
+
+
+async def search_author_posts(user_id: ObjectId, query: str) -> List[ObjectId]:
+    """See `quizbot.db.models.search_author_posts`."""
+    user_id = ObjectId(user_id)
+    if not post_index.is_loaded(user_id):
+        # posts created while loading are added to the index by `create_post`
+        post_index.add_author(user_id)
+        index_author_posts(user_id, await get_collection('posts').find(
+            *author_texts_query(user_id)).to_list(None))
+    return post_index.search(user_id, query)
+
+
+# User data and conversation states are stored the same way as by
+# `quizbot.db.persistence.MongoPersistence`, so conversations survive switching modes
+
+async def load_user_data(user_id: int) -> bytes:
+    """Returns the pickled user data."""
+    document = await get_collection('user_data').find_one({'_id': user_id})
+    return bytes(document['data']) if document else EMPTY_DATA
+
+
+async def save_user_data(user_id: int, pickled: bytes) -> None:
+    await get_collection('user_data').replace_one(
+        {'_id': user_id}, {'data': Binary(pickled)}, upsert=True)
+
+
+async def load_conversation(name: str, key: Tuple) -> Optional[Any]:
+    document = await get_collection('conversations').find_one({'_id': conversation_id(name, key)})
+    return document['state'] if document else None
+
+
+async def save_conversation(name: str, key: Tuple, state: Optional[Any]) -> None:
+    _id = conversation_id(name, key)
+    if state is None:
+        await get_collection('conversations').delete_one({'_id': _id})
+    else:
+        await get_collection('conversations').replace_one({'_id': _id}, {'state': state},
+                                                          upsert=True)
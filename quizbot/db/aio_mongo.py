@@ -0,0 +1,23 @@
+import os
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
+
+from quizbot.db.mongo import get_database_name
+from quizbot.metrics import MongoCommandListener
+
+# Motor binds the client to the event loop, so it is created on first use
+# inside the running loop rather than at import
+_client: Optional[AsyncIOMotorClient] = None
+
+
+def get_database() -> AsyncIOMotorDatabase:
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(os.environ['MONGO_HOST'],
+                                     event_listeners=[MongoCommandListener()])
+    return _client[get_database_name()]
+
+
+def get_collection(name) -> AsyncIOMotorCollection:
+    return get_database()[name]
@@ -0,0 +1,203 @@
+"""
+Archive of posts which haven't been clicked for a while, so that the hot
+collections and their indexes only hold the posts still in use:
+
+posts_archive = {
+    # the post document, with the counters of its shards added to its own
+    ...
+    'created_at': <DATETIME>,   # the author's `posts_created` entry
+    'archived_at': <DATETIME>
+}
+
+answers_archive = {
+    '_id': '<POST ID>:<CHUNK NUMBER>',
+    'post_id': <POST ID>,
+    # answers to the post, as columns of up to `ANSWERS_CHUNK` values
+    'user_ids': [<USER ID>],
+    # index of the button, or the text if the post has no such button any more
+    'answers': [<INT or TEXT>],
+    'timestamps': [<TIMESTAMP>]
+}
+
+A post is archived once it has had no clicks for `--idle-days`, judging by the
+click buckets of `quizbot.db.timeseries`. `quizbot.db.models.find_post` falls
+back to the archive, and the first click on an archived post moves it back
+with its answers. The author's totals are kept in the user document and don't
+change on archiving.
+"""
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import copy
+import datetime
+import itertools
+import logging
+
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from quizbot.db import buttons as post_buttons
+from quizbot.db import counters as counter_shards
+from quizbot.db import timeseries
+from quizbot.db.mongo import get_collection
+
+
+LOGGER = logging.getLogger(__name__)
+
+POSTS_COLLECTION = 'posts_archive'
+ANSWERS_COLLECTION = 'answers_archive'
+
+ANSWERS_CHUNK = 10000
+ARCHIVE_BATCH = 100
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def find_idle_posts(idle_since: datetime.datetime, batch_size: int,
+                    after: Optional[ObjectId]) -> Tuple[List[Dict], Optional[ObjectId]]:
+    """
+    Reads a batch of posts created before `idle_since` following the `after`
+    post, returns the ones which haven't been clicked since and the last post ID
+    of the batch, None if there are no more posts.
+    """
+    query = {'_id': {'$lt': ObjectId.from_datetime(idle_since)}}
+    if after is not None:
+        query['_id']['$gt'] = after
+    posts = list(get_collection('posts').find(query).sort('_id', ASCENDING).limit(batch_size))
+    if not posts:
+        return [], None
+
+    clicked = {'post_id': {'$in': [post['_id'] for post in posts]}, 'start': {'$gte': idle_since}}
+    clicked_ids = (set(get_collection(timeseries.MINUTES_COLLECTION).distinct('post_id', clicked))
+                   | set(get_collection(timeseries.HOURS_COLLECTION).distinct('post_id', clicked)))
+    return [post for post in posts if post['_id'] not in clicked_ids], posts[-1]['_id']
+
+
+def compact_answers(post: Dict, answers: Iterable[Dict]) -> Iterator[Dict]:
+    """Packs the answers to the post into `answers_archive` chunks."""
+    answers = iter(answers)
+    for number in itertools.count():
+        chunk = list(itertools.islice(answers, ANSWERS_CHUNK))
+        if not chunk:
+            return
+        indexes = [post_buttons.find_index(post, answer['answer']) for answer in chunk]
+        yield {'_id': f"{post['_id']}:{number}",
+               'post_id': post['_id'],
+               'user_ids': [answer['user_id'] for answer in chunk],
+               'answers': [answer['answer'] if index is None else index
+                           for answer, index in zip(chunk, indexes)],
+               'timestamps': [answer['timestamp'] for answer in chunk]}
+
+
+def expand_answers(post: Dict, chunk: Dict) -> List[Dict]:
+    buttons = post_buttons.as_array(post['buttons'])
+    return [{'user_id': user_id,
+             'post_id': post['_id'],
+             'answer': buttons[answer]['text'] if isinstance(answer, int) else answer,
+             'timestamp': timestamp}
+            for user_id, answer, timestamp in zip(chunk['user_ids'], chunk['answers'],
+                                                  chunk['timestamps'])]
+
+
+def archive_post(post: Dict) -> bool:
+    """
+    Moves the post and its answers to the archive, returns False if it has been
+    clicked meanwhile. Until the post is deleted from `posts` a failure leaves it
+    in place; answers left behind afterwards are merged back on restore.
+    """
+    post_id = post['_id']
+    author = get_collection('users').find_one({'_id': post['author']},
+                                              {f'posts_created.{post_id}': 1}) or {}
+    created = author.get('posts_created', {}).get(str(post_id), {})
+
+    archived = counter_shards.add_shard_counters(copy.deepcopy(post))
+    archived.update(counter_shards=0, created_at=created.get('timestamp'),
+                    archived_at=timeseries.utcnow())
+    get_collection(POSTS_COLLECTION).replace_one({'_id': post_id}, archived, upsert=True)
+
+    # answers given while archiving aren't archived, so only the archived ones are deleted
+    answer_ids = []
+
+    def read_answers() -> Iterator[Dict]:
+        for answer in get_collection('answers').find({'post_id': post_id}).sort('_id', ASCENDING):
+            answer_ids.append(answer['_id'])
+            yield answer
+
+    get_collection(ANSWERS_COLLECTION).delete_many({'post_id': post_id})
+    for chunk in compact_answers(post, read_answers()):
+        get_collection(ANSWERS_COLLECTION).insert_one(chunk)
+
+    # a click since the post has been read has changed its counters; clicks on
+    # sharded counters aren't seen, but the post had none for days. A click
+    # counted after the deletion, or buffered by `quizbot.db.buffer`, finds the
+    # post missing and restores it.
+    if get_collection('posts').delete_one(
+            {'_id': post_id, 'clicks_count': post['clicks_count']}).deleted_count == 0:
+        discard_archived(post_id)
+        return False
+
+    for start in range(0, len(answer_ids), ANSWERS_CHUNK):
+        get_collection('answers').delete_many(
+            {'_id': {'$in': answer_ids[start:start + ANSWERS_CHUNK]}})
+    get_collection(counter_shards.SHARDS_COLLECTION).delete_many(
+        {'_id': {'$in': counter_shards.shard_ids(post_id, post.get('counter_shards', 0))}})
+    get_collection('users').update_one({'_id': post['author']},
+                                       {'$unset': {f'posts_created.{post_id}': 1}})
+    return True
+
+
+def discard_archived(post_id: ObjectId) -> None:
+    get_collection(ANSWERS_COLLECTION).delete_many({'post_id': post_id})
+    get_collection(POSTS_COLLECTION).delete_one({'_id': post_id})
+
+
+def archive_idle_posts(idle_days: float, batch_size: int = ARCHIVE_BATCH,
+                       dry_run: bool = False) -> int:
+    """Archives the posts which haven't been clicked for `idle_days`, returns their number."""
+    idle_since = timeseries.utcnow() - datetime.timedelta(days=idle_days)
+    archived = 0
+    after = None
+    while True:
+        posts, after = find_idle_posts(idle_since, batch_size, after)
+        if after is None:
+            break
+        for post in posts:
+            if dry_run or archive_post(post):
+                archived += 1
+        LOGGER.info(f"{'Found' if dry_run else 'Archived'} {archived} idle posts")
+    return archived
+
+
+def find_archived_post(post_id: ObjectId) -> Optional[Dict]:
+    return get_collection(POSTS_COLLECTION).find_one({'_id': ObjectId(post_id)})
+
+
+def restore_post(post_id: ObjectId) -> bool:
+    """Moves the post and its answers back from the archive, returns False if it isn't there."""
+    post_id = ObjectId(post_id)
+    post = find_archived_post(post_id)
+    if post is None:
+        return False
+
+    for chunk in get_collection(ANSWERS_COLLECTION).find({'post_id': post_id}):
+        try:
+            get_collection('answers').insert_many(expand_answers(post, chunk), ordered=False)
+        except BulkWriteError as error:
+            # restored by a concurrent click, or answered while being archived
+            if any(write_error['code'] != DUPLICATE_KEY_ERROR
+                   for write_error in error.details['writeErrors']):
+                raise
+
+    created_at = post.pop('created_at', None)
+    del post['archived_at']
+    try:
+        get_collection('posts').insert_one(post)
+    except DuplicateKeyError:
+        # restored by a concurrent click, which may have been counted already
+        pass
+    if created_at is not None:
+        get_collection('users').update_one(
+            {'_id': post['author']}, {'$set': {f'posts_created.{post_id}.timestamp': created_at}})
+    discard_archived(post_id)
+    LOGGER.info(f"Post {post_id} restored from the archive")
+    return True
@@ -0,0 +1,316 @@
+"""
+Write-behind buffer for hot counters.
+
+Clicks on a popular post produce lots of tiny `$inc`/`$set` updates of the
+same documents. Instead of sending each of them to MongoDB right away, they
+are coalesced in memory per (collection, document) and flushed with a single
+`bulk_write` per collection every `flush_interval` seconds or as soon as
+`max_ops` updates are pending.
+
+An update of a document which is missing by then, e.g. a post archived since
+the click, is retried once the document is recreated by the `on_missing`
+callback of its collection. Updates failing with a transient error (network,
+write concern timeout, primary stepping down) are retried with the next flush,
+up to `max_retries` times; the ones which can't be applied, e.g. `$inc` of a
+field of a document of another shape, are logged and dropped.
+
+Updates being flushed stay in `pending_incs` and `pending_sets` until written,
+so that a document read meanwhile isn't cached without them.
+"""
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from collections import defaultdict
+import atexit
+import logging
+import os
+import threading
+
+from pymongo import UpdateOne
+from pymongo.errors import (BulkWriteError, ConnectionFailure, ExecutionTimeout,
+                            WriteConcernError)
+
+from quizbot.db.mongo import get_collection
+from quizbot.utils import str2bool
+
+
+LOGGER = logging.getLogger(__name__)
+
+DocumentKey = Tuple[str, Any]
+
+# write errors of updates which may succeed once retried, e.g. during a primary election
+TRANSIENT_ERROR_CODES = {
+    6,      # HostUnreachable
+    7,      # HostNotFound
+    50,     # MaxTimeMSExpired
+    64,     # WriteConcernFailed
+    89,     # NetworkTimeout
+    91,     # ShutdownInProgress
+    189,    # PrimarySteppedDown
+    262,    # ExceededTimeLimit
+    9001,   # SocketException
+    10107,  # NotWritablePrimary
+    11600,  # InterruptedAtShutdown
+    11602,  # InterruptedDueToReplStateChange
+    13435,  # NotPrimaryNoSecondaryOk
+    13436,  # NotPrimaryOrSecondary
+}
+# the same as exceptions, NotMasterError being an AutoReconnect, a ConnectionFailure
+TRANSIENT_ERRORS = (ConnectionFailure, ExecutionTimeout, WriteConcernError)
+
+
+class WriteBehindBuffer:
+    def __init__(self, flush_interval: float, max_ops: int, max_retries: int):
+        self.flush_interval = flush_interval
+        self.max_ops = max_ops
+        self.max_retries = max_retries
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self._incs: Dict[DocumentKey, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self._sets: Dict[DocumentKey, Dict[str, Any]] = defaultdict(dict)
+        self._upserts = set()
+        self._ops = 0
+        # failed flushes of the requeued updates
+        self._retries: Dict[DocumentKey, int] = {}
+        # updates being written by `flush`
+        self._flushing_incs: Dict[DocumentKey, Dict[str, int]] = {}
+        self._flushing_sets: Dict[DocumentKey, Dict[str, Any]] = {}
+        # collection -> recreates the given missing documents, returns the recreated IDs
+        self._recreate: Dict[str, Callable[[List[Any]], List[Any]]] = {}
+
+    def on_missing(self, collection: str, recreate: Callable[[List[Any]], List[Any]]) -> None:
+        self._recreate[collection] = recreate
+
+    def inc(self, collection: str, doc_id: Any, fields: Dict[str, int],
+            upsert: bool = False) -> None:
+        with self._lock:
+            key = (collection, doc_id)
+            for field, value in fields.items():
+                self._incs[key][field] += value
+            if upsert:
+                self._upserts.add(key)
+            self._added()
+
+    def set(self, collection: str, doc_id: Any, fields: Dict[str, Any],
+            upsert: bool = False) -> None:
+        with self._lock:
+            key = (collection, doc_id)
+            self._sets[key].update(fields)
+            if upsert:
+                self._upserts.add(key)
+            self._added()
+
+    def pending_incs(self, collection: str, doc_id: Any) -> Dict[str, int]:
+        """Returns the increments of the document not written yet, including the ones being."""
+        with self._lock:
+            key = (collection, doc_id)
+            incs = dict(self._flushing_incs.get(key, {}))
+            for field, value in self._incs.get(key, {}).items():
+                incs[field] = incs.get(field, 0) + value
+            return incs
+
+    def pending_sets(self, collection: str, doc_id: Any) -> Dict[str, Any]:
+        with self._lock:
+            key = (collection, doc_id)
+            return {**self._flushing_sets.get(key, {}), **self._sets.get(key, {})}
+
+    @property
+    def pending_ops(self) -> int:
+        return self._ops
+
+    def _added(self) -> None:
+        self._ops += 1
+        if self._ops >= self.max_ops:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                incs, self._incs = self._incs, defaultdict(lambda: defaultdict(int))
+                sets, self._sets = self._sets, defaultdict(dict)
+                upserts, self._upserts = self._upserts, set()
+                retries, self._retries = self._retries, {}
+                self._flushing_incs, self._flushing_sets = dict(incs), dict(sets)
+                self._ops = 0
+
+            requests = defaultdict(list)
+            # collection -> keys of the documents updated by `requests`, in the same order
+            keys = defaultdict(list)
+            for key in set(incs) | set(sets):
+                collection, doc_id = key
+                update = {}
+                if incs.get(key):
+                    update['$inc'] = dict(incs[key])
+                if sets.get(key):
+                    update['$set'] = sets[key]
+                requests[collection].append(
+                    UpdateOne({'_id': doc_id}, update, upsert=key in upserts))
+                keys[collection].append(key)
+
+            flushed = 0
+            for collection, ops in requests.items():
+                failed, retried = set(), set()
+                try:
+                    try:
+                        result = get_collection(collection).bulk_write(ops, ordered=False)
+                        matched = result.matched_count + result.upserted_count
+                    except BulkWriteError as error:
+                        # the other updates of an unordered bulk write have been applied
+                        failed, retried = self._failed_writes(collection, keys[collection],
+                                                              error.details['writeErrors'],
+                                                              incs, sets)
+                        matched = (error.details['nMatched'] + error.details['nUpserted'] +
+                                   len(failed))
+                    except TRANSIENT_ERRORS:
+                        LOGGER.exception(f"Failed to flush {len(ops)} buffered "
+                                         f"updates to `{collection}`, requeueing")
+                        retried = set(keys[collection])
+                        continue
+                    except Exception:
+                        LOGGER.exception(f"Failed to flush {len(ops)} buffered updates to "
+                                         f"`{collection}`, dropping them: "
+                                         f"{describe(incs, sets, keys[collection])}")
+                        continue
+                    flushed += len(ops) - len(failed)
+
+                    if collection in self._recreate and matched < len(ops):
+                        try:
+                            retried |= self._recreate_missing(collection, incs, sets,
+                                                              upserts | failed)
+                        except Exception:
+                            LOGGER.exception(f"Failed to recreate documents of `{collection}` "
+                                             f"missed by buffered updates")
+                finally:
+                    self._requeue(collection, select(incs, retried), select(sets, retried),
+                                  upserts & retried, retries)
+
+            return flushed
+
+    def _failed_writes(self, collection: str, keys: List[DocumentKey], write_errors: List[Dict],
+                       incs: Dict, sets: Dict) -> Tuple[set, set]:
+        """Returns the keys of the failed updates of a bulk write, and of the ones to retry."""
+        failed = {keys[write_error['index']] for write_error in write_errors}
+        # transient -> write errors
+        errors = {transient: [write_error for write_error in write_errors
+                              if (write_error['code'] in TRANSIENT_ERROR_CODES) == transient]
+                  for transient in (True, False)}
+        retried = {keys[write_error['index']] for write_error in errors[True]}
+        if retried:
+            LOGGER.error(f"Failed to flush {len(retried)} of {len(keys)} buffered updates "
+                         f"to `{collection}`, requeueing them: {errors[True][0]['errmsg']}")
+        if errors[False]:
+            dropped = [keys[write_error['index']] for write_error in errors[False]]
+            messages = '; '.join({write_error['errmsg'] for write_error in errors[False]})
+            LOGGER.error(f"Dropped {len(dropped)} of {len(keys)} buffered updates to "
+                         f"`{collection}` which can't be applied ({messages}): "
+                         f"{describe(incs, sets, dropped)}")
+        return failed, retried
+
+    def _recreate_missing(self, collection: str, incs: Dict, sets: Dict,
+                          skipped: set) -> set:
+        """
+        Recreates the missing documents of the updates, except the `skipped`
+        ones, returns the keys of the recreated ones to retry.
+        """
+        doc_ids = [doc_id for name, doc_id in set(incs) | set(sets)
+                   if name == collection and (name, doc_id) not in skipped]
+        found = set(get_collection(collection).distinct('_id', {'_id': {'$in': doc_ids}}))
+        missing = [doc_id for doc_id in doc_ids if doc_id not in found]
+        recreated = {(collection, doc_id) for doc_id in self._recreate[collection](missing)}
+        if recreated:
+            LOGGER.info(f"Retrying buffered updates of {len(recreated)} recreated "
+                        f"documents of `{collection}`")
+        return recreated
+
+    def _requeue(self, collection: str, incs: Dict, sets: Dict, upserts: set,
+                 retries: Dict[DocumentKey, int]) -> None:
+        """
+        Requeues the updates unless they have failed `max_retries` times, and
+        ends the flush of the collection's updates.
+        """
+        dropped = []
+        with self._lock:
+            for key in set(incs) | set(sets):
+                if key[0] != collection:
+                    continue
+                self._retries[key] = retries.get(key, 0) + 1
+                if self._retries[key] > self.max_retries:
+                    del self._retries[key]
+                    dropped.append(key)
+                    continue
+                for field, value in incs.get(key, {}).items():
+                    self._incs[key][field] += value
+                if key in sets:
+                    # newer values set while flushing take precedence
+                    self._sets[key] = {**sets[key], **self._sets.get(key, {})}
+                if key in upserts:
+                    self._upserts.add(key)
+
+            for flushing in (self._flushing_incs, self._flushing_sets):
+                for key in [key for key in flushing if key[0] == collection]:
+                    del flushing[key]
+
+        if dropped:
+            LOGGER.error(f"Dropped buffered updates to `{collection}` still failing after "
+                         f"{self.max_retries} retries: {describe(incs, sets, dropped)}")
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='write-behind-buffer',
+                                        daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        flushed = self.flush()
+        LOGGER.info(f"Write-behind buffer stopped, {flushed} updates flushed on shutdown")
+
+
+def is_enabled() -> bool:
+    return str2bool(os.environ.get('USE_CLICK_BUFFER', 'False'))
+
+
+click_buffer = WriteBehindBuffer(
+    flush_interval=int(os.environ.get('CLICK_BUFFER_FLUSH_INTERVAL_MS', '200')) / 1000,
+    max_ops=int(os.environ.get('CLICK_BUFFER_MAX_OPS', '500')),
+    max_retries=int(os.environ.get('CLICK_BUFFER_MAX_RETRIES', '100')))
+
+
+def select(updates: Dict[DocumentKey, Dict], keys: Iterable) -> Dict[DocumentKey, Dict]:
+    return {key: updates[key] for key in keys if key in updates}
+
+
+def describe(incs: Dict, sets: Dict, keys: Iterable[DocumentKey]) -> str:
+    """Lists the updates of the documents, so that dropped ones can be applied by hand."""
+    return '; '.join(f"{doc_id}: $inc {dict(incs.get((collection, doc_id), {}))} "
+                     f"$set {sets.get((collection, doc_id), {})}"
+                     for collection, doc_id in keys)
+
+
+def apply_incs(document: Dict, incs: Dict[str, int]) -> Dict:
+    """Applies dotted-path `$inc` deltas to a local copy of a document."""
+    for path, value in incs.items():
+        *parents, field = path.split('.')
+        node = document
+        for name in parents:
+            # e.g. `buttons.1.clicks_count` is a field of an array element
+            node = node[int(name)] if isinstance(node, list) else node.setdefault(name, {})
+        node[field] = node.get(field, 0) + value
+    return document
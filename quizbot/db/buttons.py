@@ -0,0 +1,65 @@
+"""
+Buttons of a post are stored as an array in the order they are shown:
+
+post['buttons'] = [
+    {
+        'text': <TEXT>,
+        'clicks_count': <INT>,
+        'alert_text': <TEXT>,
+        'is_correct': <BOOL>
+    }
+]
+
+Counters are incremented by the button index (`buttons.<INDEX>.clicks_count`),
+so the text may contain `.`, `$` or anything else. Posts created before used to
+keep the buttons in a dict keyed by the text, these are read and incremented by
+the text until `quizbot.db.migrations.migrate_buttons_to_array` converts them.
+"""
+
+from typing import Dict, List, Optional, Union
+
+
+def from_dict(buttons: Dict) -> List[Dict]:
+    """Converts buttons keyed by the text (as collected on post creation) to the array."""
+    return [{'text': text, **button} for text, button in buttons.items()]
+
+
+def as_array(buttons: Union[List[Dict], Dict]) -> List[Dict]:
+    return buttons if isinstance(buttons, list) else from_dict(buttons)
+
+
+def find_index(post: Dict, text: str) -> Optional[int]:
+    for index, button in enumerate(as_array(post['buttons'])):
+        if button['text'] == text:
+            return index
+    return None
+
+
+def parse_key(post: Dict, key: str) -> Optional[int]:
+    """Returns the index of the button stored under `key` in e.g. a counter shard."""
+    if isinstance(post['buttons'], list) and key.isdigit():
+        return int(key)
+    # incremented by the text before the post has been converted
+    return find_index(post, key)
+
+
+def get_path(post: Dict, index: int) -> str:
+    if isinstance(post['buttons'], list):
+        return f'buttons.{index}'
+    return f"buttons.{as_array(post['buttons'])[index]['text']}"
+
+
+def get_clicks(document: Dict, index: int, text: str) -> int:
+    """Returns clicks of the button from the post or its counters in either format."""
+    buttons = document['buttons']
+    return (buttons[index] if isinstance(buttons, list) else buttons[text])['clicks_count']
+
+
+def counters_projection(post: Dict, index: int) -> Dict:
+    """Projection of the post counters changed by a click on the button."""
+    # a path with an index doesn't project an array element, a field of all elements does
+    if isinstance(post['buttons'], list):
+        clicks = 'buttons.clicks_count'
+    else:
+        clicks = f'{get_path(post, index)}.clicks_count'
+    return {'clicks_count': 1, 'correct_clicks_count': 1, clicks: 1}
@@ -0,0 +1,106 @@
+"""
+Sharded click counters of viral posts.
+
+Every click on a post increments the same post document, so under heavy load
+the writes serialize on it. A post with `counter_shards` set to K > 0 has its
+clicks spread over K documents instead:
+
+post_counter_shard = {
+    '_id': '<POST ID>:<SHARD NUMBER>',
+    'clicks_count': <INT>,
+    'correct_clicks_count': <INT>,
+    'buttons': {
+        <BUTTON INDEX>: {'clicks_count': <INT>}
+    }
+}
+
+The actual post counters are the post's own counters plus the sum of its shards,
+so a post can switch to sharded counters at any moment. Depending on
+`POST_COUNTER_SHARDING` new posts are created with `COUNTER_SHARDS` shards
+('always'), switch to them once a process sees more than
+`COUNTER_SHARDING_CLICK_RATE` clicks per second on the post ('adaptive'),
+or never use them ('off').
+"""
+
+from typing import Dict, Iterable, List
+import os
+import random
+
+from bson import ObjectId
+
+from quizbot.db import buffer
+from quizbot.db import buttons
+from quizbot.db.cache import TTLCache
+from quizbot.db.mongo import get_collection
+
+
+SHARDS_COLLECTION = 'post_counter_shards'
+
+SHARDING_MODE = os.environ.get('POST_COUNTER_SHARDING', 'off')
+SHARDS = int(os.environ.get('COUNTER_SHARDS', '8'))
+SHARDING_CLICK_RATE = float(os.environ.get('COUNTER_SHARDING_CLICK_RATE', '20'))
+
+# post ID -> [clicks in the current one second window]
+click_rates = TTLCache(max_size=10000, ttl=1)
+
+
+def default_shards() -> int:
+    return SHARDS if SHARDING_MODE == 'always' else 0
+
+
+def shard_ids(post_id: ObjectId, shards: int) -> List[str]:
+    return [f'{post_id}:{shard}' for shard in range(shards)]
+
+
+def random_shard_id(post_id: ObjectId, shards: int) -> str:
+    return f'{post_id}:{random.randrange(shards)}'
+
+
+def add_shard_counters(post: Dict) -> Dict:
+    """Adds counters of the post's shards, including buffered ones, to the post document."""
+    shards = post.get('counter_shards', 0)
+    if not shards:
+        return post
+
+    ids = shard_ids(post['_id'], shards)
+    return apply_shards(post, get_collection(SHARDS_COLLECTION).find({'_id': {'$in': ids}}))
+
+
+def apply_shards(post: Dict, shards: Iterable[Dict]) -> Dict:
+    """Adds counters of the given shard documents and the buffered ones to the post document."""
+    for shard in shards:
+        buffer.apply_incs(post, {'clicks_count': shard.get('clicks_count', 0),
+                                 'correct_clicks_count': shard.get('correct_clicks_count', 0)})
+        if 'buttons' not in post:
+            # only the totals are needed, see `rebuild_user_stats`
+            continue
+        for key, button in shard.get('buttons', {}).items():
+            index = buttons.parse_key(post, key)
+            if index is not None:
+                buffer.apply_incs(post, {f'{buttons.get_path(post, index)}.clicks_count':
+                                         button['clicks_count']})
+
+    if buffer.is_enabled():
+        for _id in shard_ids(post['_id'], post['counter_shards']):
+            buffer.apply_incs(post, buffer.click_buffer.pending_incs(SHARDS_COLLECTION, _id))
+
+    return post
+
+
+def is_click_rate_exceeded(post_id: ObjectId) -> bool:
+    """Counts a click on the post, returns True once it should switch to sharded counters."""
+    if SHARDING_MODE != 'adaptive':
+        return False
+
+    # the window expires one second after the first click in it
+    window = click_rates.get(post_id)
+    if window is None:
+        click_rates.set(post_id, [1])
+        return False
+
+    window[0] += 1
+    if window[0] < SHARDING_CLICK_RATE:
+        return False
+
+    click_rates.pop(post_id)
+    return True
@@ -0,0 +1,376 @@
+"""
+Streaming export of posts, their button counters and users' answers for analytics.
+
+Documents are read in `_id` order in batches of `batch_size`, converted to flat
+rows and written right away, so memory use doesn't depend on the size of the
+export. After each batch made durable, the last exported `_id` and the position
+in the output are saved to the checkpoint file, if given; an export started
+again with the same checkpoint continues after the last saved batch.
+
+Archived posts and answers (see `quizbot.db.archive`) are exported after the
+ones in the hot collections; a post archived or restored while being exported
+may be missed or exported twice.
+
+CSV and JSON Lines exports are single files. Parquet exports (which need
+`pyarrow`) are directories of `part-<N>.parquet` files, as Parquet files can't
+be appended to; a checkpoint is saved each time a part is complete.
+"""
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+import csv
+import datetime
+import json
+import logging
+import os
+
+from bson import ObjectId
+
+from quizbot.db import archive
+from quizbot.db import buttons as post_buttons
+from quizbot.db import counters as counter_shards
+from quizbot.db.mongo import get_collection
+
+
+LOGGER = logging.getLogger(__name__)
+
+TABLES = ('posts', 'buttons', 'answers')
+FORMATS = ('csv', 'jsonl', 'parquet')
+
+# table -> collections it is exported from, one after another
+SOURCES = {
+    'posts': ('posts', archive.POSTS_COLLECTION),
+    'buttons': ('posts', archive.POSTS_COLLECTION),
+    'answers': ('answers', archive.ANSWERS_COLLECTION),
+}
+
+# table -> column -> type of the column in Parquet files
+COLUMNS = {
+    'posts': {'post_id': 'str', 'author_id': 'str', 'author_telegram_id': 'int',
+              'created_at': 'datetime', 'type': 'str', 'text': 'str', 'photo': 'str',
+              'buttons_count': 'int', 'clicks_count': 'int', 'correct_clicks_count': 'int'},
+    'buttons': {'post_id': 'str', 'button_index': 'int', 'text': 'str', 'is_correct': 'bool',
+                'clicks_count': 'int'},
+    'answers': {'answer_id': 'str', 'post_id': 'str', 'user_id': 'str', 'telegram_id': 'int',
+                'answer': 'str', 'button_index': 'int', 'is_correct': 'bool',
+                'timestamp': 'datetime'},
+}
+
+# rows of a Parquet part file
+PARQUET_PART_ROWS = 1000000
+
+
+def find_telegram_ids(user_ids: Iterable[ObjectId]) -> Dict[ObjectId, Any]:
+    users = get_collection('users').find({'_id': {'$in': list(set(user_ids))}},
+                                         {'telegram_id': 1})
+    return {user['_id']: user.get('telegram_id') for user in users}
+
+
+def post_rows(posts: List[Dict]) -> List[Dict]:
+    telegram_ids = find_telegram_ids(post['author'] for post in posts)
+    return [{'post_id': str(post['_id']),
+             'author_id': str(post['author']),
+             'author_telegram_id': telegram_ids.get(post['author']),
+             'created_at': post['_id'].generation_time.replace(tzinfo=None),
+             'type': 'photo' if post.get('photo') else 'text',
+             'text': post.get('text'),
+             'photo': post.get('photo'),
+             'buttons_count': len(post['buttons']),
+             'clicks_count': post.get('clicks_count', 0),
+             'correct_clicks_count': post.get('correct_clicks_count', 0)}
+            for post in add_shard_counters(posts)]
+
+
+def button_rows(posts: List[Dict]) -> List[Dict]:
+    return [{'post_id': str(post['_id']),
+             'button_index': index,
+             'text': button['text'],
+             'is_correct': button['is_correct'],
+             'clicks_count': button.get('clicks_count', 0)}
+            for post in add_shard_counters(posts)
+            for index, button in enumerate(post_buttons.as_array(post['buttons']))]
+
+
+def answer_rows(answers: List[Dict]) -> List[Dict]:
+    telegram_ids = find_telegram_ids(answer['user_id'] for answer in answers)
+    post_ids = list({answer['post_id'] for answer in answers})
+    posts = {}
+    for collection in ('posts', archive.POSTS_COLLECTION):
+        missing = [post_id for post_id in post_ids if post_id not in posts]
+        if not missing:
+            break
+        posts.update({post['_id']: post_buttons.as_array(post['buttons']) for post in
+                      get_collection(collection).find({'_id': {'$in': missing}}, {'buttons': 1})})
+
+    rows = []
+    for answer in answers:
+        buttons = posts.get(answer['post_id'], [])
+        index = next((index for index, button in enumerate(buttons)
+                      if button['text'] == answer['answer']), None)
+        rows.append({'answer_id': str(answer['_id']),
+                     'post_id': str(answer['post_id']),
+                     'user_id': str(answer['user_id']),
+                     'telegram_id': telegram_ids.get(answer['user_id']),
+                     'answer': answer['answer'],
+                     'button_index': index,
+                     'is_correct': buttons[index]['is_correct'] if index is not None else None,
+                     'timestamp': answer.get('timestamp')})
+    return rows
+
+
+def expand_chunks(chunks: List[Dict], since: Optional[datetime.datetime],
+                  until: Optional[datetime.datetime]) -> List[Dict]:
+    """Unpacks `answers_archive` chunks to answers, keeping the ones given between the dates."""
+    posts = {post['_id']: post for post in get_collection(archive.POSTS_COLLECTION).find(
+        {'_id': {'$in': list({chunk['post_id'] for chunk in chunks})}}, {'buttons': 1})}
+
+    answers = []
+    for chunk in chunks:
+        post = posts.get(chunk['post_id'])
+        if post is None:
+            # restored while being exported
+            continue
+        for number, answer in enumerate(archive.expand_answers(post, chunk)):
+            timestamp = answer['timestamp']
+            if ((since is not None or until is not None) and timestamp is None
+                    or since is not None and timestamp < since
+                    or until is not None and timestamp >= until):
+                continue
+            # archived answers don't keep their IDs
+            answers.append({'_id': f"{chunk['_id']}:{number}", **answer})
+    return answers
+
+
+def add_shard_counters(posts: List[Dict]) -> List[Dict]:
+    """Adds counters of the posts' shards with one query per batch."""
+    sharded = {post['_id']: post for post in posts if post.get('counter_shards')}
+    if not sharded:
+        return posts
+
+    ids = [_id for post in sharded.values()
+           for _id in counter_shards.shard_ids(post['_id'], post['counter_shards'])]
+    shards: Dict[ObjectId, List[Dict]] = {}
+    for shard in get_collection(counter_shards.SHARDS_COLLECTION).find({'_id': {'$in': ids}}):
+        shards.setdefault(ObjectId(shard['_id'].split(':')[0]), []).append(shard)
+    for post_id, post in sharded.items():
+        counter_shards.apply_shards(post, shards.get(post_id, []))
+    return posts
+
+
+ROWS: Dict[str, Callable[[List[Dict]], List[Dict]]] = {
+    'posts': post_rows,
+    'buttons': button_rows,
+    'answers': answer_rows,
+}
+
+
+def make_query(table: str, author: Optional[ObjectId] = None,
+               since: Optional[datetime.datetime] = None,
+               until: Optional[datetime.datetime] = None,
+               collection: Optional[str] = None) -> Dict:
+    """
+    Posts and their buttons are filtered by the time the post was created,
+    answers by their `timestamp` and by the author of the post, all in UTC. Archived answer
+    chunks are matched if any answer is in the range, see `expand_chunks`.
+    """
+    query = {}
+    if table == 'answers':
+        archived = collection == archive.ANSWERS_COLLECTION
+        if author is not None:
+            posts = archive.POSTS_COLLECTION if archived else 'posts'
+            post_ids = [post['_id'] for post in get_collection(posts).find({'author': author},
+                                                                           {'_id': 1})]
+            query['post_id'] = {'$in': post_ids}
+        dates = {}
+        if since is not None:
+            dates['$gte'] = since
+        if until is not None:
+            dates['$lt'] = until
+        if dates:
+            query.update({'timestamps': {'$elemMatch': dates}} if archived
+                         else {'timestamp': dates})
+        return query
+
+    if author is not None:
+        query['author'] = author
+    if since is not None:
+        query.setdefault('_id', {})['$gte'] = ObjectId.from_datetime(since)
+    if until is not None:
+        query.setdefault('_id', {})['$lt'] = ObjectId.from_datetime(until)
+    return query
+
+
+def iterate_batches(collection: str, query: Dict, after: Optional[Any],
+                    batch_size: int) -> Iterator[List[Dict]]:
+    """Yields the matching documents in `_id` order, starting after `after`."""
+    while True:
+        batch_query = query
+        if after is not None:
+            batch_query = {**query, '_id': {**query.get('_id', {}), '$gt': after}}
+        batch = list(get_collection(collection).find(batch_query).sort('_id', 1)
+                     .limit(batch_size))
+        if not batch:
+            return
+        yield batch
+        after = batch[-1]['_id']
+
+
+class FileWriter:
+    """Writes rows to a CSV or JSON Lines file, which is truncated to the checkpoint on resume."""
+
+    def __init__(self, path: str, columns: Dict[str, str], fmt: str, position: Optional[int]):
+        if position is None:
+            self.file = open(path, 'w', newline='', encoding='utf-8')
+        else:
+            # rows written after the checkpoint are written again
+            self.file = open(path, 'r+', newline='', encoding='utf-8')
+            self.file.seek(position)
+            self.file.truncate()
+
+        self.csv = csv.DictWriter(self.file, list(columns)) if fmt == 'csv' else None
+        if self.csv is not None and not position:
+            self.csv.writeheader()
+
+    def write(self, rows: List[Dict]) -> None:
+        if self.csv is not None:
+            self.csv.writerows(rows)
+            return
+        for row in rows:
+            self.file.write(json.dumps(row, ensure_ascii=False, default=str) + '\n')
+
+    def position(self) -> Optional[int]:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetWriter:
+    """Writes rows to Parquet files of `PARQUET_PART_ROWS` rows in the `path` directory."""
+
+    def __init__(self, path: str, columns: Dict[str, str], position: Optional[int]):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet export needs pyarrow: pip install pyarrow")
+
+        self.pyarrow = pyarrow
+        self.parquet = pyarrow.parquet
+        self.path = path
+        types = {'str': pyarrow.string(), 'int': pyarrow.int64(), 'bool': pyarrow.bool_(),
+                 'datetime': pyarrow.timestamp('ms')}
+        self.schema = pyarrow.schema([(column, types[kind]) for column, kind in columns.items()])
+        # an incomplete part left by an interrupted export is written again
+        self.part = position or 0
+        self.part_rows = 0
+        self.writer = None
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, rows: List[Dict]) -> None:
+        if not rows:
+            return
+        table = self.pyarrow.Table.from_pydict(
+            {column: [row[column] for row in rows] for column in self.schema.names},
+            schema=self.schema)
+        if self.writer is None:
+            self.writer = self.parquet.ParquetWriter(
+                os.path.join(self.path, f'part-{self.part:05}.parquet'), self.schema)
+        self.writer.write_table(table)
+        self.part_rows += len(rows)
+
+    def position(self) -> Optional[int]:
+        """Returns the next part once a part is complete, None while it's being written."""
+        if self.part_rows < PARQUET_PART_ROWS:
+            return None
+        self.close()
+        return self.part
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.part += 1
+            self.part_rows = 0
+
+
+def load_checkpoint(path: Optional[str]) -> Dict:
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: Optional[str], checkpoint: Dict) -> None:
+    if path is None:
+        return
+    # replaced atomically, so an interrupted save leaves the previous checkpoint
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(f'{path}.tmp', path)
+
+
+def export(table: str, output: str, fmt: str = 'csv',
+           author: Optional[ObjectId] = None,
+           since: Optional[datetime.datetime] = None,
+           until: Optional[datetime.datetime] = None,
+           checkpoint_path: Optional[str] = None,
+           batch_size: int = 1000) -> int:
+    """Exports the table, returns the number of rows in the output."""
+    options = {'table': table, 'output': output, 'format': fmt,
+               'author': str(author) if author else None,
+               'since': since.isoformat() if since else None,
+               'until': until.isoformat() if until else None}
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint and checkpoint['options'] != options:
+        raise ValueError(f"Checkpoint {checkpoint_path} is of another export: "
+                         f"{checkpoint['options']}")
+    if checkpoint.get('finished'):
+        LOGGER.info(f"Export to {output} has already finished")
+        return checkpoint['rows']
+
+    # checkpoints of exports without the archive have no source
+    source = checkpoint.get('source', 0)
+    last_id = checkpoint.get('last_id')
+    rows_count = checkpoint.get('rows', 0)
+    if last_id is not None:
+        LOGGER.info(f"Resuming export to {output} after {last_id}, {rows_count} rows exported")
+
+    columns = COLUMNS[table]
+    if fmt == 'parquet':
+        writer = ParquetWriter(output, columns, checkpoint.get('position'))
+    else:
+        writer = FileWriter(output, columns, fmt, checkpoint.get('position'))
+
+    try:
+        for number, collection in enumerate(SOURCES[table][source:], source):
+            after = None
+            if number == source and last_id is not None:
+                # chunks of archived answers have string IDs
+                after = last_id if collection == archive.ANSWERS_COLLECTION else ObjectId(last_id)
+            size = batch_size
+            if collection == archive.ANSWERS_COLLECTION:
+                size = max(1, batch_size // archive.ANSWERS_CHUNK)
+
+            query = make_query(table, author, since, until, collection)
+            for batch in iterate_batches(collection, query, after, size):
+                documents = batch
+                if collection == archive.ANSWERS_COLLECTION:
+                    documents = expand_chunks(batch, since, until)
+                rows = ROWS[table](documents)
+                writer.write(rows)
+                rows_count += len(rows)
+                position = writer.position()
+                if position is not None:
+                    save_checkpoint(checkpoint_path, {'options': options, 'rows': rows_count,
+                                                      'source': number,
+                                                      'last_id': str(batch[-1]['_id']),
+                                                      'position': position})
+                    LOGGER.info(f"Exported {rows_count} rows")
+    finally:
+        writer.close()
+
+    save_checkpoint(checkpoint_path, {'options': options, 'rows': rows_count, 'finished': True})
+    LOGGER.info(f"Exported {rows_count} {table} rows to {output}")
+    return rows_count
@@ -0,0 +1,64 @@
+"""
+Indexes of all the collections, created at startup by `ensure_indexes`.
+Creating an existing index is a no-op, so it's safe to run in every process.
+
+A new query must be served by one of these, `python -m quizbot.manage
+check-query-plans` (see `quizbot.db.plans`) reports the ones which aren't.
+"""
+
+from typing import Dict, List
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from quizbot.db import archive
+from quizbot.db import publish_jobs
+from quizbot.db import timeseries
+from quizbot.db.mongo import get_collection
+
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    'users': [
+        # `find_user_id`
+        IndexModel('telegram_id', unique=True)
+    ],
+    'answers': [
+        # `record_answer`, a user answers a post once
+        IndexModel([('user_id', ASCENDING), ('post_id', ASCENDING)], unique=True),
+        # `seed_answered_users`, covered by the index
+        IndexModel([('post_id', ASCENDING), ('user_id', ASCENDING)])
+    ],
+    'posts': [
+        # `find_author_posts`, `search_author_posts`
+        IndexModel([('author', ASCENDING), ('_id', DESCENDING)])
+    ],
+    timeseries.MINUTES_COLLECTION: [
+        # `get_trend`, `find_idle_posts`
+        IndexModel([('post_id', ASCENDING), ('start', ASCENDING)]),
+        # `roll_up`, which skips the rolled up buckets kept for a while,
+        # `find_recently_clicked_posts`
+        IndexModel([('rolled_up', ASCENDING), ('start', ASCENDING)])
+    ],
+    timeseries.HOURS_COLLECTION: [
+        IndexModel([('post_id', ASCENDING), ('start', ASCENDING)]),
+        # `roll_up` deleting the expired buckets
+        IndexModel('start')
+    ],
+    archive.ANSWERS_COLLECTION: [
+        IndexModel('post_id')
+    ],
+    publish_jobs.JOBS_COLLECTION: [
+        # `claim_job`
+        IndexModel([('status', ASCENDING), ('send_at', ASCENDING)]),
+        # `find_author_jobs`
+        IndexModel([('author', ASCENDING), ('_id', DESCENDING)])
+    ],
+    publish_jobs.DELIVERIES_COLLECTION: [
+        # `find_pending_deliveries`
+        IndexModel([('job_id', ASCENDING), ('status', ASCENDING)])
+    ]
+}
+
+
+def ensure_indexes() -> None:
+    for collection, indexes in INDEXES.items():
+        get_collection(collection).create_indexes(indexes)
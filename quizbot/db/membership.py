@@ -0,0 +1,327 @@
+"""
+Per-post Bloom filters of the users who have answered the post.
+
+An answer is saved by inserting it under a unique index, and a user tapping the
+buttons of a post they've already answered costs a failed insert plus a lookup
+of the stored answer. Users often do so to see the alert again, so
+`record_answer` looks up the stored answer first if the post's filter may
+contain the user, and inserts right away if it certainly doesn't.
+
+A filter is seeded from the `answers` of the post by a background thread,
+requested on its first click in the process (or right away for a post created
+in the process or warmed up on startup), and updated with the answers recorded
+afterwards, including the ones recorded while it was seeded. Until the filter
+is ready, clicks insert their answer as if there were no filter. Answers
+recorded by other processes are missed, which only costs the failed insert as
+before; the unique index keeps answers correct whatever the filter says. Filters take
+`ANSWERED_FILTER_MEMORY_MB` in total, the least recently clicked posts are
+dropped first. A filter holding as many users as it was sized for grows by
+chaining another one of twice the capacity, rather than rescanning the answers
+during a click; posts with more than `ANSWERED_FILTER_MAX_USERS` answers are
+not filtered.
+"""
+
+from typing import Callable, Deque, Dict, Hashable, Iterable, Iterator, List, Optional
+from collections import OrderedDict, deque
+import atexit
+import hashlib
+import logging
+import math
+import os
+import threading
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+MEMORY_LIMIT = int(float(os.environ.get('ANSWERED_FILTER_MEMORY_MB', '64')) * 1024 * 1024)
+ERROR_RATE = float(os.environ.get('ANSWERED_FILTER_ERROR_RATE', '0.01'))
+MAX_USERS = int(os.environ.get('ANSWERED_FILTER_MAX_USERS', '1000000'))
+# users a filter is sized for at least, ~1.2 KB at 1% false positives
+MIN_CAPACITY = 1000
+# posts waiting for their filter to be seeded, more are requested again on a later click
+MAX_SEEDING_REQUESTS = 10000
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate_target = error_rate
+        # optimal number of bits and hash functions for the capacity and error rate
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: bytes) -> Iterator[int]:
+        # double hashing: k positions from the two halves of a single digest
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key: bytes) -> None:
+        is_new = False
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not self._bits[position >> 3] & mask:
+                self._bits[position >> 3] |= mask
+                is_new = True
+        self.count += is_new
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._bits)
+
+    def is_full(self) -> bool:
+        return self.count >= self.capacity
+
+    def error_rate(self) -> float:
+        """Expected false positive rate with the keys added so far."""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class ScalableBloomFilter:
+    """
+    Chain of Bloom filters, a full one is followed by one of twice the
+    capacity and half the error rate, so that the overall error rate stays
+    below `error_rate`.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.filters: List[BloomFilter] = [BloomFilter(capacity, error_rate / 2)]
+
+    def add(self, key: bytes) -> None:
+        last = self.filters[-1]
+        if last.is_full():
+            last = BloomFilter(2 * last.capacity, last.error_rate_target / 2)
+            self.filters.append(last)
+        last.add(key)
+
+    def __contains__(self, key: bytes) -> bool:
+        return any(key in bloom for bloom in self.filters)
+
+    @property
+    def count(self) -> int:
+        return sum(bloom.count for bloom in self.filters)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(bloom.nbytes for bloom in self.filters)
+
+    def error_rate(self) -> float:
+        """Expected false positive rate with the keys added so far."""
+        not_positive = 1.0
+        for bloom in self.filters:
+            not_positive *= 1 - bloom.error_rate()
+        return 1 - not_positive
+
+
+class AnsweredUsers:
+    """Thread-safe LRU map of post ID -> `ScalableBloomFilter` of user IDs bounded by total size."""
+
+    # marks posts with too many answers to be filtered
+    UNFILTERED = object()
+
+    def __init__(self, memory_limit: int, error_rate: float, max_users: int):
+        self.memory_limit = memory_limit
+        self.error_rate = error_rate
+        self.max_users = max_users
+        self.nbytes = 0
+        # clicks the filters were asked about, and how those went
+        self.negatives = 0
+        self.positives = 0
+        self.false_positives = 0
+
+        self._lock = threading.Lock()
+        self._filters: OrderedDict = OrderedDict()
+        # posts being seeded -> users added meanwhile
+        self._seeding: Dict[Hashable, List[bytes]] = {}
+        # posts waiting for the seeding thread
+        self._requests: Deque[Hashable] = deque()
+        self._requested = threading.Condition(self._lock)
+        # returns the users who answered a post, with the database client of the thread
+        self._read_users: Optional[Callable[[Hashable], Iterable[bytes]]] = None
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    def is_enabled(self) -> bool:
+        return self.memory_limit > 0
+
+    def start(self, read_users: Callable[[Hashable], Iterable[bytes]]) -> None:
+        """Starts the thread seeding the filters requested by `request_seeding`."""
+        if self._thread is not None or not self.is_enabled():
+            return
+        self._read_users = read_users
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='answered-users-seeder',
+                                        daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """Stops after seeding the current post, the requested ones are dropped."""
+        if self._thread is None:
+            return
+        with self._lock:
+            self._stopped = True
+            self._requested.notify()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                while not self._requests and not self._stopped:
+                    self._requested.wait()
+                if self._stopped:
+                    for post_id in self._requests:
+                        self._seeding.pop(post_id, None)
+                    self._requests.clear()
+                    return
+                post_id = self._requests.popleft()
+
+            try:
+                self.seed(post_id, self._read_users(post_id))
+            except Exception:
+                LOGGER.exception(f"Failed to seed the answered users filter of post {post_id}")
+                self.cancel_seeding(post_id)
+
+    def might_contain(self, post_id: Hashable, user_id: bytes) -> Optional[bool]:
+        """Returns whether the user may have answered the post, None if it isn't filtered."""
+        with self._lock:
+            bloom = self._filters.get(post_id)
+            if bloom is None or bloom is self.UNFILTERED:
+                return None
+            self._filters.move_to_end(post_id)
+            if user_id in bloom:
+                self.positives += 1
+                return True
+            self.negatives += 1
+            return False
+
+    def count_false_positive(self) -> None:
+        with self._lock:
+            self.false_positives += 1
+
+    def request_seeding(self, post_id: Hashable) -> None:
+        """
+        Queues the post to be seeded by the seeding thread, unless it has a
+        filter or is being seeded. Doesn't wait: the post isn't filtered until then.
+        """
+        with self._lock:
+            if (self._thread is None or post_id in self._filters or post_id in self._seeding
+                    or len(self._requests) >= MAX_SEEDING_REQUESTS):
+                return
+            self._seeding[post_id] = []
+            self._requests.append(post_id)
+            self._requested.notify()
+
+    def start_seeding(self, post_id: Hashable) -> bool:
+        """
+        Returns whether the caller is to seed the post's filter right away:
+        there is none, and it isn't being seeded.
+        """
+        with self._lock:
+            if post_id in self._filters or post_id in self._seeding:
+                return False
+            self._seeding[post_id] = []
+            return True
+
+    def seed(self, post_id: Hashable, user_ids: Iterable[bytes]) -> None:
+        """
+        Replaces the post's filter with one of the users, who are fetched by the
+        caller and must not be more than one over `max_users`.
+        """
+        user_ids = list(user_ids)
+        bloom = self.UNFILTERED
+        if len(user_ids) <= self.max_users:
+            bloom = ScalableBloomFilter(max(MIN_CAPACITY, 2 * len(user_ids)), self.error_rate)
+            for user_id in user_ids:
+                bloom.add(user_id)
+
+        with self._lock:
+            added = self._seeding.pop(post_id, [])
+            if bloom is not self.UNFILTERED:
+                for user_id in added:
+                    bloom.add(user_id)
+            self._put(post_id, bloom)
+
+    def cancel_seeding(self, post_id: Hashable) -> None:
+        with self._lock:
+            self._seeding.pop(post_id, None)
+
+    def add(self, post_id: Hashable, user_id: bytes) -> None:
+        with self._lock:
+            bloom = self._filters.get(post_id)
+            if bloom is None:
+                added = self._seeding.get(post_id)
+                if added is not None:
+                    added.append(user_id)
+                return
+            if bloom is self.UNFILTERED:
+                return
+            nbytes = bloom.nbytes
+            bloom.add(user_id)
+            if bloom.count > self.max_users:
+                self._put(post_id, self.UNFILTERED)
+            elif bloom.nbytes != nbytes:
+                # a filter has been chained
+                self.nbytes += bloom.nbytes - nbytes
+                self._evict()
+
+    def _put(self, post_id: Hashable, bloom) -> None:
+        self._remove(post_id)
+        self._filters[post_id] = bloom
+        self.nbytes += self._size(bloom)
+        self._evict()
+
+    def _evict(self) -> None:
+        while self.nbytes > self.memory_limit and len(self._filters) > 1:
+            self._remove(next(iter(self._filters)))
+
+    def _size(self, bloom) -> int:
+        # markers of unfiltered posts count too, so that their number is bounded
+        return 64 if bloom is self.UNFILTERED else bloom.nbytes
+
+    def _remove(self, post_id: Hashable) -> None:
+        bloom = self._filters.pop(post_id, None)
+        if bloom is not None:
+            self.nbytes -= self._size(bloom)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._filters.clear()
+            self.nbytes = 0
+
+    def __len__(self) -> int:
+        return len(self._filters)
+
+    def expected_error_rate(self) -> float:
+        """Mean expected false positive rate of the filters."""
+        with self._lock:
+            rates = [bloom.error_rate() for bloom in self._filters.values()
+                     if bloom is not self.UNFILTERED]
+        return sum(rates) / len(rates) if rates else 0.0
+
+    def false_positive_rate(self) -> float:
+        """Share of users who hadn't answered the post, but may have according to the filter."""
+        not_answered = self.negatives + self.false_positives
+        return self.false_positives / not_answered if not_answered else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'filters': len(self._filters),
+            'bytes': self.nbytes,
+            'negatives': self.negatives,
+            'positives': self.positives,
+            'false_positives': self.false_positives,
+            'false_positive_rate': self.false_positive_rate()
+        }
+
+
+answered_users = AnsweredUsers(MEMORY_LIMIT, ERROR_RATE, MAX_USERS)
@@ -0,0 +1,151 @@
+from typing import Dict, List
+import logging
+import pickle
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from quizbot.db import buttons
+from quizbot.db import counters as counter_shards
+from quizbot.db.mongo import get_collection
+from quizbot.db.persistence import MongoPersistence
+
+
+LOGGER = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def _insert_answers(answers: List[Dict]) -> int:
+    try:
+        return len(get_collection('answers').insert_many(answers, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        # answers already migrated (or given after the new schema was deployed) are skipped
+        return e.details['nInserted']
+
+
+def migrate_posts_clicked_to_answers(drop_legacy: bool = False) -> int:
+    users = get_collection('users')
+    inserted = 0
+    batch = []
+
+    cursor = users.find({'posts_clicked': {'$exists': True}}, {'posts_clicked': 1},
+                        batch_size=BATCH_SIZE)
+    for user in cursor:
+        for post_id, click in user['posts_clicked'].items():
+            batch.append({
+                'user_id': user['_id'],
+                'post_id': ObjectId(post_id),
+                'answer': click['answer'],
+                'timestamp': click.get('timestamp')
+            })
+        if len(batch) >= BATCH_SIZE:
+            inserted += _insert_answers(batch)
+            batch = []
+
+    if batch:
+        inserted += _insert_answers(batch)
+
+    LOGGER.info(f"Migrated {inserted} answers to `answers` collection")
+
+    if drop_legacy:
+        result = users.update_many({'posts_clicked': {'$exists': True}},
+                                   {'$unset': {'posts_clicked': ''}})
+        LOGGER.info(f"Removed `posts_clicked` from {result.modified_count} users")
+
+    return inserted
+
+
+def migrate_pickle_persistence(filename: str) -> None:
+    with open(filename, 'rb') as f:
+        data = pickle.load(f)
+
+    persistence = MongoPersistence()
+
+    for user_id, user_data in data.get('user_data', {}).items():
+        # photos used to be stored as `telegram.PhotoSize` objects
+        if getattr(user_data.get('photo'), 'file_id', None):
+            user_data['photo'] = user_data['photo'].file_id
+        persistence.update_user_data(user_id, user_data)
+
+    for name, conversations in data.get('conversations', {}).items():
+        for key, state in conversations.items():
+            persistence.update_conversation(name, key, state)
+
+    LOGGER.info(f"Migrated data of {len(data.get('user_data', {}))} users and "
+                f"{sum(map(len, data.get('conversations', {}).values()))} conversations")
+
+
+def _move_shard_clicks_to_post(post: Dict) -> None:
+    """
+    Moves clicks of the post's counter shards, counted by the button text, to
+    the post before its buttons are converted: a shard key is then always a
+    text, while after the conversion a numeric text can't be told from an index.
+    """
+    posts = get_collection('posts')
+    shards = get_collection(counter_shards.SHARDS_COLLECTION)
+    ids = counter_shards.shard_ids(post['_id'], post['counter_shards'])
+
+    for shard in shards.find({'_id': {'$in': ids}}):
+        for text in list(shard.get('buttons', {})):
+            if text not in post['buttons']:
+                continue
+            # read again if a click has changed the counter since it has been read
+            while True:
+                clicks = shard['buttons'][text]['clicks_count']
+                result = shards.update_one(
+                    {'_id': shard['_id'], f'buttons.{text}.clicks_count': clicks},
+                    {'$unset': {f'buttons.{text}': ''}})
+                if result.modified_count:
+                    break
+                shard = shards.find_one({'_id': shard['_id']})
+            posts.update_one({'_id': post['_id']},
+                             {'$inc': {f'buttons.{text}.clicks_count': clicks}})
+
+
+def _move_shard_clicks(post: Dict) -> None:
+    """Moves clicks of the post's counter shards from the button text to the index."""
+    indexes = {button['text']: index
+               for index, button in enumerate(buttons.as_array(post['buttons']))}
+    shards = get_collection(counter_shards.SHARDS_COLLECTION)
+    ids = counter_shards.shard_ids(post['_id'], post['counter_shards'])
+
+    for shard in shards.find({'_id': {'$in': ids}}):
+        for text, button in shard.get('buttons', {}).items():
+            # only clicks counted by the text while the post was being converted are left, a
+            # numeric text can't be told from the index of clicks counted since then
+            if text not in indexes or text.isdigit():
+                continue
+            # skipped if a click has changed the counter since it has been read
+            shards.update_one(
+                {'_id': shard['_id'], f'buttons.{text}.clicks_count': button['clicks_count']},
+                {'$unset': {f'buttons.{text}': ''},
+                 '$inc': {f'buttons.{indexes[text]}.clicks_count': button['clicks_count']}})
+
+
+def migrate_buttons_to_array() -> int:
+    """Converts buttons keyed by text to arrays, returns the number of converted posts."""
+    posts = get_collection('posts')
+    converted = 0
+
+    cursor = posts.find({'buttons': {'$not': {'$type': 'array'}}},
+                        {'buttons': 1, 'counter_shards': 1}, batch_size=BATCH_SIZE)
+    for post in cursor:
+        if post.get('counter_shards'):
+            _move_shard_clicks_to_post(post)
+            post = posts.find_one({'_id': post['_id']}, {'buttons': 1, 'counter_shards': 1})
+
+        # the update only matches if no click has changed the buttons since they have been read
+        while post is not None and isinstance(post['buttons'], dict):
+            result = posts.update_one({'_id': post['_id'], 'buttons': post['buttons']},
+                                      {'$set': {'buttons': buttons.from_dict(post['buttons'])}})
+            if result.modified_count:
+                converted += 1
+                break
+            post = posts.find_one({'_id': post['_id']}, {'buttons': 1, 'counter_shards': 1})
+
+        if post is not None and post.get('counter_shards'):
+            _move_shard_clicks(post)
+
+    LOGGER.info(f"Converted buttons of {converted} posts to arrays")
+    return converted
@@ -3,16 +3,14 @@ MongoDb documents structure:
 
 user = {
     'telegram_id': <TELEGRAM ID>,
-    'last_click': <TIMESTAMP>,
-    'posts_clicked': {
-        <POST ID>: {'timestamp': <TIMESTAMP>, 'answer': <TEXT>},
-        <POST ID>: {'timestamp': <TIMESTAMP>, 'answer': <TEXT>}
-    },
     'posts_created': {
         <POST ID>: {'timestamp': <TIMESTAMP>},
         <POST ID>: {'timestamp': <TIMESTAMP>}
     },
-    posts_created_count: <INT>
+    'posts_created_count': <INT>,
+    # totals over all the posts created by the user
+    'clicks_count': <INT>,
+    'correct_clicks_count': <INT>
 }
 
 post = {
@@ -20,121 +18,629 @@ post = {
     'photo': <TELEGRAM PHOTO ID>,
     'clicks_count': <INT>,
     'correct_clicks_count': <INT>,
-    'buttons': {
-        <TEXT>: {
+    # see `quizbot.db.buttons`
+    'buttons': [
+        {
+            'text': <TEXT>,
             'clicks_count': <INT>,
             'alert_text': <TEXT>,
             'is_correct': <BOOL>
         }
-    },
-    'author': <USER ID>
+    ],
+    'author': <USER ID>,
+    # number of counter shards, see `quizbot.db.counters`
+    'counter_shards': <INT>
 }
+
+answer = {
+    'user_id': <USER ID>,
+    'post_id': <POST ID>,
+    'answer': <TEXT>,
+    'timestamp': <TIMESTAMP>
+}
+
+Answers used to be stored in `user['posts_clicked'][<POST ID>]`, see
+`quizbot.db.migrations.migrate_posts_clicked_to_answers`.
+
+Filters, updates and projections are built by functions shared with
+`quizbot.db.aio_models`, which only differs in how it sends them.
 """
 
 
-from typing import Dict, Optional, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+import copy
 import datetime
+import logging
+import os
 
 from quizbot.db.mongo import get_collection
-from pymongo import ReturnDocument
+from quizbot.db import archive
+from quizbot.db import buffer
+from quizbot.db import buttons as post_buttons
+from quizbot.db import counters as counter_shards
+from quizbot.db import indexes
+from quizbot.db import publish_jobs
+from quizbot.db import timeseries
+from quizbot.db.cache import TTLCache
+from quizbot.db.membership import answered_users
+from quizbot.db.publish_jobs import ChatId
+from quizbot.db.search import post_index
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from bson import ObjectId
 
 
-def create_post(text: Optional[str],
-                photo: Optional[str],
-                buttons: Dict,
-                user_id: ObjectId) -> ObjectId:
-    post = {
+LOGGER = logging.getLogger(__name__)
+
+# Everything but the counters is immutable after `create_post`, so cached posts
+# are only refreshed to pick up clicks recorded by other processes. Clicks
+# recorded by this process are applied to the cached copy right away.
+post_cache = TTLCache(max_size=int(os.environ.get('POST_CACHE_SIZE', '10000')),
+                      ttl=float(os.environ.get('POST_CACHE_TTL', '30')))
+
+# telegram_id -> user ObjectId, which never changes once the user is created
+user_id_cache = TTLCache(max_size=int(os.environ.get('USER_CACHE_SIZE', '100000')),
+                         ttl=float(os.environ.get('USER_CACHE_TTL', '86400')))
+
+# answers read by a query seeding an answered users filter
+SEED_PAGE_SIZE = 10000
+
+
+class ClickResult(NamedTuple):
+    # whether this click has been recorded as the user's answer
+    recorded: bool
+    # the answer the user has given to the post, possibly with an earlier click
+    answer: str
+    # the text of the clicked button
+    button_text: str
+    # the rest is what `postutils.make_alert_text` needs, if the answer is `answer`
+    initial_text: str
+    count: int
+    total_count: int
+    is_correct: bool
+
+
+def ensure_indexes() -> None:
+    indexes.ensure_indexes()
+
+
+def new_post(text: Optional[str],
+             photo: Optional[str],
+             buttons: Dict,
+             user_id: ObjectId,
+             shards: Optional[int] = None) -> Dict:
+    return {
         'text': text,
         'photo': photo,
-        'buttons': buttons,
+        'buttons': post_buttons.from_dict(buttons),
         'author': user_id,
         'clicks_count': 0,
-        'correct_clicks_count': 0
+        'correct_clicks_count': 0,
+        'counter_shards': counter_shards.default_shards() if shards is None else shards
     }
+
+
+def post_created_update(*post_ids: ObjectId) -> Dict:
+    """The update of the author's document on creation of the posts."""
+    timestamp = timeseries.utcnow()
+    return {'$set': {f'posts_created.{post_id}.timestamp': timestamp for post_id in post_ids},
+            '$inc': {f'posts_created_count': len(post_ids)}}
+
+
+def create_post(text: Optional[str],
+                photo: Optional[str],
+                buttons: Dict,
+                user_id: ObjectId,
+                shards: Optional[int] = None) -> ObjectId:
+    post = new_post(text=text, photo=photo, buttons=buttons, user_id=user_id, shards=shards)
     post_id = get_collection('posts').insert_one(post).inserted_id
+    post_cache.set(post_id, copy.deepcopy(post))
+    post_index.add(ObjectId(user_id), post_id, text)
+    if answered_users.is_enabled():
+        # nobody has answered it yet
+        answered_users.seed(post_id, [])
 
-    get_collection('users').update_one(
-        {'_id': ObjectId(user_id)},
-        {'$set': {f'posts_created.{post_id}.timestamp': datetime.datetime.now()},
-         '$inc': {f'posts_created_count': 1}})
+    get_collection('users').update_one({'_id': ObjectId(user_id)}, post_created_update(post_id))
 
     return post_id
 
 
+def create_posts(posts: List[Dict], user_id: ObjectId) -> List[ObjectId]:
+    """
+    Creates the posts given as dicts of `create_post` arguments with a single
+    insert and a single update of the author.
+    """
+    documents = [new_post(text=post['text'], photo=post.get('photo'), buttons=post['buttons'],
+                          user_id=ObjectId(user_id))
+                 for post in posts]
+    post_ids = get_collection('posts').insert_many(documents).inserted_ids
+    # not cached, unlike a post created in the conversation they aren't clicked right away
+    for post_id, post in zip(post_ids, posts):
+        post_index.add(ObjectId(user_id), post_id, post['text'])
+
+    get_collection('users').update_one({'_id': ObjectId(user_id)},
+                                       post_created_update(*post_ids))
+
+    return post_ids
+
+
 def find_post(post_id: ObjectId) -> Dict:
-    post = get_collection('posts').find_one({"_id": ObjectId(post_id)})
+    """
+    Returns the post document, which must not be modified by the caller. An
+    archived post has `archived_at` set, see `quizbot.db.archive`.
+    """
+    post_id = ObjectId(post_id)
+    post = post_cache.get(post_id)
+    if post is not None:
+        return post
+
+    post = get_collection('posts').find_one({"_id": post_id})
     if not post:
-        raise ValueError(f"No post ID {post_id} in database")
+        post = archive.find_archived_post(post_id)
+        if not post:
+            raise ValueError(f"No post ID {post_id} in database")
+    add_pending_counters(post)
+    counter_shards.add_shard_counters(post)
+
+    post_cache.set(post_id, post)
+    return post
+
+
+def load_posts(post_ids: List[ObjectId]) -> List[Dict]:
+    """
+    Reads the posts into the cache with a single query, and seeds the filters
+    of the users who answered them. Archived posts are left out.
+    """
+    posts = list(get_collection('posts').find({'_id': {'$in': post_ids}}))
+    for post in posts:
+        add_pending_counters(post)
+        counter_shards.add_shard_counters(post)
+        post_cache.set(post['_id'], post)
+        seed_answered_users(post['_id'])
+    return posts
+
+
+def add_pending_counters(post: Dict) -> Dict:
+    """Adds the post counters still waiting in the write-behind buffer to the post document."""
+    if buffer.is_enabled():
+        buffer.apply_incs(post, buffer.click_buffer.pending_incs('posts', post['_id']))
     return post
 
 
+def sharding_update(post_id: ObjectId, shards: int) -> Tuple[Dict, Dict]:
+    """Returns the filter and the update switching the post to counter shards unless it is."""
+    return ({'_id': ObjectId(post_id), 'counter_shards': {'$not': {'$gt': 0}}},
+            {'$set': {'counter_shards': shards}})
+
+
+def sharding_enabled(post_id: ObjectId, shards: int) -> None:
+    post_cache.pop(ObjectId(post_id))
+    LOGGER.info(f"Post {post_id} switched to {shards} counter shards")
+
+
+def enable_counter_sharding(post_id: ObjectId, shards: int) -> None:
+    get_collection('posts').update_one(*sharding_update(post_id, shards))
+    sharding_enabled(post_id, shards)
+
+
+def answer_query(post_id: ObjectId, user_id: ObjectId) -> Tuple[Dict, Dict]:
+    """Returns the filter and the projection of the user's answer to the post."""
+    return {'user_id': ObjectId(user_id), 'post_id': ObjectId(post_id)}, {'answer': 1}
+
+
+def new_answer(user_id: ObjectId, post_id: ObjectId, user_answer: str) -> Dict:
+    return {
+        'user_id': ObjectId(user_id),
+        'post_id': ObjectId(post_id),
+        'answer': user_answer,
+        'timestamp': timeseries.utcnow()
+    }
+
+
 def is_post_clicked_by_user(post_id: ObjectId, user_id: ObjectId) -> Tuple[bool, str]:
-    field = f'posts_clicked.{post_id}.answer'
-    result = get_collection('users').find_one(
-        {f'_id': ObjectId(user_id), field: {'$exists': True}},
-        {field: 1})
+    result = get_collection('answers').find_one(*answer_query(post_id, user_id))
 
     if not result:
         return False, ''
 
-    return True, result['posts_clicked'][str(post_id)]['answer']
+    return True, result['answer']
+
+
+def answered_users_query(post_id: ObjectId) -> Tuple[Dict, Dict]:
+    """Returns the filter and the projection of the answers seeding the post's `answered_users`."""
+    return {'post_id': ObjectId(post_id)}, {'_id': 0, 'user_id': 1}
+
+
+def read_answered_users(post_id: ObjectId) -> Iterator[bytes]:
+    """
+    Yields the users who answered the post, reading the answers in pages of
+    `SEED_PAGE_SIZE` and stopping once there are too many to be filtered.
+    """
+    query, projection = answered_users_query(post_id)
+    remaining = answered_users.max_users + 1
+    last_user_id = None
+    while remaining > 0:
+        page_query = query if last_user_id is None else {**query,
+                                                         'user_id': {'$gt': last_user_id}}
+        limit = min(SEED_PAGE_SIZE, remaining)
+        page = list(get_collection('answers').find(page_query, projection)
+                    .sort('user_id', ASCENDING).limit(limit))
+        for answer in page:
+            yield answer['user_id'].binary
+        if len(page) < limit:
+            return
+        last_user_id = page[-1]['user_id']
+        remaining -= len(page)
+
+
+def seed_answered_users(post_id: ObjectId) -> None:
+    """Seeds the post's filter right away, clicks request it in the background instead."""
+    if not answered_users.is_enabled() or not answered_users.start_seeding(post_id):
+        return
+    try:
+        answered_users.seed(post_id, read_answered_users(post_id))
+    except Exception:
+        answered_users.cancel_seeding(post_id)
+        raise
+
+
+def record_answer(user_id: ObjectId, post_id: ObjectId, user_answer: str) -> Tuple[bool, str]:
+    """
+    Atomically saves the user's answer to the post, unless the user has already answered it.
+    Returns whether the answer has been recorded and the answer stored in the database.
+    The stored answer is looked up first if the user may have answered the post
+    according to `answered_users`.
+    """
+    user_id, post_id = ObjectId(user_id), ObjectId(post_id)
+    answered_users.request_seeding(post_id)
+    if answered_users.might_contain(post_id, user_id.binary):
+        is_clicked, answer = is_post_clicked_by_user(post_id=post_id, user_id=user_id)
+        if is_clicked:
+            return False, answer
+        answered_users.count_false_positive()
+
+    try:
+        get_collection('answers').insert_one(new_answer(user_id, post_id, user_answer))
+        answered_users.add(post_id, user_id.binary)
+        return True, user_answer
+    except DuplicateKeyError:
+        answered_users.add(post_id, user_id.binary)
+        _, answer = is_post_clicked_by_user(post_id=post_id, user_id=user_id)
+        return False, answer
+
+
+def user_query(telegram_id: str) -> Tuple[Dict, Dict]:
+    """Returns the filter and the projection of the user's ID."""
+    return {'telegram_id': telegram_id}, {'_id': 1}
+
+
+def user_upsert(telegram_id: str) -> Dict:
+    """Returns the arguments of `find_one_and_update` creating the user unless it exists."""
+    query, projection = user_query(telegram_id)
+    return dict(filter=query, update={'$setOnInsert': {'telegram_id': telegram_id}},
+                projection=projection, return_document=ReturnDocument.AFTER, upsert=True)
+
+
+def user_found(telegram_id: str, user: Optional[Dict]) -> Optional[ObjectId]:
+    if user is None:
+        return None
+    user_id_cache.set(telegram_id, user['_id'])
+    return user['_id']
+
+
+def find_user_id(telegram_id: str) -> Optional[ObjectId]:
+    user_id = user_id_cache.get(telegram_id)
+    if user_id is not None:
+        return user_id
+
+    return user_found(telegram_id, get_collection('users').find_one(*user_query(telegram_id)))
 
 
 def find_or_create_user(telegram_id: str) -> ObjectId:
-    return get_collection('users').find_one_and_update(
-        {'telegram_id': telegram_id},
-        {'$set': {'telegram_id': telegram_id}},
-        {},
-        return_document=ReturnDocument.AFTER,
-        upsert=True)['_id']
-
-
-def update_stats_on_click(user_id: ObjectId, post_id: ObjectId,
-                          user_answer: str, is_correct: bool) -> None:
-    timestamp = datetime.datetime.now()
-    get_collection('posts').update_one(
-        {'_id': ObjectId(post_id)},
-        {'$inc': {f'buttons.{user_answer}.clicks_count': 1,
-                  f'clicks_count': 1,
-                  f'correct_clicks_count': int(is_correct)}})
-
+    user_id = find_user_id(telegram_id)
+    if user_id is not None:
+        return user_id
+
+    users = get_collection('users')
+    try:
+        user = users.find_one_and_update(**user_upsert(telegram_id))
+    except DuplicateKeyError:
+        # concurrent upsert of the same user won the race
+        user = users.find_one(*user_query(telegram_id))
+
+    return user_found(telegram_id, user)
+
+
+def click_incs(post: Dict, index: int, is_correct: bool) -> Tuple[Dict, Dict]:
+    """Returns the `$inc` updates of the post and its author on a click."""
+    post_inc = {f'{post_buttons.get_path(post, index)}.clicks_count': 1,
+                f'clicks_count': 1,
+                f'correct_clicks_count': int(is_correct)}
+    author_inc = {'clicks_count': 1,
+                  'correct_clicks_count': int(is_correct)}
+    return post_inc, author_inc
+
+
+def refresh_counters(post: Dict, counters: Dict, index: int) -> None:
+    """Copies the counters returned by the database after a click to a cached post."""
+    post['clicks_count'] = counters['clicks_count']
+    post['correct_clicks_count'] = counters['correct_clicks_count']
+    text = post_buttons.as_array(post['buttons'])[index]['text']
+    button = post['buttons'][index if isinstance(post['buttons'], list) else text]
+    button['clicks_count'] = post_buttons.get_clicks(counters, index, text)
+
+
+def counters_target(post: Dict) -> Tuple[str, Any, bool]:
+    """
+    Returns where the post counters of a click are incremented: the collection,
+    the document ID and whether the document is upserted.
+    """
+    if post.get('counter_shards'):
+        return (counter_shards.SHARDS_COLLECTION,
+                counter_shards.random_shard_id(post['_id'], post['counter_shards']), True)
+    return 'posts', post['_id'], False
+
+
+def post_inc_update(post: Dict, index: int, post_inc: Dict) -> Dict:
+    """Returns the arguments of `find_one_and_update` returning the post counters after a click."""
+    return dict(filter={'_id': post['_id']}, update={'$inc': post_inc},
+                projection=post_buttons.counters_projection(post, index),
+                return_document=ReturnDocument.AFTER)
+
+
+def buffer_click(post: Dict, is_correct: bool, collection: str, doc_id: Any, upsert: bool,
+                 post_inc: Dict, author_inc: Dict) -> None:
+    """Queues the counter updates of a click in the write-behind buffer."""
+    buffer.click_buffer.inc(collection, doc_id, post_inc, upsert=upsert)
+    buffer.click_buffer.inc('users', post['author'], author_inc)
+    timeseries.buffer_click(post['_id'], is_correct)
+    post_cache.update(post['_id'], lambda cached: buffer.apply_incs(cached, post_inc))
+
+
+def update_stats_on_click(post: Dict, index: int, is_correct: bool) -> Dict:
+    """
+    Increments the post, author and minute bucket counters and returns the post
+    counters after the click.
+    """
+    post_id = post['_id']
+    post_inc, author_inc = click_incs(post, index, is_correct)
+
+    collection, doc_id, upsert = counters_target(post)
+    if not upsert and counter_shards.is_click_rate_exceeded(post_id):
+        enable_counter_sharding(post_id, counter_shards.SHARDS)
+
+    if buffer.is_enabled():
+        buffer_click(post, is_correct, collection, doc_id, upsert, post_inc, author_inc)
+        return find_post(post_id)
+
+    timeseries.count_click(post_id, is_correct)
     get_collection('users').update_one(
-        {'_id': ObjectId(user_id)},
-        {'$set': {f"last_click": timestamp,
-                  f"posts_clicked.{post_id}.timestamp": timestamp,
-                  f"posts_clicked.{post_id}.answer": user_answer}})
+        {'_id': post['author']},
+        {'$inc': author_inc})
+
+    if upsert:
+        get_collection(collection).update_one({'_id': doc_id}, {'$inc': post_inc}, upsert=True)
+        post_cache.update(post_id, lambda post: buffer.apply_incs(post, post_inc))
+        return find_post(post_id)
+
+    def inc_post() -> Optional[Dict]:
+        return get_collection('posts').find_one_and_update(
+            **post_inc_update(post, index, post_inc))
+
+    counters = inc_post()
+    # archived since the post has been read, see `quizbot.db.archive`
+    if counters is None and restore_post(post_id):
+        counters = inc_post()
+    if counters is None:
+        raise ValueError(f"No post ID {post_id} in database")
 
+    post_cache.update(post_id, lambda post: refresh_counters(post, counters, index))
+    return counters
 
-def total_user_posts(user_id: ObjectId) -> int:
-    return get_collection('users').find_one(
-        {'_id': ObjectId(user_id)},
-        {'posts_created_count': 1}).get('posts_created_count', 0)
 
+def find_button(post: Dict, button: Union[int, str]) -> Tuple[int, Dict]:
+    """Returns the index and the button given by the index or (legacy callback data) the text."""
+    index = post_buttons.find_index(post, button) if isinstance(button, str) else button
+    buttons = post_buttons.as_array(post['buttons'])
+    if index is None or not 0 <= index < len(buttons):
+        raise ValueError(f"No button {button} in post {post['_id']}")
+    return index, buttons[index]
 
-def count_user_posts_clicks(user_id: ObjectId) -> Tuple[int, int]:
-    posts = get_collection('users').find_one(
-        {'_id': ObjectId(user_id)},
-        {'posts_created': 1})['posts_created']
 
-    posts_info = get_collection('posts').find(
-        {'_id': {"$in": [ObjectId(post_id) for post_id in posts]}},
-        {'clicks_count': 1, 'correct_clicks_count': 1}
-    )
+def record_click(post_id: ObjectId, telegram_id: str, button: Union[int, str]) -> ClickResult:
+    """
+    Handles a quiz button click: saves the answer, unless the user has already
+    answered the post, and updates the post counters. Post and user lookups are
+    served from the in-memory caches, so it takes a single round trip to save the
+    answer plus two to update the counters and the minute bucket (none with the
+    write-behind buffer). A repeated click takes a single lookup of the stored
+    answer, see `quizbot.db.membership`.
+    Counts in the result exclude the user's own click.
+    """
+    post = find_post(post_id)
+    if 'archived_at' in post:
+        restore_post(post_id)
+        post = find_post(post_id)
+    user_id = find_or_create_user(telegram_id)
+    index, button = find_button(post, button)
+
+    recorded, answer = record_answer(user_id=user_id, post_id=post_id, user_answer=button['text'])
+    counters = post
+    if recorded:
+        counters = update_stats_on_click(post=post, index=index, is_correct=button['is_correct'])
+
+    return click_result(recorded, answer, index, button, counters)
+
+
+def click_result(recorded: bool, answer: str, index: int,
+                 button: Dict, counters: Dict) -> ClickResult:
+    return ClickResult(recorded=recorded,
+                       answer=answer,
+                       button_text=button['text'],
+                       initial_text=button['alert_text'],
+                       count=post_buttons.get_clicks(counters, index, button['text']) - 1,
+                       total_count=counters['clicks_count'] - 1,
+                       is_correct=button['is_correct'])
+
+
+def restore_post(post_id: ObjectId) -> bool:
+    """Moves an archived post back to `posts` once it's clicked again."""
+    restored = archive.restore_post(post_id)
+    post_cache.pop(ObjectId(post_id))
+    return restored
+
+
+def restore_archived_posts(post_ids: List[ObjectId]) -> List[ObjectId]:
+    """Restores the posts archived while buffered clicks on them were pending."""
+    return [post_id for post_id in post_ids if restore_post(post_id)]
+
+
+def get_post_trend(post_id: ObjectId) -> timeseries.Trend:
+    return timeseries.get_trend(post_id)
+
+
+def create_publish_job(post_id: ObjectId, user_id: ObjectId, chat_ids: List[ChatId],
+                       send_at: datetime.datetime) -> ObjectId:
+    return publish_jobs.create_job(post_id, user_id, chat_ids, send_at)
+
+
+def cancel_publish_job(job_id: ObjectId, user_id: ObjectId) -> bool:
+    """Cancels the author's job unless it's over, returns whether it was."""
+    return publish_jobs.cancel_job(job_id, user_id)
+
+
+def find_publish_jobs(user_id: ObjectId, limit: int) -> List[Dict]:
+    return publish_jobs.find_author_jobs(user_id, limit)
+
+
+USER_STATS_FIELDS = ('posts_created_count', 'clicks_count', 'correct_clicks_count')
+
+
+def user_stats_query(user_id: ObjectId) -> Tuple[Dict, Dict]:
+    return {'_id': ObjectId(user_id)}, {field: 1 for field in USER_STATS_FIELDS}
+
 
-    clicks_count = 0
-    correct_clicks_count = 0
-    for info in posts_info:
-        clicks_count += info.get('clicks_count', 0)
-        correct_clicks_count += info.get('correct_clicks_count', 0)
+def user_stats(user: Optional[Dict]) -> Tuple[int, int, int]:
+    return tuple((user or {}).get(field, 0) for field in USER_STATS_FIELDS)
 
-    return clicks_count, correct_clicks_count
+
+def get_user_stats(user_id: ObjectId) -> Tuple[int, int, int]:
+    """Returns the number of posts created by the user and total clicks / correct clicks on them."""
+    return user_stats(get_collection('users').find_one(*user_stats_query(user_id)))
+
+
+def total_user_posts(user_id: ObjectId) -> int:
+    return get_user_stats(user_id)[0]
+
+
+def count_user_posts_clicks(user_id: ObjectId) -> Tuple[int, int]:
+    return get_user_stats(user_id)[1:]
+
+
+def rebuild_user_stats(dry_run: bool = False) -> List[Dict]:
+    """
+    Recomputes the per-author totals from the posts and fixes them, unless `dry_run`.
+    Returns the authors whose totals have drifted.
+    """
+    expected = {}
+    # archived posts have the counters of their shards added to their own
+    for collection in ('posts', archive.POSTS_COLLECTION):
+        totals = get_collection(collection).aggregate([
+            {'$group': {'_id': '$author',
+                        'posts_created_count': {'$sum': 1},
+                        'clicks_count': {'$sum': '$clicks_count'},
+                        'correct_clicks_count': {'$sum': '$correct_clicks_count'}}}
+        ])
+        for total in totals:
+            author = expected.setdefault(total.pop('_id'), dict.fromkeys(total, 0))
+            for field, value in total.items():
+                author[field] += value
+
+    sharded_posts = get_collection('posts').find({'counter_shards': {'$gt': 0}},
+                                                 {'author': 1, 'counter_shards': 1})
+    for post in sharded_posts:
+        shards = counter_shards.add_shard_counters(
+            {**post, 'clicks_count': 0, 'correct_clicks_count': 0})
+        expected[post['author']]['clicks_count'] += shards['clicks_count']
+        expected[post['author']]['correct_clicks_count'] += shards['correct_clicks_count']
+
+    drifted = []
+    users = get_collection('users').find(
+        {'$or': [{'_id': {'$in': list(expected)}},
+                 {'clicks_count': {'$gt': 0}},
+                 {'posts_created_count': {'$gt': 0}}]},
+        {'posts_created_count': 1, 'clicks_count': 1, 'correct_clicks_count': 1})
+
+    for user in users:
+        stats = expected.get(user['_id'], {'posts_created_count': 0,
+                                           'clicks_count': 0,
+                                           'correct_clicks_count': 0})
+        actual = {field: user.get(field, 0) for field in stats}
+        if actual == stats:
+            continue
+
+        drifted.append({'_id': user['_id'], 'expected': stats, 'actual': actual})
+        if not dry_run:
+            get_collection('users').update_one({'_id': user['_id']}, {'$set': stats})
+
+    return drifted
 
 
 def count_post_clicks(post: Dict) -> Tuple[int, int]:
     return post['clicks_count'], post['correct_clicks_count']
 
 
+# what inline query results are rendered from
+POST_CONTENT_FIELDS = {'text': 1, 'photo': 1, 'buttons': 1}
+
+
+def author_posts_query(user_id: ObjectId, before: Optional[ObjectId]) -> Dict:
+    query = {'author': ObjectId(user_id)}
+    if before is not None:
+        query['_id'] = {'$lt': before}
+    return query
+
+
+def find_author_posts(user_id: ObjectId, before: Optional[ObjectId], limit: int) -> List[Dict]:
+    """Returns the content of the author's posts created before the `before` post, newest first."""
+    return list(get_collection('posts').find(author_posts_query(user_id, before),
+                                             POST_CONTENT_FIELDS)
+                .sort('_id', DESCENDING).limit(limit))
+
+
+def in_given_order(posts: Iterable[Dict], post_ids: List[ObjectId]) -> List[Dict]:
+    """Returns the posts in the order of `post_ids`, leaving out the missing ones."""
+    posts = {post['_id']: post for post in posts}
+    return [posts[post_id] for post_id in post_ids if post_id in posts]
+
+
+def find_posts_content(post_ids: Iterable[ObjectId]) -> List[Dict]:
+    """Returns the content of the existing posts in the order of `post_ids`."""
+    post_ids = list(post_ids)
+    return in_given_order(get_collection('posts').find({'_id': {'$in': post_ids}},
+                                                       POST_CONTENT_FIELDS), post_ids)
+
+
+def author_texts_query(user_id: ObjectId) -> Tuple[Dict, Dict]:
+    """Returns the filter and the projection of the texts indexed by `post_index`."""
+    return {'author': ObjectId(user_id), 'text': {'$ne': None}}, {'text': 1}
+
+
+def index_author_posts(user_id: ObjectId, posts: Iterable[Dict]) -> None:
+    for post in posts:
+        post_index.add(user_id, post['_id'], post['text'])
+
+
+def search_author_posts(user_id: ObjectId, query: str) -> List[ObjectId]:
+    """Returns the author's posts with words starting with the words of the query, newest first."""
+    user_id = ObjectId(user_id)
+    if not post_index.is_loaded(user_id):
+        # posts created while loading are added to the index by `create_post`
+        post_index.add_author(user_id)
+        index_author_posts(user_id, get_collection('posts').find(*author_texts_query(user_id)))
+    return post_index.search(user_id, query)
+
+
 def is_post_existing(post_id: ObjectId) -> bool:
     return get_collection('posts').find_one(
         {'_id': ObjectId(post_id)}, {}) is not None
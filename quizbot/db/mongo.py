@@ -1,11 +1,60 @@
+import logging
 import os
+import threading
+import time
+from typing import Optional
+
 from pymongo import MongoClient
 from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+
+from quizbot.metrics import MongoCommandListener
+
+
+LOGGER = logging.getLogger(__name__)
+
+# MongoClient is not fork-safe, so each process creates its own on first use,
+# and it connects on its first command rather than on creation
+_client: Optional[MongoClient] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+
 
-client = MongoClient(os.environ['MONGO_HOST'])
-db = client['quiz_posts']
+def get_database_name() -> str:
+    return os.environ.get('MONGO_DATABASE', 'quiz_posts')
+
+
+def get_client() -> MongoClient:
+    global _client, _client_pid
+    if _client_pid == os.getpid():
+        return _client
+
+    with _client_lock:
+        if _client_pid != os.getpid():
+            _client = MongoClient(os.environ['MONGO_HOST'], connect=False,
+                                  event_listeners=[MongoCommandListener()])
+            _client_pid = os.getpid()
+        return _client
+
+
+def get_database() -> Database:
+    return get_client()[get_database_name()]
 
 
 def get_collection(name) -> Collection:
-    return db[name]
+    return get_database()[name]
+
 
+def wait_for_server(timeout: float) -> None:
+    """Pings the server until it answers, raises RuntimeError if it doesn't within `timeout`."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            get_client().admin.command('ping')
+            return
+        except PyMongoError as error:
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f"MongoDB is not available: {error}")
+            LOGGER.warning(f"MongoDB is not available yet, retrying: {error}")
+            time.sleep(1)
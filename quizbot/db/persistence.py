@@ -0,0 +1,186 @@
+"""
+MongoDB-backed persistence of `user_data` and conversation states.
+
+MongoDb documents structure:
+
+user_data = {
+    '_id': <TELEGRAM ID>,
+    'data': <PICKLED USER DATA>
+}
+
+conversation = {
+    '_id': '<CONVERSATION NAME>:<KEY>:<KEY>...',
+    'state': <STATE>
+}
+
+Nothing is loaded at startup: user data and conversation states are read on
+first access, and only the values which have changed since they were last
+read or written are saved.
+"""
+
+from typing import Any, Dict, Hashable, Optional, Tuple
+from collections import defaultdict
+import logging
+import pickle
+import threading
+
+from bson import Binary
+from telegram.ext import BasePersistence
+
+from quizbot.db.mongo import get_collection
+
+
+LOGGER = logging.getLogger(__name__)
+
+EMPTY_DATA = pickle.dumps({})
+
+
+def conversation_id(name: str, key: Tuple) -> str:
+    return ':'.join([name, *map(str, key)])
+
+
+class LazyDict(dict):
+    """User data of a single user, read from the database on first access."""
+
+    def __init__(self, loader):
+        super().__init__()
+        self.loader = loader
+        self.loaded = False
+
+    def load(self) -> 'LazyDict':
+        if not self.loaded:
+            self.loaded = True
+            super().update(self.loader())
+        return self
+
+
+def _loading(method):
+    def wrapper(self, *args, **kwargs):
+        return method(self.load(), *args, **kwargs)
+    return wrapper
+
+
+for _method in ['__getitem__', '__setitem__', '__delitem__', '__contains__', '__iter__',
+                '__len__', '__eq__', '__repr__', 'get', 'setdefault', 'pop', 'popitem',
+                'update', 'keys', 'items', 'values', 'clear', 'copy']:
+    setattr(LazyDict, _method, _loading(getattr(dict, _method)))
+
+
+class LazyUserData(defaultdict):
+    def __init__(self, persistence: 'MongoPersistence'):
+        super().__init__(dict)
+        self.persistence = persistence
+
+    def __missing__(self, user_id: int) -> LazyDict:
+        # Users clicking quiz buttons never touch their data, so the dispatcher
+        # asking for it after every update must not hit the database
+        data = LazyDict(lambda: self.persistence.load_user_data(user_id))
+        self[user_id] = data
+        return data
+
+
+class LazyConversations(dict):
+    def __init__(self, persistence: 'MongoPersistence', name: str):
+        super().__init__()
+        self.persistence = persistence
+        self.name = name
+        self._loaded = set()
+
+    def _load(self, key: Tuple) -> None:
+        if key in self._loaded:
+            return
+        self._loaded.add(key)
+        state = self.persistence.load_conversation(self.name, key)
+        if state is not None:
+            super().setdefault(key, state)
+
+    def __contains__(self, key: Hashable) -> bool:
+        self._load(key)
+        return super().__contains__(key)
+
+    def __getitem__(self, key: Hashable) -> Any:
+        self._load(key)
+        return super().__getitem__(key)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        self._load(key)
+        return super().get(key, default)
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        self._loaded.add(key)
+        super().__setitem__(key, value)
+
+
+class MongoPersistence(BasePersistence):
+    def __init__(self):
+        super().__init__(store_user_data=True, store_chat_data=False)
+        self.user_data: Optional[LazyUserData] = None
+        self.conversations: Dict[str, LazyConversations] = {}
+
+        self._lock = threading.Lock()
+        # pickled user data and conversation states as stored in the database
+        self._stored_user_data: Dict[int, bytes] = {}
+        self._stored_states: Dict[str, Any] = {}
+
+    def load_user_data(self, user_id: int) -> Dict:
+        document = get_collection('user_data').find_one({'_id': user_id})
+        stored = bytes(document['data']) if document else EMPTY_DATA
+        with self._lock:
+            self._stored_user_data[user_id] = stored
+        return pickle.loads(stored)
+
+    def load_conversation(self, name: str, key: Tuple) -> Optional[str]:
+        _id = conversation_id(name, key)
+        document = get_collection('conversations').find_one({'_id': _id})
+        state = document['state'] if document else None
+        with self._lock:
+            self._stored_states[_id] = state
+        return state
+
+    def get_user_data(self) -> LazyUserData:
+        if self.user_data is None:
+            self.user_data = LazyUserData(self)
+        return self.user_data
+
+    def get_chat_data(self) -> Dict:
+        raise NotImplementedError("Chat data is not persisted")
+
+    def get_conversations(self, name: str) -> LazyConversations:
+        if name not in self.conversations:
+            self.conversations[name] = LazyConversations(self, name)
+        return self.conversations[name]
+
+    def update_conversation(self, name: str, key: Tuple, new_state: Optional[str]) -> None:
+        _id = conversation_id(name, key)
+        with self._lock:
+            if _id in self._stored_states and self._stored_states[_id] == new_state:
+                return
+            self._stored_states[_id] = new_state
+
+        if new_state is None:
+            get_collection('conversations').delete_one({'_id': _id})
+        else:
+            get_collection('conversations').replace_one(
+                {'_id': _id}, {'state': new_state}, upsert=True)
+
+    def update_user_data(self, user_id: int, data: Dict) -> None:
+        if isinstance(data, LazyDict):
+            if not data.loaded:
+                return
+            data = dict(data)
+
+        pickled = pickle.dumps(data)
+        with self._lock:
+            if self._stored_user_data.get(user_id, EMPTY_DATA) == pickled:
+                return
+            self._stored_user_data[user_id] = pickled
+
+        get_collection('user_data').replace_one(
+            {'_id': user_id}, {'data': Binary(pickled)}, upsert=True)
+
+    def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        pass
+
+    def flush(self) -> None:
+        # every change is written right away in `update_*` methods
+        pass
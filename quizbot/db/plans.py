@@ -0,0 +1,261 @@
+"""
+Query plan regression check, run with `python -m quizbot.manage check-query-plans`.
+
+Seeds a scratch database next to the bot's one with users, posts, answers,
+click buckets, a sharded and an archived post and a publish job, then calls the
+functions of `quizbot.db.models` (and the jobs of the other data modules)
+recording the commands they send. Every recorded query is explained on the
+seeded data, and the check fails on a collection scan or when a query examines
+more than `max_wasted` documents it doesn't return.
+"""
+
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+import datetime
+import logging
+import os
+
+from bson import SON
+from pymongo import monitoring
+
+from quizbot.db import archive
+from quizbot.db import membership
+from quizbot.db import publish_jobs
+from quizbot.db import timeseries
+from quizbot.db.mongo import get_client, get_database, get_database_name
+import quizbot.db.models as models
+
+
+LOGGER = logging.getLogger(__name__)
+
+EXPLAINED_COMMANDS = ('find', 'count', 'distinct', 'aggregate', 'update', 'delete',
+                      'findAndModify')
+# fields of a sent command which `explain` doesn't accept
+SESSION_FIELDS = ('lsid', 'txnNumber', '$clusterTime', '$db', '$readPreference',
+                  'writeConcern', 'readConcern')
+
+# functions which scan whole collections by design
+FULL_SCANS = {
+    'rebuild_user_stats': "recomputes the totals of all the authors"
+}
+
+# documents a query may examine on top of the ones it returns
+MAX_WASTED_DOCS = 20
+
+SEED_AUTHORS = 10
+SEED_POSTS_PER_AUTHOR = 10
+SEED_CLICKS_PER_POST = 20
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """Records the commands sent to the scratch database while `function` is set."""
+
+    def __init__(self, database: str):
+        self.database = database
+        self.function: Optional[str] = None
+        self.commands: List[Tuple[str, SON]] = []
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if (self.function is not None and event.database_name == self.database
+                and event.command_name in EXPLAINED_COMMANDS):
+            self.commands.append((self.function, SON(event.command)))
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        pass
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        pass
+
+
+class PlanReport(NamedTuple):
+    function: str
+    command: str
+    collection: str
+    stages: List[str]
+    docs_examined: int
+    returned: int
+    problem: Optional[str]
+
+    def describe(self) -> str:
+        text = (f"{self.function}: {self.command} {self.collection} "
+                f"[{' > '.join(self.stages)}] examined {self.docs_examined}, "
+                f"returned {self.returned}")
+        return f"{text} -- {self.problem}" if self.problem else text
+
+
+def explainable(command: SON) -> Iterator[SON]:
+    """Yields the command without the session fields, a write of several statements per one."""
+    command = SON((key, value) for key, value in command.items() if key not in SESSION_FIELDS)
+    statements = {'update': 'updates', 'delete': 'deletes'}.get(next(iter(command)))
+    if statements is None:
+        yield command
+        return
+    for statement in command[statements]:
+        yield SON([*((key, value) for key, value in command.items() if key != statements),
+                   (statements, [statement])])
+
+
+def find_stages(node) -> Iterator[str]:
+    if isinstance(node, dict):
+        if isinstance(node.get('stage'), str):
+            yield node['stage']
+        for key, value in node.items():
+            if key not in ('rejectedPlans', 'allPlansExecution'):
+                yield from find_stages(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from find_stages(value)
+
+
+def find_execution_stats(node) -> Dict:
+    if isinstance(node, dict):
+        if 'executionStats' in node:
+            return node['executionStats']
+        for value in node.values():
+            stats = find_execution_stats(value)
+            if stats:
+                return stats
+    elif isinstance(node, list):
+        for value in node:
+            stats = find_execution_stats(value)
+            if stats:
+                return stats
+    return {}
+
+
+def explain(function: str, command: SON, max_wasted: int) -> PlanReport:
+    result = get_database().command('explain', command, verbosity='executionStats')
+    stats = find_execution_stats(result)
+    stages = list(dict.fromkeys(find_stages(result.get('queryPlanner', result))))
+    docs_examined = stats.get('totalDocsExamined', 0)
+    returned = stats.get('nReturned', 0)
+
+    problem = None
+    if function in FULL_SCANS:
+        pass
+    elif 'COLLSCAN' in stages:
+        problem = "collection scan"
+    elif docs_examined - returned > max_wasted:
+        problem = f"examines {docs_examined - returned} documents it doesn't return"
+
+    name = next(iter(command))
+    return PlanReport(function=function, command=name, collection=str(command[name]),
+                      stages=stages, docs_examined=docs_examined, returned=returned,
+                      problem=problem)
+
+
+def seed() -> Dict:
+    """Fills the scratch database, returns the IDs the workload queries."""
+    authors = [models.find_or_create_user(str(1000 + number)) for number in range(SEED_AUTHORS)]
+    post_ids = []
+    for author in authors:
+        buttons = {'Yes': {'alert_text': '', 'clicks_count': 0, 'correct_clicks_count': 0,
+                           'is_correct': True},
+                   'No': {'alert_text': '', 'clicks_count': 0, 'correct_clicks_count': 0,
+                          'is_correct': False}}
+        post_ids += models.create_posts([{'text': f'Quiz number {number}', 'buttons': buttons}
+                                         for number in range(SEED_POSTS_PER_AUTHOR)], author)
+
+    for number, post_id in enumerate(post_ids):
+        for click in range(SEED_CLICKS_PER_POST):
+            models.record_click(post_id, str(2000 + number + click), click % 2)
+
+    sharded, archived = post_ids[1], post_ids[2]
+    models.enable_counter_sharding(sharded, 4)
+    models.record_click(sharded, '1', 0)
+    archive.archive_post(models.find_post(archived))
+    models.post_cache.clear()
+    # later hours are rolled up, and new clicks stay in minute buckets
+    timeseries.roll_up(timeseries.utcnow() + datetime.timedelta(hours=2))
+
+    job_id = models.create_publish_job(post_ids[0], authors[0], list(range(-100, 0)),
+                                       datetime.datetime.utcnow())
+    return {'author': authors[0], 'post': post_ids[0], 'sharded': sharded,
+            'archived': archived, 'posts': post_ids, 'job': job_id}
+
+
+def workload(ids: Dict) -> List[Tuple[str, Callable]]:
+    """Calls of the data layer functions querying the database, by function name."""
+    author, post_id = ids['author'], ids['post']
+    now = datetime.datetime.utcnow()
+    lease = datetime.timedelta(minutes=1)
+
+    def find_post(post_id):
+        models.post_cache.clear()
+        return models.find_post(post_id)
+
+    def find_user_id():
+        models.user_id_cache.clear()
+        return models.find_user_id('1000')
+
+    def seed_answered_users():
+        membership.answered_users.clear()
+        return models.seed_answered_users(post_id)
+
+    def deliver():
+        deliveries = publish_jobs.find_pending_deliveries(ids['job'], 10)
+        publish_jobs.record_deliveries(ids['job'], [(delivery['_id'], 1, None)
+                                                    for delivery in deliveries])
+
+    return [
+        ('find_post', lambda: find_post(post_id)),
+        ('find_post', lambda: find_post(ids['sharded'])),
+        ('find_post', lambda: find_post(ids['archived'])),
+        ('find_user_id', find_user_id),
+        ('find_or_create_user', lambda: models.find_or_create_user('999999')),
+        ('is_post_clicked_by_user', lambda: models.is_post_clicked_by_user(post_id, author)),
+        ('seed_answered_users', seed_answered_users),
+        ('record_click', lambda: models.record_click(post_id, '3000', 0)),
+        ('record_click', lambda: models.record_click(post_id, '3000', 1)),
+        ('record_click', lambda: models.record_click(ids['sharded'], '3000', 0)),
+        ('restore_post', lambda: models.restore_post(ids['archived'])),
+        ('enable_counter_sharding', lambda: models.enable_counter_sharding(ids['posts'][3], 4)),
+        ('get_post_trend', lambda: models.get_post_trend(post_id)),
+        ('get_user_stats', lambda: models.get_user_stats(author)),
+        ('find_author_posts', lambda: models.find_author_posts(author, None, 5)),
+        ('find_author_posts', lambda: models.find_author_posts(author, ids['posts'][5], 5)),
+        ('find_posts_content', lambda: models.find_posts_content(ids['posts'][:5])),
+        ('load_posts', lambda: models.load_posts(ids['posts'][:5])),
+        ('search_author_posts', lambda: models.search_author_posts(author, 'quiz')),
+        ('is_post_existing', lambda: models.is_post_existing(post_id)),
+        ('find_publish_jobs', lambda: models.find_publish_jobs(author, 10)),
+        ('claim_job', lambda: publish_jobs.claim_job(now, lease)),
+        ('renew_lease', lambda: publish_jobs.renew_lease(ids['job'], now, lease)),
+        ('record_deliveries', deliver),
+        ('finish_job', lambda: publish_jobs.finish_job(ids['job'])),
+        ('cancel_publish_job', lambda: models.cancel_publish_job(ids['job'], author)),
+        ('find_recently_clicked_posts', lambda: timeseries.find_recently_clicked_posts(
+            now - datetime.timedelta(hours=1), 100)),
+        ('roll_up', lambda: timeseries.roll_up(now + datetime.timedelta(hours=2))),
+        ('find_idle_posts', lambda: archive.find_idle_posts(now, 100, None)),
+        ('archive_post', lambda: archive.archive_post(models.find_post(ids['posts'][4]))),
+        ('rebuild_user_stats', lambda: models.rebuild_user_stats(dry_run=True)),
+    ]
+
+
+def check_query_plans(max_wasted: int = MAX_WASTED_DOCS) -> List[PlanReport]:
+    """
+    Runs the check in a scratch database, returns the reports of the recorded
+    queries. Must be called before the first query of the process, so that the
+    recorder sees the commands of the client.
+    """
+    database = f'{get_database_name()}_plan_check'
+    os.environ['MONGO_DATABASE'] = database
+    recorder = CommandRecorder(database)
+    monitoring.register(recorder)
+
+    get_client().drop_database(database)
+    try:
+        models.ensure_indexes()
+        ids = seed()
+        LOGGER.info(f"Seeded {database}, running the queries")
+        for function, call in workload(ids):
+            recorder.function = function
+            try:
+                call()
+            finally:
+                recorder.function = None
+
+        return [explain(function, command, max_wasted)
+                for function, sent in recorder.commands for command in explainable(sent)]
+    finally:
+        get_client().drop_database(database)
@@ -0,0 +1,147 @@
+"""
+Jobs publishing a post to many chats at a set time, see `quizbot.publisher`:
+
+publish_job = {
+    'post_id': <POST ID>,
+    'author': <USER ID>,
+    'send_at': <DATETIME>,      # UTC
+    'status': 'scheduled' | 'running' | 'done' | 'cancelled',
+    # a running job is sent by one process until then, and taken over afterwards
+    'lease_until': <DATETIME>,
+    'chats_count': <INT>,
+    'sent_count': <INT>,
+    'failed_count': <INT>,
+    'created_at': <DATETIME>,
+    'finished_at': <DATETIME>
+}
+
+publish_delivery = {
+    '_id': '<JOB ID>:<CHAT ID>',
+    'job_id': <JOB ID>,
+    'chat_id': <CHAT ID OR @USERNAME>,
+    'status': 'pending' | 'sent' | 'failed',
+    'message_id': <INT>,
+    'error': <TEXT>
+}
+
+Deliveries are marked once sent, so a job interrupted by a restart resumes with
+the pending ones; messages in flight at the moment may be sent twice.
+"""
+
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+
+from quizbot.db.mongo import get_collection
+
+
+JOBS_COLLECTION = 'publish_jobs'
+DELIVERIES_COLLECTION = 'publish_deliveries'
+
+ChatId = Union[int, str]
+
+
+def job_documents(post_id: ObjectId, user_id: ObjectId, chat_ids: Iterable[ChatId],
+                  send_at: datetime.datetime) -> Tuple[Dict, List[Dict]]:
+    """Returns the documents of a new job and its deliveries."""
+    job_id = ObjectId()
+    # the same chat given twice gets the post once
+    chat_ids = list(dict.fromkeys(chat_ids))
+    deliveries = [{'_id': f'{job_id}:{chat_id}', 'job_id': job_id, 'chat_id': chat_id,
+                   'status': 'pending'}
+                  for chat_id in chat_ids]
+    job = {
+        '_id': job_id,
+        'post_id': ObjectId(post_id),
+        'author': ObjectId(user_id),
+        'send_at': send_at,
+        'status': 'scheduled',
+        'chats_count': len(chat_ids),
+        'sent_count': 0,
+        'failed_count': 0,
+        'created_at': datetime.datetime.utcnow()
+    }
+    return job, deliveries
+
+
+def create_job(post_id: ObjectId, user_id: ObjectId, chat_ids: Iterable[ChatId],
+               send_at: datetime.datetime) -> ObjectId:
+    job, deliveries = job_documents(post_id, user_id, chat_ids, send_at)
+    if deliveries:
+        get_collection(DELIVERIES_COLLECTION).insert_many(deliveries)
+    # the job is only picked up once all its deliveries are saved
+    get_collection(JOBS_COLLECTION).insert_one(job)
+    return job['_id']
+
+
+def claim_job(now: datetime.datetime, lease: datetime.timedelta) -> Optional[Dict]:
+    """Returns a job due to be sent, or abandoned by a stopped process, leased to the caller."""
+    return get_collection(JOBS_COLLECTION).find_one_and_update(
+        {'$or': [{'status': 'scheduled', 'send_at': {'$lte': now}},
+                 {'status': 'running', 'lease_until': {'$lt': now}}]},
+        {'$set': {'status': 'running', 'lease_until': now + lease}},
+        sort=[('send_at', ASCENDING)],
+        return_document=ReturnDocument.AFTER)
+
+
+def renew_lease(job_id: ObjectId, now: datetime.datetime, lease: datetime.timedelta) -> bool:
+    """Extends the lease of a running job, returns False if it has been cancelled."""
+    result = get_collection(JOBS_COLLECTION).update_one(
+        {'_id': job_id, 'status': 'running'}, {'$set': {'lease_until': now + lease}})
+    return result.matched_count > 0
+
+
+def release_job(job_id: ObjectId) -> None:
+    """Returns a job interrupted by a shutdown to the schedule, so that it's resumed right away."""
+    get_collection(JOBS_COLLECTION).update_one({'_id': job_id, 'status': 'running'},
+                                               {'$set': {'status': 'scheduled'}})
+
+
+def find_pending_deliveries(job_id: ObjectId, limit: int) -> List[Dict]:
+    return list(get_collection(DELIVERIES_COLLECTION).find(
+        {'job_id': job_id, 'status': 'pending'}).limit(limit))
+
+
+def record_deliveries(job_id: ObjectId,
+                      results: List[Tuple[str, Optional[int], Optional[str]]]) -> None:
+    """Saves the results of sending, as (delivery ID, message ID, error)."""
+    if not results:
+        return
+    get_collection(DELIVERIES_COLLECTION).bulk_write([
+        UpdateOne({'_id': _id}, {'$set': {'status': 'failed', 'error': error}
+                                 if error is not None else
+                                 {'status': 'sent', 'message_id': message_id}})
+        for _id, message_id, error in results], ordered=False)
+
+    failed = sum(error is not None for _, _, error in results)
+    get_collection(JOBS_COLLECTION).update_one(
+        {'_id': job_id}, {'$inc': {'sent_count': len(results) - failed, 'failed_count': failed}})
+
+
+def finish_job(job_id: ObjectId) -> None:
+    get_collection(JOBS_COLLECTION).update_one(
+        {'_id': job_id, 'status': 'running'},
+        {'$set': {'status': 'done', 'finished_at': datetime.datetime.utcnow()}})
+
+
+def cancel_query(job_id: ObjectId, user_id: ObjectId) -> Tuple[Dict, Dict]:
+    """Returns the filter and the update cancelling the author's job unless it's over."""
+    return ({'_id': ObjectId(job_id), 'author': ObjectId(user_id),
+             'status': {'$in': ['scheduled', 'running']}},
+            {'$set': {'status': 'cancelled', 'finished_at': datetime.datetime.utcnow()}})
+
+
+def cancel_job(job_id: ObjectId, user_id: ObjectId) -> bool:
+    return get_collection(JOBS_COLLECTION).update_one(
+        *cancel_query(job_id, user_id)).modified_count > 0
+
+
+def author_jobs_query(user_id: ObjectId) -> Dict:
+    return {'author': ObjectId(user_id)}
+
+
+def find_author_jobs(user_id: ObjectId, limit: int) -> List[Dict]:
+    return list(get_collection(JOBS_COLLECTION).find(author_jobs_query(user_id))
+                .sort('_id', DESCENDING).limit(limit))
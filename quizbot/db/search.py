@@ -0,0 +1,81 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import List, Optional, Set
+import os
+import re
+import threading
+
+from bson import ObjectId
+
+
+WORD_RE = re.compile(r'\w+')
+
+
+def get_words(text: Optional[str]) -> Set[str]:
+    return set(WORD_RE.findall(text.lower())) if text else set()
+
+
+class PostIndex:
+    """
+    In-memory prefix index of the words of posts' text, per author.
+
+    An author's posts are loaded on the first search (`add_author`, then `add`
+    for each post) and kept up to date by `create_post` from then on. Authors
+    not searched for longest are evicted once there are more than `max_authors`.
+    Posts created by another process are only found after the author is
+    evicted, so an author's updates should be handled by the same process.
+    """
+
+    def __init__(self, max_authors: int):
+        self.max_authors = max_authors
+        self._lock = threading.Lock()
+        # author -> sorted [(word, post ID)]
+        self._authors: OrderedDict = OrderedDict()
+
+    def is_loaded(self, author: ObjectId) -> bool:
+        with self._lock:
+            return author in self._authors
+
+    def add_author(self, author: ObjectId) -> None:
+        """Starts indexing the author's posts, which are then added with `add`."""
+        with self._lock:
+            self._authors.setdefault(author, [])
+            self._authors.move_to_end(author)
+            while len(self._authors) > self.max_authors:
+                self._authors.popitem(last=False)
+
+    def add(self, author: ObjectId, post_id: ObjectId, text: Optional[str]) -> None:
+        with self._lock:
+            entries = self._authors.get(author)
+            if entries is None:
+                return
+            for word in get_words(text):
+                entry = (word, post_id)
+                index = bisect_left(entries, entry)
+                if index == len(entries) or entries[index] != entry:
+                    entries.insert(index, entry)
+
+    def search(self, author: ObjectId, query: str) -> List[ObjectId]:
+        """Returns the author's posts with words starting with the query words, newest first."""
+        with self._lock:
+            entries = self._authors.get(author)
+            if entries is None:
+                return []
+            self._authors.move_to_end(author)
+
+            found: Optional[Set[ObjectId]] = None
+            for prefix in get_words(query):
+                matching = set()
+                for word, post_id in entries[bisect_left(entries, (prefix,)):]:
+                    if not word.startswith(prefix):
+                        break
+                    matching.add(post_id)
+                found = matching if found is None else found & matching
+
+        return sorted(found or (), reverse=True)
+
+    def __len__(self) -> int:
+        return len(self._authors)
+
+
+post_index = PostIndex(max_authors=int(os.environ.get('SEARCH_INDEX_AUTHORS', '10000')))
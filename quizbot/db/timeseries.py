@@ -0,0 +1,277 @@
+"""
+Clicks of posts over time, pre-aggregated in per-minute and per-hour buckets:
+
+post_clicks_by_minute = {
+    '_id': '<POST ID>:<YYYYMMDDHHMM>',
+    'post_id': <POST ID>,
+    'start': <DATETIME>,    # UTC
+    'clicks_count': <INT>,
+    'correct_clicks_count': <INT>,
+    # true once the bucket has been added to its hour bucket, false again once
+    # clicked after that
+    'rolled_up': <BOOL>,
+    # the counters as of the last roll-up
+    'rolled_up_clicks': <INT>,
+    'rolled_up_correct_clicks': <INT>
+}
+
+post_clicks_by_hour = {
+    '_id': '<POST ID>:<YYYYMMDDHH>',
+    'post_id': <POST ID>,
+    'start': <DATETIME>,    # UTC
+    'clicks_count': <INT>,
+    'correct_clicks_count': <INT>,
+    # minutes of the hour added to the bucket
+    'minutes': [<INT>],
+    # minute -> its clicks added to the bucket
+    'minute_clicks': {<MINUTE>: <INT>}
+}
+
+A click increments its minute bucket. `roll_up` adds minute buckets of finished
+hours to the hour buckets and deletes them after `MINUTE_BUCKETS_RETENTION_HOURS`,
+so the trend of a post is read from at most a few hundred small documents
+whatever the number of clicks. A minute bucket clicked after its roll-up, e.g.
+by a click which has waited in the write-behind buffer, is rolled up again
+with the clicks added since. Hour buckets are deleted after
+`HOUR_BUCKETS_RETENTION_DAYS`.
+"""
+
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+import atexit
+import datetime
+import logging
+import os
+import threading
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from quizbot.db import buffer
+from quizbot.db.mongo import get_collection
+
+
+LOGGER = logging.getLogger(__name__)
+
+MINUTES_COLLECTION = 'post_clicks_by_minute'
+HOURS_COLLECTION = 'post_clicks_by_hour'
+
+# Seconds between roll-ups, 0 disables them in this process
+ROLLUP_INTERVAL = float(os.environ.get('CLICK_ROLLUP_INTERVAL', '300'))
+# Minute buckets are kept for the last hour trend after being rolled up
+MINUTE_BUCKETS_RETENTION = datetime.timedelta(
+    hours=float(os.environ.get('MINUTE_BUCKETS_RETENTION_HOURS', '3')))
+HOUR_BUCKETS_RETENTION = datetime.timedelta(
+    days=float(os.environ.get('HOUR_BUCKETS_RETENTION_DAYS', '90')))
+# An hour is rolled up a while after it's over, so that clicks still waiting
+# in the write-behind buffer mostly reach its minute buckets first
+ROLLUP_DELAY = datetime.timedelta(minutes=5)
+ROLLUP_BATCH = 1000
+
+DUPLICATE_KEY_ERROR = 11000
+
+# the last hour trend is shown in slots of this many minutes
+TREND_SLOT_MINUTES = 5
+TREND_HOURS = 24
+
+
+class Trend(NamedTuple):
+    # clicks per `TREND_SLOT_MINUTES` over the last hour, oldest first
+    minutes: List[int]
+    # clicks per hour over the last `TREND_HOURS` hours, oldest first
+    hours: List[int]
+    # start of the last `TREND_HOURS` hours
+    first_hour: datetime.datetime
+
+
+def utcnow() -> datetime.datetime:
+    # naive UTC, as pymongo returns dates
+    return datetime.datetime.utcnow()
+
+
+def click_bucket_update(post_id: ObjectId, is_correct: bool,
+                        now: Optional[datetime.datetime] = None) -> Tuple[str, Dict, Dict]:
+    """Returns the ID, the `$inc` and the `$setOnInsert` updates of the minute bucket of a click."""
+    start = (now or utcnow()).replace(second=0, microsecond=0)
+    return (f'{post_id}:{start:%Y%m%d%H%M}',
+            {'clicks_count': 1, 'correct_clicks_count': int(is_correct)},
+            {'post_id': post_id, 'start': start})
+
+
+def buffer_click(post_id: ObjectId, is_correct: bool) -> None:
+    _id, inc, fields = click_bucket_update(post_id, is_correct)
+    buffer.click_buffer.inc(MINUTES_COLLECTION, _id, inc, upsert=True)
+    buffer.click_buffer.set(MINUTES_COLLECTION, _id, {**fields, 'rolled_up': False},
+                            upsert=True)
+
+
+def click_bucket_upsert(post_id: ObjectId, is_correct: bool) -> Tuple[Dict, Dict]:
+    """Returns the filter and the update of the minute bucket of a click, to be upserted."""
+    _id, inc, fields = click_bucket_update(post_id, is_correct)
+    # the bucket is rolled up again if it already was
+    return {'_id': _id}, {'$inc': inc, '$setOnInsert': fields, '$set': {'rolled_up': False}}
+
+
+def count_click(post_id: ObjectId, is_correct: bool) -> None:
+    if buffer.is_enabled():
+        return buffer_click(post_id, is_correct)
+
+    get_collection(MINUTES_COLLECTION).update_one(*click_bucket_upsert(post_id, is_correct),
+                                                  upsert=True)
+
+
+def get_first_hour(now: datetime.datetime) -> datetime.datetime:
+    return now.replace(minute=0, second=0, microsecond=0) - \
+        datetime.timedelta(hours=TREND_HOURS - 1)
+
+
+def trend_query(post_id: ObjectId, now: datetime.datetime) -> Dict:
+    """Query of the minute and hour buckets needed by `build_trend`."""
+    return {'post_id': ObjectId(post_id), 'start': {'$gte': get_first_hour(now)}}
+
+
+def add_to_slot(slots: List[int], index: int, clicks: int) -> None:
+    # buckets of other slots, e.g. started after `now` on a host with a clock ahead, are skipped
+    if 0 <= index < len(slots):
+        slots[index] += clicks
+
+
+def build_trend(minute_buckets: Iterable[Dict], hour_buckets: Iterable[Dict],
+                now: datetime.datetime) -> Trend:
+    first_hour = get_first_hour(now)
+    first_minute = now.replace(second=0, microsecond=0) - datetime.timedelta(minutes=59)
+
+    minutes = [0] * (60 // TREND_SLOT_MINUTES)
+    hours = [0] * TREND_HOURS
+    for bucket in minute_buckets:
+        clicks = bucket.get('clicks_count', 0)
+        if bucket['start'] >= first_minute:
+            elapsed = (bucket['start'] - first_minute).total_seconds() // 60
+            add_to_slot(minutes, int(elapsed) // TREND_SLOT_MINUTES, clicks)
+        if not bucket.get('rolled_up'):
+            # the ones rolled up before are already in the hour bucket
+            add_to_slot(hours, int((bucket['start'] - first_hour).total_seconds() // 3600),
+                        clicks - bucket.get('rolled_up_clicks', 0))
+    for bucket in hour_buckets:
+        add_to_slot(hours, int((bucket['start'] - first_hour).total_seconds() // 3600),
+                    bucket.get('clicks_count', 0))
+
+    return Trend(minutes=minutes, hours=hours, first_hour=first_hour)
+
+
+def get_trend(post_id: ObjectId, now: Optional[datetime.datetime] = None) -> Trend:
+    now = now or utcnow()
+    query = trend_query(post_id, now)
+    return build_trend(get_collection(MINUTES_COLLECTION).find(query),
+                       get_collection(HOURS_COLLECTION).find(query), now)
+
+
+def find_recently_clicked_posts(since: datetime.datetime, limit: int) -> List[ObjectId]:
+    """Returns up to `limit` posts clicked since `since`, the most recently clicked first."""
+    return [bucket['_id'] for bucket in get_collection(MINUTES_COLLECTION).aggregate([
+        # matching every value of `rolled_up` lets the roll-up index serve it
+        {'$match': {'rolled_up': {'$in': [True, False, None]}, 'start': {'$gte': since}}},
+        {'$group': {'_id': '$post_id', 'last_click': {'$max': '$start'}}},
+        {'$sort': {'last_click': -1}},
+        {'$limit': limit}
+    ])]
+
+
+def hour_bucket_update(bucket: Dict) -> UpdateOne:
+    """Adds the clicks of the minute bucket since its last roll-up to the hour bucket."""
+    hour = bucket['start'].replace(minute=0)
+    minute = bucket['start'].minute
+    clicks = bucket.get('clicks_count', 0)
+    query = {'_id': f"{bucket['post_id']}:{hour:%Y%m%d%H}"}
+    # a minute already added as of these clicks doesn't match, so the upsert
+    # fails with a duplicate key
+    if 'rolled_up_clicks' in bucket:
+        query[f'minute_clicks.{minute}'] = bucket['rolled_up_clicks']
+    else:
+        query['minutes'] = {'$ne': minute}
+    return UpdateOne(
+        query,
+        {'$inc': {'clicks_count': clicks - bucket.get('rolled_up_clicks', 0),
+                  'correct_clicks_count': bucket.get('correct_clicks_count', 0) -
+                  bucket.get('rolled_up_correct_clicks', 0)},
+         '$addToSet': {'minutes': minute},
+         '$set': {f'minute_clicks.{minute}': clicks},
+         '$setOnInsert': {'post_id': bucket['post_id'], 'start': hour}},
+        upsert=True)
+
+
+def rolled_up_update(bucket: Dict) -> UpdateOne:
+    # a bucket clicked since it was read stays to be rolled up again
+    return UpdateOne(
+        {'_id': bucket['_id'], 'clicks_count': bucket.get('clicks_count')},
+        {'$set': {'rolled_up': True,
+                  'rolled_up_clicks': bucket.get('clicks_count', 0),
+                  'rolled_up_correct_clicks': bucket.get('correct_clicks_count', 0)}})
+
+
+def roll_up(now: Optional[datetime.datetime] = None) -> int:
+    """
+    Adds minute buckets of finished hours, or their clicks since the last
+    roll-up, to the hour buckets and deletes the expired buckets, returns the
+    number of minute buckets added. Safe to run in several processes at once
+    or to rerun after a failure.
+    """
+    now = now or utcnow()
+    before = (now - ROLLUP_DELAY).replace(minute=0, second=0, microsecond=0)
+    minutes = get_collection(MINUTES_COLLECTION)
+
+    rolled_up = 0
+    while True:
+        buckets = list(minutes.find({'start': {'$lt': before}, 'rolled_up': {'$ne': True}})
+                       .limit(ROLLUP_BATCH))
+        if not buckets:
+            break
+
+        try:
+            get_collection(HOURS_COLLECTION).bulk_write(
+                [hour_bucket_update(bucket) for bucket in buckets], ordered=False)
+        except BulkWriteError as error:
+            if any(write_error['code'] != DUPLICATE_KEY_ERROR
+                   for write_error in error.details['writeErrors']):
+                raise
+        minutes.bulk_write([rolled_up_update(bucket) for bucket in buckets], ordered=False)
+        rolled_up += len(buckets)
+
+    expired = minutes.delete_many({'start': {'$lt': now - MINUTE_BUCKETS_RETENTION},
+                                   'rolled_up': True}).deleted_count
+    expired_hours = get_collection(HOURS_COLLECTION).delete_many(
+        {'start': {'$lt': now - HOUR_BUCKETS_RETENTION}}).deleted_count
+    LOGGER.info(f"Rolled up {rolled_up} minute click buckets, deleted {expired} expired "
+                f"and {expired_hours} expired hour buckets")
+    return rolled_up
+
+
+class RollUpJob:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                roll_up()
+            except Exception:
+                LOGGER.exception("Failed to roll up click buckets, retrying later")
+
+    def start(self) -> None:
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name='click-roll-up', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+
+roll_up_job = RollUpJob(interval=ROLLUP_INTERVAL)
@@ -1,16 +1,19 @@
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 from telegram import ReplyKeyboardMarkup, KeyboardButton
 from telegram import ReplyKeyboardRemove, ForceReply
-from telegram import InputTextMessageContent
-from telegram import InlineQueryResultArticle, InlineQueryResultCachedPhoto
-from telegram import Update, ParseMode
+from telegram import Document, InlineQuery, Message, Update, ParseMode
 from telegram.ext import CallbackContext
+from bson import ObjectId
+from typing import Dict, List, Optional
+import datetime
 
+import quizbot.handlers.importer as importer
+import quizbot.publisher as publisher
 import quizbot.handlers.post as postutils
 import quizbot.db as db
 import quizbot.db.models
 
-from quizbot.handlers.inline import INLINE_STATS
+from quizbot.db.publish_jobs import ChatId
 from quizbot.handlers.state import State
 
 
@@ -31,7 +34,7 @@ def start_post_creation(update: Update, context: CallbackContext) -> str:
     context.user_data['buttons'] = dict()
 
     if update.message.photo:
-        context.user_data['photo'] = update.message.photo[-1]
+        context.user_data['photo'] = update.message.photo[-1].file_id
     else:
         text = update.message.text
         if not postutils.is_main_text_valid(text):
@@ -116,66 +119,85 @@ def finish_post_creation(update: Update, context: CallbackContext) -> str:
 
     user_id = db.models.find_or_create_user(update.effective_user.id)
     post_id = db.models.create_post(text=context.user_data['text'],
-                                    photo=photo.file_id if photo else None,
+                                    photo=photo,
                                     buttons=buttons,
                                     user_id=user_id)
     post = db.models.find_post(post_id)
 
     LOGGER.info(f"Generated post: {post}")
+    reply_with_created_post(update.message, post)
 
-    keyboard = postutils.get_post_keyboard(buttons=buttons, post_id=post_id)
+    return State.WAITING_POST
+
+
+def reply_with_created_post(message: Message, post: Dict) -> None:
+    """Sends the new post to its author, with the buttons to publish it and see its statistics."""
+    post_id = post['_id']
+    keyboard = postutils.get_post_keyboard(buttons=post['buttons'], post_id=post_id)
     keyboard.append([InlineKeyboardButton('Publish to channel',
                                           switch_inline_query=f'#{post_id}')])
     keyboard.append([InlineKeyboardButton('Post statistics',
-                                          callback_data=f'{post_id}|{INLINE_STATS}')])
+                                          callback_data=postutils.encode_callback_data(
+                                              post_id, postutils.STATS_BUTTON))])
     markup = InlineKeyboardMarkup(keyboard)
 
     if postutils.post_type(post) == 'text':
-        update.message.reply_text(post['text'], reply_markup=markup)
+        message.reply_text(post['text'], reply_markup=markup)
     elif postutils.post_type(post) == 'photo':
-        update.message.reply_photo(photo, reply_markup=markup)
-
-    return State.WAITING_POST
+        message.reply_photo(post['photo'], reply_markup=markup)
 
 
 def inline_find_post(update: Update, context: CallbackContext) -> None:
-    query = update.inline_query.query
+    inline_query = update.inline_query
+    query = inline_query.query.strip()
 
-    if not query.startswith('#'):
-        update.inline_query.answer([], switch_pm_text='Create new quiz post',
-                                   switch_pm_parameter='_')
-        return
+    if query.startswith('#'):
+        return inline_publish_post(inline_query, query[1:])
 
-    post_id = query[1:]
-    LOGGER.info(f"Inline query with id {post_id}")
+    # the author's own posts: the recent ones, or the ones matching the query
+    user_id = db.models.find_user_id(inline_query.from_user.id)
+    posts, next_offset = [], ''
+    if user_id is not None and not query:
+        posts = db.models.find_author_posts(user_id, before=get_offset_post(inline_query),
+                                            limit=postutils.MAX_INLINE_RESULTS)
+        next_offset = get_next_offset(posts)
+    elif user_id is not None:
+        post_ids = db.models.search_author_posts(user_id, query)
+        post_ids, next_offset = postutils.get_page(post_ids, inline_query.offset)
+        posts = db.models.find_posts_content(post_ids)
 
-    try:
-        post = db.models.find_post(post_id)
-    except:
-        LOGGER.error(f"Error looking for ID {post_id} in inline query")
-        return
+    answer_author_posts(inline_query, posts, next_offset)
 
-    content = postutils.get_content_description(post)
-    markup = InlineKeyboardMarkup(postutils.get_post_keyboard(post['buttons'], post_id))
 
-    result = None
-    if postutils.post_type(post) == 'text':
-        result = InlineQueryResultArticle(
-            id=post_id,
-            title="New post",
-            description=f"Create new post with {content}",
-            input_message_content=InputTextMessageContent(post['text']),
-            reply_markup=markup)
+def get_offset_post(inline_query: InlineQuery) -> Optional[ObjectId]:
+    """Returns the last post of the previous page of the author's recent posts."""
+    return ObjectId(inline_query.offset) if ObjectId.is_valid(inline_query.offset) else None
+
+
+def get_next_offset(posts: List[Dict]) -> str:
+    return str(posts[-1]['_id']) if len(posts) == postutils.MAX_INLINE_RESULTS else ''
+
+
+def answer_author_posts(inline_query: InlineQuery, posts: List[Dict], next_offset: str) -> None:
+    inline_query.answer([postutils.get_inline_result(post) for post in posts],
+                        cache_time=postutils.INLINE_LIST_CACHE_TIME, is_personal=True,
+                        next_offset=next_offset, switch_pm_text='Create new quiz post',
+                        switch_pm_parameter='_')
 
-    elif postutils.post_type(post) == 'photo':
-        result = InlineQueryResultCachedPhoto(
-            id=post_id,
-            photo_file_id=post['photo'],
-            title="New post",
-            description=f"Create new post with {content}",
-            reply_markup=markup)
 
-    update.inline_query.answer([result])
+def inline_publish_post(inline_query: InlineQuery, post_id: str) -> None:
+    LOGGER.info(f"Inline query with id {post_id}")
+
+    result = postutils.inline_result_cache.get(post_id)
+    if result is None:
+        try:
+            post = db.models.find_post(post_id)
+        except:
+            LOGGER.error(f"Error looking for ID {post_id} in inline query")
+            return
+        result = postutils.get_inline_result(post)
+
+    inline_query.answer([result], cache_time=postutils.INLINE_POST_CACHE_TIME)
 
 
 def cancel_post_creation(update: Update, context: CallbackContext) -> str:
@@ -184,15 +206,51 @@ def cancel_post_creation(update: Update, context: CallbackContext) -> str:
     return State.WAITING_POST
 
 
+def import_quizzes(update: Update, context: CallbackContext) -> None:
+    document = update.message.document
+    error = check_import_document(document)
+    if error is not None:
+        update.message.reply_text(error)
+        return
+
+    data = bytes(context.bot.get_file(document.file_id).download_as_bytearray())
+    try:
+        quizzes = importer.load_quizzes(document.file_name, data)
+    except importer.QuizImportError as error:
+        update.message.reply_text(f"Nothing imported:\n{error.describe()}")
+        return
+
+    user_id = db.models.find_or_create_user(update.effective_user.id)
+    post_ids = db.models.create_posts(importer.to_posts(quizzes), user_id)
+    LOGGER.info(f"Imported {len(post_ids)} posts of user {user_id}")
+
+    for message in importer.make_publish_messages(quizzes, post_ids):
+        update.message.reply_text(**message)
+
+
+def check_import_document(document: Document) -> Optional[str]:
+    """Returns why the sent document can't be imported, if it can't."""
+    if not importer.is_supported(document.file_name):
+        return "Send me a .csv or .json file with quizzes to import them"
+    if document.file_size and document.file_size > importer.MAX_FILE_SIZE:
+        return "The file is too big to import"
+    return None
+
+
 def show_stats(update: Update, context: CallbackContext) -> None:
+    if context.args:
+        return show_post_stats(update, context.args[0])
+
     user_id = db.models.find_or_create_user(update.effective_user.id)
-    posts_count = db.models.total_user_posts(user_id)
+    reply_with_user_stats(update.message, *db.models.get_user_stats(user_id))
+
 
+def reply_with_user_stats(message: Message, posts_count: int, clicks_count: int,
+                          correct_clicks_count: int) -> None:
     if posts_count == 0:
-        update.message.reply_text("You have no posts yet!")
+        message.reply_text("You have no posts yet!")
         return
 
-    clicks_count, correct_clicks_count = db.models.count_user_posts_clicks(user_id)
     average_clicks_per_post = float(clicks_count) / posts_count
 
     if clicks_count == 0:
@@ -200,8 +258,84 @@ def show_stats(update: Update, context: CallbackContext) -> None:
     else:
         average_correct_percentage = float(correct_clicks_count) / clicks_count
 
-    update.message.reply_text(f"Statistics of your posts:\n"
-                              f"  - *Total number*: {posts_count}\n"
-                              f"  - *Average users answers per post*: {average_clicks_per_post}\n"
-                              f"  - *Average correct answers*: {average_correct_percentage:.0%}",
+    message.reply_text(f"Statistics of your posts:\n"
+                       f"  - *Total number*: {posts_count}\n"
+                       f"  - *Average users answers per post*: {average_clicks_per_post}\n"
+                       f"  - *Average correct answers*: {average_correct_percentage:.0%}",
+                       parse_mode=ParseMode.MARKDOWN)
+
+
+def show_post_stats(update: Update, post_id: str) -> None:
+    """Shows the trend of a post to its author."""
+    user_id = db.models.find_or_create_user(update.effective_user.id)
+    try:
+        post = db.models.find_post(post_id) if ObjectId.is_valid(post_id) else None
+    except ValueError:
+        post = None
+
+    if post is None or post['author'] != user_id:
+        update.message.reply_text(f"You have no post with ID {post_id}")
+        return
+
+    trend = db.models.get_post_trend(post['_id'])
+    update.message.reply_text(postutils.make_trend_text(post, trend),
                               parse_mode=ParseMode.MARKDOWN)
+
+
+def publish_post(update: Update, context: CallbackContext) -> None:
+    """Schedules sending the author's post to the given chats, see `quizbot.publisher`."""
+    try:
+        post_id, send_at, chat_ids = publisher.parse_publish_args(context.args)
+    except ValueError as error:
+        update.message.reply_text(str(error))
+        return
+
+    user_id = db.models.find_or_create_user(update.effective_user.id)
+    try:
+        post = db.models.find_post(post_id)
+    except ValueError:
+        post = None
+    if post is None or post['author'] != user_id:
+        update.message.reply_text(f"You have no post with ID {post_id}")
+        return
+
+    forbidden = publisher.find_forbidden_chats(chat_ids, update.effective_user.id,
+                                               publisher.bot_call(context.bot))
+    if forbidden:
+        update.message.reply_text(publisher.make_forbidden_text(forbidden))
+        return
+
+    job_id = db.models.create_publish_job(post['_id'], user_id, chat_ids, send_at)
+    reply_with_created_job(update.message, job_id, post_id, chat_ids, send_at)
+
+
+def reply_with_created_job(message: Message, job_id: ObjectId, post_id: str,
+                           chat_ids: List[ChatId], send_at: datetime.datetime) -> None:
+    LOGGER.info(f"Publish job {job_id} of post {post_id} to {len(chat_ids)} chats created")
+    message.reply_text(f"Post `{post_id}` will be sent to {len(chat_ids)} chats "
+                       f"at {send_at:%Y-%m-%d %H:%M} UTC, job `{job_id}`. "
+                       f"See /jobs for the progress.",
+                       parse_mode=ParseMode.MARKDOWN)
+
+
+def show_publish_jobs(update: Update, context: CallbackContext) -> None:
+    user_id = db.models.find_or_create_user(update.effective_user.id)
+    jobs = db.models.find_publish_jobs(user_id, publisher.JOBS_LISTED)
+    update.message.reply_text(publisher.make_jobs_text(jobs), parse_mode=ParseMode.MARKDOWN)
+
+
+def cancel_publish_job(update: Update, context: CallbackContext) -> None:
+    if not context.args or not ObjectId.is_valid(context.args[0]):
+        update.message.reply_text("Usage: /canceljob <job id>")
+        return
+
+    user_id = db.models.find_or_create_user(update.effective_user.id)
+    reply_with_cancelled_job(update.message, context.args[0],
+                             db.models.cancel_publish_job(context.args[0], user_id))
+
+
+def reply_with_cancelled_job(message: Message, job_id: str, is_cancelled: bool) -> None:
+    if is_cancelled:
+        message.reply_text("The job is cancelled, messages already sent are kept")
+    else:
+        message.reply_text(f"You have no scheduled or running job {job_id}")
@@ -12,36 +12,62 @@ from quizbot.handlers.admin import (
     add_button_text,
     display_keyboard_to_choose_correct_answer,
     inline_find_post,
+    import_quizzes,
+    publish_post,
+    show_publish_jobs,
+    cancel_publish_job,
     show_stats
 )
 
 from quizbot.handlers.inline import process_inline_button_click
 from quizbot.handlers.state import State
+from quizbot.ingress import async_handlers
+from quizbot.metrics import timed_handler as timed
+from quizbot.outbound import without_waiting
 
 import logging
 
 LOGGER = logging.getLogger(__name__)
 
+
+def step(handler):
+    # the conversation runs in the dispatcher thread, so its replies are queued
+    # rather than waited for, see `quizbot.outbound`
+    return without_waiting(timed(handler))
+
+
 conv_handler = ConversationHandler(
     name='post_creating_handler',
-    entry_points=[CommandHandler('start', start)],
+    entry_points=[CommandHandler('start', step(start))],
     states={
-        State.WAITING_POST: [MessageHandler(Filters.text | Filters.photo, start_post_creation)],
-        State.EDITING_POST: [CommandHandler('addbutton', start_button_creation),
-                             CommandHandler('finish', display_keyboard_to_choose_correct_answer)],
-        State.WAITING_BUTTON_TEXT: [MessageHandler(Filters.text, add_button_text)],
-        State.WAITING_BUTTON_ALERT_TEXT: [MessageHandler(Filters.text, add_button_alert_text)],
-        State.WAITING_CORRECT_ANSWER: [MessageHandler(Filters.text, finish_post_creation)]
+        State.WAITING_POST: [MessageHandler(Filters.text | Filters.photo,
+                                            step(start_post_creation))],
+        State.EDITING_POST: [CommandHandler('addbutton', step(start_button_creation)),
+                             CommandHandler('finish',
+                                            step(display_keyboard_to_choose_correct_answer))],
+        State.WAITING_BUTTON_TEXT: [MessageHandler(Filters.text, step(add_button_text))],
+        State.WAITING_BUTTON_ALERT_TEXT: [MessageHandler(Filters.text,
+                                                         step(add_button_alert_text))],
+        State.WAITING_CORRECT_ANSWER: [MessageHandler(Filters.text, step(finish_post_creation))]
     },
     persistent=True,
-    fallbacks=[CommandHandler('cancel', cancel_post_creation),
-               CommandHandler('start', start)]
+    fallbacks=[CommandHandler('cancel', step(cancel_post_creation)),
+               CommandHandler('start', step(start))]
 )
 
 
+# Stateless handlers run in the dispatcher worker pool, so that slow database
+# calls for one update don't delay the others. The conversation handler keeps
+# running in the dispatcher thread to process each user's messages in order.
+run_async = async_handlers.run_async
+
 handlers = [
-    CommandHandler('stats', show_stats),
-    CallbackQueryHandler(process_inline_button_click),
-    InlineQueryHandler(inline_find_post),
+    CommandHandler('stats', run_async(timed(show_stats))),
+    CommandHandler('publish', run_async(timed(publish_post))),
+    CommandHandler('jobs', run_async(timed(show_publish_jobs))),
+    CommandHandler('canceljob', run_async(timed(cancel_publish_job))),
+    MessageHandler(Filters.document, run_async(timed(import_quizzes))),
+    CallbackQueryHandler(run_async(timed(process_inline_button_click))),
+    InlineQueryHandler(run_async(timed(inline_find_post))),
     conv_handler
 ]
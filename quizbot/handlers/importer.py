@@ -0,0 +1,160 @@
+"""
+Bulk import of quizzes prepared in spreadsheets, from a CSV or JSON document
+sent to the bot or given to `python -m quizbot.manage import-quizzes`.
+
+CSV files have a header row and a quiz per row:
+
+    text,correct,button_1,alert_1,button_2,alert_2,...
+
+where `correct` is the number of the correct button. JSON files have a list of quizzes:
+
+    [{"text": <TEXT>,
+      "buttons": [{"text": <TEXT>, "alert_text": <TEXT>, "is_correct": <BOOL>}]}]
+
+All the quizzes of a file are validated as in the post creation conversation
+before any of them is created.
+"""
+
+from typing import Dict, List, Optional
+import csv
+import io
+import json
+import os
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import quizbot.handlers.post as postutils
+
+
+EXTENSIONS = ('.csv', '.json')
+MAX_QUIZZES = int(os.environ.get('IMPORT_MAX_QUIZZES', '1000'))
+MAX_FILE_SIZE = 5 * 1024 * 1024
+# Telegram allows up to 100 buttons in a keyboard
+MAX_BUTTONS = 100
+# errors reported to the user, the rest are only counted
+MAX_REPORTED_ERRORS = 20
+# quizzes listed with publish buttons in a message
+QUIZZES_PER_MESSAGE = 50
+
+
+class QuizImportError(ValueError):
+    def __init__(self, errors: List[str]):
+        super().__init__('\n'.join(errors))
+        self.errors = errors
+
+    def describe(self) -> str:
+        text = '\n'.join(self.errors[:MAX_REPORTED_ERRORS])
+        if len(self.errors) > MAX_REPORTED_ERRORS:
+            text += f"\n... and {len(self.errors) - MAX_REPORTED_ERRORS} more errors"
+        return text
+
+
+def is_supported(filename: Optional[str]) -> bool:
+    return (filename or '').lower().endswith(EXTENSIONS)
+
+
+def parse_csv(text: str) -> List[Dict]:
+    quizzes = []
+    for row in csv.DictReader(io.StringIO(text)):
+        correct = (row.get('correct') or '').strip()
+        buttons = []
+        for number in range(1, MAX_BUTTONS + 1):
+            button_text = (row.get(f'button_{number}') or '').strip()
+            if not button_text:
+                break
+            buttons.append({'text': button_text,
+                            'alert_text': (row.get(f'alert_{number}') or '').strip(),
+                            'is_correct': correct == str(number)})
+        quizzes.append({'text': (row.get('text') or '').strip(), 'buttons': buttons})
+    return quizzes
+
+
+def parse_json(text: str) -> List[Dict]:
+    quizzes = json.loads(text)
+    if not isinstance(quizzes, list) or not all(isinstance(quiz, dict) for quiz in quizzes):
+        raise ValueError("a list of quizzes expected")
+    return [{'text': str(quiz.get('text') or '').strip(),
+             'buttons': [{'text': str(button.get('text') or '').strip(),
+                          'alert_text': str(button.get('alert_text') or '').strip(),
+                          'is_correct': bool(button.get('is_correct'))}
+                         for button in quiz.get('buttons') or [] if isinstance(button, dict)]}
+            for quiz in quizzes]
+
+
+def validate(quiz: Dict) -> List[str]:
+    errors = []
+    if not quiz['text']:
+        errors.append("no text")
+    elif not postutils.is_main_text_valid(quiz['text']):
+        errors.append(f"the length of text ({len(quiz['text'])}) exceeds the Telegram API limit")
+
+    buttons = quiz['buttons']
+    if not buttons:
+        errors.append("no buttons")
+    if len(buttons) > MAX_BUTTONS:
+        errors.append(f"more than {MAX_BUTTONS} buttons")
+    if len({button['text'] for button in buttons}) < len(buttons):
+        errors.append("buttons with the same text")
+    if buttons and sum(button['is_correct'] for button in buttons) != 1:
+        errors.append("not exactly one correct button")
+    for button in buttons:
+        is_alert_text_valid, example = postutils.is_alert_text_valid(button['alert_text'])
+        if not is_alert_text_valid:
+            errors.append(f"the length of alert message of button {button['text']} "
+                          f"({len(example)}) exceeds the Telegram API limit")
+    return errors
+
+
+def load_quizzes(filename: str, data: bytes) -> List[Dict]:
+    """Returns the quizzes of the file, raises `QuizImportError` if any of them is invalid."""
+    try:
+        # spreadsheet apps often save UTF-8 with a byte order mark
+        text = data.decode('utf-8-sig')
+        quizzes = parse_json(text) if filename.lower().endswith('.json') else parse_csv(text)
+    except (UnicodeDecodeError, ValueError, csv.Error) as error:
+        raise QuizImportError([f"Can't read {filename}: {error}"])
+
+    if not quizzes:
+        raise QuizImportError([f"No quizzes in {filename}"])
+    if len(quizzes) > MAX_QUIZZES:
+        raise QuizImportError([f"{len(quizzes)} quizzes in {filename}, "
+                               f"up to {MAX_QUIZZES} can be imported at once"])
+
+    errors = [f"Quiz {number}: {error}"
+              for number, quiz in enumerate(quizzes, 1) for error in validate(quiz)]
+    if errors:
+        raise QuizImportError(errors)
+    return quizzes
+
+
+def to_posts(quizzes: List[Dict]) -> List[Dict]:
+    """Converts the quizzes to `quizbot.db.models.create_posts` arguments."""
+    return [{'text': quiz['text'],
+             'photo': None,
+             'buttons': {button['text']: {'alert_text': button['alert_text'],
+                                          'clicks_count': 0,
+                                          'correct_clicks_count': 0,
+                                          'is_correct': button['is_correct']}
+                         for button in quiz['buttons']}}
+            for quiz in quizzes]
+
+
+def get_excerpt(text: str, length: int = 40) -> str:
+    text = ' '.join(text.split())
+    return text if len(text) <= length else text[:length - 1] + '…'
+
+
+def make_publish_messages(quizzes: List[Dict], post_ids: List) -> List[Dict]:
+    """Returns `reply_text` arguments listing the created posts with a publish button each."""
+    messages = []
+    for start in range(0, len(quizzes), QUIZZES_PER_MESSAGE):
+        keyboard = [[InlineKeyboardButton(f"{number}. {get_excerpt(quiz['text'])}",
+                                          switch_inline_query=f'#{post_id}')]
+                    for number, quiz, post_id in zip(range(start + 1, len(quizzes) + 1),
+                                                     quizzes[start:start + QUIZZES_PER_MESSAGE],
+                                                     post_ids[start:start + QUIZZES_PER_MESSAGE])]
+        end = start + len(keyboard)
+        messages.append({'text': f"Quizzes {start + 1}-{end} of {len(quizzes)}, "
+                                 f"press a quiz to publish it:",
+                         'reply_markup': InlineKeyboardMarkup(keyboard)})
+    return messages
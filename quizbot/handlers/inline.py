@@ -1,3 +1,5 @@
+from typing import Dict, Union
+
 from telegram import Update, CallbackQuery
 from telegram.ext import CallbackContext
 from bson import ObjectId
@@ -5,21 +7,25 @@ from bson import ObjectId
 
 import quizbot.db.models
 import quizbot.db as db
+from quizbot.db.models import ClickResult
 import quizbot.handlers.post as postutils
+from quizbot.ingress import ingress
 
 import logging
 
 LOGGER = logging.getLogger(__name__)
-INLINE_STATS = '__view_stats__'
 
 
 def process_inline_button_click(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
-    post_id, data = query.data.split('|')
-    if data == INLINE_STATS:
-        return show_post_statistics(query, ObjectId(post_id))
-    else:
-        return process_quiz_button_click(update, ObjectId(post_id), data)
+    try:
+        post_id, button = postutils.decode_callback_data(query.data)
+        if button == postutils.STATS_BUTTON:
+            return show_post_statistics(query, post_id)
+        else:
+            return process_quiz_button_click(update, post_id, button)
+    finally:
+        ingress.release(query)
 
 
 def show_post_statistics(query: CallbackQuery, post_id: ObjectId) -> None:
@@ -27,56 +33,47 @@ def show_post_statistics(query: CallbackQuery, post_id: ObjectId) -> None:
         post = db.models.find_post(post_id)
     except:
         LOGGER.error(f"Could not find post {post_id} on statistics button click")
-        query.answer(text="Post has not been found. "
-                          "Approach the developer.", show_alert=False)
+        ingress.answer(query, text="Post has not been found. "
+                                   "Approach the developer.", show_alert=False)
         return
 
+    ingress.answer(query, **make_statistics_answer(query, post))
+
+
+def make_statistics_answer(query: CallbackQuery, post: Dict) -> Dict:
+    """Returns the parameters of the answer to a post statistics button click."""
     clicks_count, correct_clicks_count = db.models.count_post_clicks(post)
-    query.answer(text=f"Правильных ответов: {correct_clicks_count} / {clicks_count}",
-                 show_alert=True)
+    return dict(text=f"Правильных ответов: {correct_clicks_count} / {clicks_count}",
+                show_alert=True, merge_key=f'{query.from_user.id}|{query.data}')
 
 
-def process_quiz_button_click(update: Update, post_id: ObjectId, button_text: str) -> None:
+def process_quiz_button_click(update: Update, post_id: ObjectId, button: Union[int, str]) -> None:
     query = update.callback_query
 
     try:
-        post = db.models.find_post(post_id)
-    except:
+        click = db.models.record_click(post_id=post_id,
+                                       telegram_id=update.effective_user.id,
+                                       button=button)
+    except ValueError:
         LOGGER.error(f"Could not find post {post_id} on quiz button click")
-        query.answer(text="Пост не найден в базе данных. "
-                          "Обратитесь к разработчику.", show_alert=False)
+        ingress.answer(query, text="Пост не найден в базе данных. "
+                                   "Обратитесь к разработчику.", show_alert=False)
         return
 
-    LOGGER.info(f"Button `{button_text}` clicked for post: {post}")
-
-    user_id = db.models.find_or_create_user(update.effective_user.id)
-
-    do_update = True
-    clicked, answer = db.models.is_post_clicked_by_user(post_id=post_id, user_id=user_id)
-
-    if clicked:
-        if answer != button_text:
-            query.answer(text="Ответ нельзя изменить!", show_alert=False)
-            return
-        else:
-            do_update = False
-
-    is_correct = post['buttons'][button_text]['is_correct']
-    count = post['buttons'][button_text]['clicks_count']
-    total_count = post['clicks_count']
+    LOGGER.debug(f"Button `{click.button_text}` clicked for post {post_id}")
+    ingress.answer(query, **make_click_answer(query, click))
 
-    if do_update:
-        db.models.update_stats_on_click(user_id=user_id, post_id=post_id,
-                                        user_answer=button_text, is_correct=is_correct)
-    else:
-        # do not include this user's click into statistics
-        count -= 1
-        total_count -= 1
 
-    alert_text = postutils.make_alert_text(initial_text=post['buttons'][button_text]['alert_text'],
-                                           count=count,
-                                           total_count=total_count,
-                                           is_correct=is_correct)
+def make_click_answer(query: CallbackQuery, click: ClickResult) -> Dict:
+    """Returns the parameters of the answer to a quiz button click."""
+    # repeated taps on the button get a single answer if it's still queued
+    merge_key = f'{query.from_user.id}|{query.data}'
+    if click.answer != click.button_text:
+        return dict(text="Ответ нельзя изменить!", show_alert=False, merge_key=merge_key)
 
-    query.answer(text=alert_text, show_alert=True)
+    alert_text = postutils.make_alert_text(initial_text=click.initial_text,
+                                           count=click.count,
+                                           total_count=click.total_count,
+                                           is_correct=click.is_correct)
 
+    return dict(text=alert_text, show_alert=True, merge_key=merge_key)
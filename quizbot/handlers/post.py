@@ -1,16 +1,78 @@
-from typing import Dict, List, Tuple, Optional
-from telegram import InlineKeyboardButton
+from typing import Dict, List, Tuple, Optional, Union
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputTextMessageContent
+from telegram import InlineQueryResult, InlineQueryResultArticle, InlineQueryResultCachedPhoto
+from bson import ObjectId
+from bson.errors import InvalidId
+import base64
+import binascii
+import datetime
+import math
+import os
+
+from quizbot.db import buttons as post_buttons
+from quizbot.db.cache import TTLCache
+from quizbot.db.timeseries import TREND_SLOT_MINUTES, Trend
 
 MAX_TELEGRAM_API_POST_TEXT_LENGTH = 4096
 MAX_TELEGRAM_API_ALERT_TEXT_LENGTH = 200
+MAX_TELEGRAM_API_ROW_BUTTONS = 8
+
+SPARKLINE_BARS = '▁▂▃▄▅▆▇█'
+
+# button index in the callback data of the post statistics button
+STATS_BUTTON = 0xFF
+# button text in the legacy callback data of the post statistics button
+LEGACY_STATS_BUTTON = '__view_stats__'
+
+# inline query results per page, Telegram allows up to 50
+MAX_INLINE_RESULTS = 20
+# Seconds Telegram may serve an answer to the same inline query from its cache:
+# `#<post_id>` always gives the same post, while the list of the author's posts
+# changes once they create a new one
+INLINE_POST_CACHE_TIME = int(os.environ.get('INLINE_POST_CACHE_TIME', '3600'))
+INLINE_LIST_CACHE_TIME = int(os.environ.get('INLINE_LIST_CACHE_TIME', '10'))
+
+# post ID -> inline query result; posts aren't edited by the bot, but may be
+# by `quizbot.manage` commands, e.g. `migrate-buttons` changes the callback data
+inline_result_cache = TTLCache(max_size=int(os.environ.get('INLINE_RESULT_CACHE_SIZE', '10000')),
+                               ttl=float(os.environ.get('INLINE_RESULT_CACHE_TTL', '3600')))
+
+
+def encode_callback_data(post_id: ObjectId, button: int) -> str:
+    """Encodes the post ID and the button index as 18 characters of URL-safe base64."""
+    data = ObjectId(post_id).binary + bytes([button])
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_callback_data(data: str) -> Tuple[ObjectId, Union[int, str]]:
+    """
+    Returns the post ID and the button index, or the button text if the data has
+    the `<post_id>|<text>` format of the messages posted by earlier versions.
+    """
+    try:
+        if '|' in data:
+            post_id, text = data.split('|', 1)
+            return ObjectId(post_id), STATS_BUTTON if text == LEGACY_STATS_BUTTON else text
+
+        decoded = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+        if len(decoded) != 13:
+            raise ValueError(f"{len(decoded)} bytes")
+        return ObjectId(decoded[:12]), decoded[12]
+    except (ValueError, binascii.Error, InvalidId) as error:
+        raise ValueError(f"Invalid callback data `{data}`: {error}")
 
 
 def get_post_keyboard(buttons, post_id) -> List[List[InlineKeyboardButton]]:
     if not buttons:
         return []
 
-    return [[InlineKeyboardButton(text, callback_data=f"{post_id}|{text}")
-            for text in buttons]]
+    keyboard = [InlineKeyboardButton(button['text'],
+                                     callback_data=encode_callback_data(post_id, index))
+                for index, button in enumerate(post_buttons.as_array(buttons))]
+    # the fewest rows Telegram allows, of about the same length: 9 buttons are 5 and 4
+    rows = math.ceil(len(keyboard) / MAX_TELEGRAM_API_ROW_BUTTONS)
+    per_row = math.ceil(len(keyboard) / rows)
+    return [keyboard[start:start + per_row] for start in range(0, len(keyboard), per_row)]
 
 
 def post_type(post: Dict) -> str:
@@ -34,6 +96,68 @@ def get_content_description(post: Dict) -> str:
     return content
 
 
+def make_inline_result(post: Dict) -> InlineQueryResult:
+    post_id = str(post['_id'])
+    content = get_content_description(post)
+    markup = InlineKeyboardMarkup(get_post_keyboard(post['buttons'], post_id))
+
+    if post_type(post) == 'text':
+        return InlineQueryResultArticle(
+            id=post_id,
+            title="New post",
+            description=f"Create new post with {content}",
+            input_message_content=InputTextMessageContent(post['text']),
+            reply_markup=markup)
+
+    return InlineQueryResultCachedPhoto(
+        id=post_id,
+        photo_file_id=post['photo'],
+        title="New post",
+        description=f"Create new post with {content}",
+        reply_markup=markup)
+
+
+def get_inline_result(post: Dict) -> InlineQueryResult:
+    result = inline_result_cache.get(str(post['_id']))
+    if result is None:
+        result = make_inline_result(post)
+        inline_result_cache.set(str(post['_id']), result)
+    return result
+
+
+def get_page(post_ids: List, offset: str) -> Tuple[List, str]:
+    """Returns the page of inline query results at `offset` and the offset of the next page."""
+    start = int(offset) if offset.isdigit() else 0
+    end = start + MAX_INLINE_RESULTS
+    return post_ids[start:end], str(end) if end < len(post_ids) else ''
+
+
+def make_sparkline(values: List[int]) -> str:
+    top = max(values)
+    if not top:
+        return SPARKLINE_BARS[0] * len(values)
+    return ''.join(SPARKLINE_BARS[round(value / top * (len(SPARKLINE_BARS) - 1))]
+                   for value in values)
+
+
+def make_trend_text(post: Dict, trend: Trend) -> str:
+    clicks_count = post['clicks_count']
+    correct = post['correct_clicks_count'] / clicks_count if clicks_count else 0
+    text = (f"Statistics of post `{post['_id']}`:\n"
+            f"  - *Answers*: {clicks_count}\n"
+            f"  - *Correct answers*: {correct:.0%}\n"
+            f"  - *Last hour* ({TREND_SLOT_MINUTES} min): {make_sparkline(trend.minutes)} "
+            f"{sum(trend.minutes)}\n"
+            f"  - *Last {len(trend.hours)} hours*: {make_sparkline(trend.hours)} "
+            f"{sum(trend.hours)}")
+
+    peak = max(range(len(trend.hours)), key=lambda hour: trend.hours[hour])
+    if trend.hours[peak]:
+        start = trend.first_hour + datetime.timedelta(hours=peak)
+        text += f"\n  - *Peak hour*: {start:%H}:00 UTC, {trend.hours[peak]} answers"
+    return text
+
+
 def make_alert_text(*, initial_text: str,
                     count: int, total_count: int,
                     is_correct: bool,
@@ -0,0 +1,347 @@
+"""
+Admission of received updates before they are dispatched to the handlers.
+
+Updates wait in a queue of at most `INGRESS_MAX_PENDING_UPDATES`. Putting an
+update into the full queue doesn't wait for room, which would hold up the
+webhook server, but raises `QueueFull`, so that Telegram keeps the rest (long
+polling, where they are received again after a pause) or retries them
+(webhook, which answers 503) instead of the bot piling them up in memory.
+Once the queue is `INGRESS_SHED_THRESHOLD` full, low priority updates (inline
+queries, `/stats`, `/jobs` and the post statistics button) are dropped, so
+that quiz clicks and post creation keep flowing; the statistics button is
+answered that the bot is busy.
+
+Taps on the same button by the same user are coalesced: while the first one
+is waiting or being handled, the others wait for its answer, and for
+`INGRESS_COALESCE_WINDOW` seconds after it they get the same answer right
+away, without being dispatched. Handlers answer callback queries with
+`ingress.answer` for this, and call `ingress.release` once done, so that taps
+waiting for a tap whose handler has failed are answered to try again.
+
+The threaded mode puts updates into `IngressQueue`, the asyncio mode calls
+`Ingress.admit` with the number of updates in flight. Handlers of the threaded
+mode run by the dispatcher's worker pool are decorated with
+`async_handlers.run_async`, so that the dispatcher takes the next update only
+once there is room for its call, and the rest wait in `IngressQueue`.
+"""
+
+from collections import OrderedDict
+from functools import wraps
+from typing import Callable, Dict, Hashable, List, Optional
+import logging
+import os
+import queue
+import threading
+import time
+
+from telegram import CallbackQuery, Update
+from telegram.error import RetryAfter
+from telegram.ext import Dispatcher
+from tornado.web import HTTPError
+
+from quizbot import metrics
+from quizbot.handlers.post import STATS_BUTTON, decode_callback_data
+from quizbot.outbound import MERGE_KEY
+
+
+LOGGER = logging.getLogger(__name__)
+
+LOW, NORMAL, CLICK = range(3)
+
+LOW_PRIORITY_COMMANDS = {'stats', 'jobs'}
+BUSY_TEXT = "The bot is busy, try again in a minute"
+RETRY_TEXT = "Something went wrong, try again"
+
+# a click not answered by then won't be, see `quizbot.outbound`
+ANSWER_DEADLINE = float(os.environ.get('CALLBACK_ANSWER_DEADLINE', '15'))
+# seconds before getting updates again once the queue is full, in long polling mode
+FULL_QUEUE_PAUSE = 1
+# updates remembered by `RecentUpdates`, a getUpdates call returns 100 at most
+RECENT_UPDATES = 1000
+
+COALESCED_CLICKS = metrics.Counter('quizbot_ingress_coalesced_total',
+                                   'Repeated button taps answered without being dispatched',
+                                   labels=['state'])
+SHED_UPDATES = metrics.Counter('quizbot_ingress_shed_total',
+                               'Low priority updates dropped under overload', labels=['kind'])
+FULL_QUEUE_REJECTS = metrics.Counter('quizbot_ingress_full_queue_rejected_total',
+                                     'Updates left to Telegram to send again as the queue was full')
+
+
+class QueueFull(RetryAfter, HTTPError):
+    """
+    Raised when putting an update into a full queue. python-telegram-bot pauses
+    long polling on `RetryAfter`, without acknowledging the updates, and its
+    webhook server answers `HTTPError` with its status code.
+    """
+
+    def __init__(self):
+        RetryAfter.__init__(self, FULL_QUEUE_PAUSE)
+        HTTPError.__init__(self, 503)
+        self.message = "The update queue is full"
+
+
+class RecentUpdates:
+    """
+    IDs of the last queued updates: the updates of a getUpdates call queued
+    before one raised `QueueFull` are received again, and skipped then.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._ids: OrderedDict = OrderedDict()
+
+    def __contains__(self, update_id: int) -> bool:
+        return update_id in self._ids
+
+    def add(self, update_id: int) -> None:
+        self._ids[update_id] = True
+        if len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+
+
+def get_priority(update: Update) -> int:
+    query = update.callback_query
+    if query is not None:
+        try:
+            _, button = decode_callback_data(query.data or '')
+        except ValueError:
+            return NORMAL
+        return LOW if button == STATS_BUTTON else CLICK
+
+    if update.inline_query is not None:
+        return LOW
+
+    message = update.message
+    if message is not None and message.text and message.text.startswith('/'):
+        command = message.text.split()[0][1:].split('@')[0].lower()
+        if command in LOW_PRIORITY_COMMANDS:
+            return LOW
+    return NORMAL
+
+
+def click_key(query: CallbackQuery) -> Hashable:
+    return query.from_user.id, query.data
+
+
+class CoalescedClick:
+    def __init__(self, query_id: str, now: float):
+        # the query being handled, the others wait for its answer
+        self.query_id = query_id
+        self.received_at = now
+        self.answered_at: Optional[float] = None
+        self.params: Optional[Dict] = None
+        self.waiting: List[str] = []
+
+    def is_expired(self, now: float, window: float) -> bool:
+        if self.params is None:
+            return now - self.received_at > ANSWER_DEADLINE
+        return now - self.answered_at > window
+
+
+class Ingress:
+    def __init__(self, max_pending: int, shed_threshold: float, coalesce_window: float):
+        self.max_pending = max_pending
+        self.shed_threshold = shed_threshold
+        self.coalesce_window = coalesce_window
+        self._send_answer: Optional[Callable[[Dict], None]] = None
+        self._lock = threading.Lock()
+        # click key -> `CoalescedClick`, in the order of receiving
+        self._clicks: OrderedDict = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> 'Ingress':
+        return cls(max_pending=int(os.environ.get('INGRESS_MAX_PENDING_UPDATES', '1000')),
+                   shed_threshold=float(os.environ.get('INGRESS_SHED_THRESHOLD', '0.5')),
+                   coalesce_window=float(os.environ.get('INGRESS_COALESCE_WINDOW', '2')))
+
+    def start(self, send_answer: Callable[[Dict], None]) -> None:
+        """
+        Starts admitting updates, `send_answer` queues an `answerCallbackQuery`
+        call with the given parameters without waiting for it to be sent.
+        """
+        self._send_answer = send_answer
+
+    def admit(self, update: Update, pending: int, capacity: int) -> bool:
+        """Returns whether the update is to be dispatched, with `pending` of `capacity` waiting."""
+        if self._send_answer is None:
+            return True
+
+        priority = get_priority(update)
+        if priority == LOW and capacity and pending >= capacity * self.shed_threshold:
+            self.shed(update)
+            return False
+
+        if update.callback_query is not None and priority != NORMAL \
+                and self.coalesce_window > 0:
+            return self.coalesce(update.callback_query)
+        return True
+
+    def shed(self, update: Update) -> None:
+        if update.callback_query is not None:
+            self._send_answer({'callback_query_id': update.callback_query.id,
+                               'text': BUSY_TEXT, 'show_alert': False})
+            SHED_UPDATES.inc(kind='callback_query')
+        elif update.inline_query is not None:
+            SHED_UPDATES.inc(kind='inline_query')
+        else:
+            SHED_UPDATES.inc(kind='command')
+
+    def coalesce(self, query: CallbackQuery) -> bool:
+        """Returns whether the query is the first of its button taps to be handled."""
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            key = click_key(query)
+            click = self._clicks.get(key)
+            if click is None or click.is_expired(now, self.coalesce_window):
+                self._clicks.pop(key, None)
+                self._clicks[key] = CoalescedClick(query.id, now)
+                return True
+            if click.params is None:
+                click.waiting.append(query.id)
+                COALESCED_CLICKS.inc(state='waiting')
+                return False
+            params = click.params
+
+        self._send_answer({**params, 'callback_query_id': query.id})
+        COALESCED_CLICKS.inc(state='answered')
+        return False
+
+    def _prune(self, now: float) -> None:
+        while self._clicks:
+            key, click = next(iter(self._clicks.items()))
+            if not click.is_expired(now, self.coalesce_window):
+                return
+            del self._clicks[key]
+
+    def answer(self, query: CallbackQuery, **params) -> None:
+        """Answers the callback query and the taps coalesced with it."""
+        query.answer(**params)
+        if self._send_answer is None or self.coalesce_window <= 0:
+            return
+
+        # each tap gets its own answer, unlike the ones merged by `quizbot.outbound`
+        params = {name: value for name, value in params.items() if name != MERGE_KEY}
+        with self._lock:
+            click = self._clicks.get(click_key(query))
+            if click is None or click.query_id != query.id:
+                return
+            click.params = params
+            click.answered_at = time.monotonic()
+            waiting, click.waiting = click.waiting, []
+
+        for query_id in waiting:
+            self._send_answer({**params, 'callback_query_id': query_id})
+
+    def release(self, query: CallbackQuery) -> None:
+        """Called once the query has been handled, whether it has been answered or not."""
+        for query_id in self._forget(query):
+            self._send_answer({'callback_query_id': query_id, 'text': RETRY_TEXT,
+                               'show_alert': False})
+
+    def reject(self, update: Update) -> None:
+        """Called for an admitted update not queued after all, Telegram sends it again."""
+        FULL_QUEUE_REJECTS.inc()
+        if update.callback_query is None:
+            return
+        for query_id in self._forget(update.callback_query):
+            self._send_answer({'callback_query_id': query_id, 'text': BUSY_TEXT,
+                               'show_alert': False})
+
+    def _forget(self, query: CallbackQuery) -> List[str]:
+        """
+        Drops the query's taps unless it has been answered, so that the next tap
+        is handled again, returns the taps which were waiting for its answer.
+        """
+        if self._send_answer is None or self.coalesce_window <= 0:
+            return []
+
+        with self._lock:
+            key = click_key(query)
+            click = self._clicks.get(key)
+            if click is None or click.query_id != query.id or click.params is not None:
+                return []
+            del self._clicks[key]
+        return click.waiting
+
+    def __len__(self) -> int:
+        return len(self._clicks)
+
+
+class IngressQueue(queue.Queue):
+    """
+    Bounded update queue of the threaded dispatcher, passing the updates
+    through `ingress`. Putting an update never waits, see `QueueFull`.
+    """
+
+    def __init__(self, ingress: Ingress):
+        super().__init__(ingress.max_pending)
+        self.ingress = ingress
+        self._recent = RecentUpdates(RECENT_UPDATES)
+
+    def put(self, item, block=True, timeout=None) -> None:
+        if not isinstance(item, Update):
+            # errors of getting updates are put into the queue too, unless it's full
+            if not isinstance(item, QueueFull) and not self.full():
+                super().put(item, block=False)
+            return
+
+        if item.update_id in self._recent \
+                or not self.ingress.admit(item, self.qsize(), self.maxsize):
+            return
+        try:
+            super().put(item, block=False)
+        except queue.Full:
+            self.ingress.reject(item)
+            raise QueueFull()
+        self._recent.add(item.update_id)
+
+    def wait_for_room(self, timeout: float) -> bool:
+        """Returns whether the queue isn't full, waiting for at most `timeout` seconds."""
+        with self.not_full:
+            return self.not_full.wait_for(lambda: not 0 < self.maxsize <= self._qsize(), timeout)
+
+
+class AsyncHandlers:
+    """
+    Bounds the handler calls handed over to the dispatcher's worker pool by
+    `run_async`: at most one call per worker waits for a free worker, then the
+    dispatcher thread waits as well.
+    """
+
+    def __init__(self):
+        self._slots: Optional[threading.Semaphore] = None
+        self._lock = threading.Lock()
+        # calls waiting for a free worker
+        self.waiting = 0
+
+    def start(self, workers: int) -> None:
+        # the running calls and as many waiting ones
+        self._slots = threading.Semaphore(workers * 2)
+
+    def run_async(self, func: Callable) -> Callable:
+        """Runs the handler in the dispatcher's worker pool, see `telegram.ext.run_async`."""
+        @wraps(func)
+        def async_func(*args, **kwargs):
+            slots = self._slots
+            if slots is not None:
+                slots.acquire()
+            with self._lock:
+                self.waiting += 1
+            return Dispatcher.get_instance().run_async(self._run, slots, func, *args, **kwargs)
+
+        return async_func
+
+    def _run(self, slots: Optional[threading.Semaphore], func: Callable, *args, **kwargs):
+        with self._lock:
+            self.waiting -= 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if slots is not None:
+                slots.release()
+
+
+ingress = Ingress.from_env()
+async_handlers = AsyncHandlers()
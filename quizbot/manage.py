@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands: `python -m quizbot.manage <command> [options]`
+"""
+
+# Generic imports
+import argparse
+import datetime
+import logging
+
+from bson import ObjectId
+
+# Custom imports
+import quizbot.db.archive
+import quizbot.db.export
+import quizbot.db.models
+import quizbot.db.migrations
+import quizbot.db.plans
+import quizbot.db.timeseries
+import quizbot.handlers.importer
+import quizbot.publisher
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def migrate_answers(args: argparse.Namespace) -> None:
+    quizbot.db.models.ensure_indexes()
+    quizbot.db.migrations.migrate_posts_clicked_to_answers(drop_legacy=args.drop_legacy)
+
+
+def migrate_persistence(args: argparse.Namespace) -> None:
+    quizbot.db.migrations.migrate_pickle_persistence(args.filename)
+
+
+def migrate_buttons(args: argparse.Namespace) -> None:
+    quizbot.db.migrations.migrate_buttons_to_array()
+
+
+def rebuild_user_stats(args: argparse.Namespace) -> None:
+    drifted = quizbot.db.models.rebuild_user_stats(dry_run=args.check)
+    for user in drifted:
+        LOGGER.warning(f"User {user['_id']}: expected {user['expected']}, "
+                       f"found {user['actual']}")
+    LOGGER.info(f"{len(drifted)} users with drifted totals"
+                f"{'' if args.check else ' fixed'}")
+    if args.check and drifted:
+        raise SystemExit(1)
+
+
+def check_query_plans(args: argparse.Namespace) -> None:
+    reports = quizbot.db.plans.check_query_plans(max_wasted=args.max_wasted_docs)
+    for report in reports:
+        print(report.describe())
+    problems = [report for report in reports if report.problem]
+    LOGGER.info(f"{len(reports)} queries explained, {len(problems)} with problems")
+    if problems:
+        raise SystemExit(1)
+
+
+def roll_up_clicks(args: argparse.Namespace) -> None:
+    quizbot.db.models.ensure_indexes()
+    quizbot.db.timeseries.roll_up()
+
+
+def archive_posts(args: argparse.Namespace) -> None:
+    quizbot.db.models.ensure_indexes()
+    archived = quizbot.db.archive.archive_idle_posts(args.idle_days, batch_size=args.batch_size,
+                                                     dry_run=args.dry_run)
+    print(f"{archived} posts {'to archive' if args.dry_run else 'archived'}")
+
+
+def export(args: argparse.Namespace) -> None:
+    author = None
+    if args.author is not None:
+        author = quizbot.db.models.find_user_id(args.author)
+        if author is None:
+            raise SystemExit(f"No user with Telegram ID {args.author}")
+
+    try:
+        quizbot.db.export.export(args.table, args.output, fmt=args.format, author=author,
+                                 since=args.since, until=args.until,
+                                 checkpoint_path=args.checkpoint, batch_size=args.batch_size)
+    except (RuntimeError, ValueError) as error:
+        # missing pyarrow or a checkpoint of another export
+        raise SystemExit(str(error))
+
+
+def import_quizzes(args: argparse.Namespace) -> None:
+    importer = quizbot.handlers.importer
+    with open(args.filename, 'rb') as f:
+        data = f.read()
+    try:
+        quizzes = importer.load_quizzes(args.filename, data)
+    except importer.QuizImportError as error:
+        raise SystemExit(f"Nothing imported:\n{error}")
+
+    user_id = quizbot.db.models.find_or_create_user(args.author)
+    post_ids = quizbot.db.models.create_posts(importer.to_posts(quizzes), user_id)
+    LOGGER.info(f"Imported {len(post_ids)} posts")
+    for quiz, post_id in zip(quizzes, post_ids):
+        print(f"@{args.bot_username} #{post_id}\t{importer.get_excerpt(quiz['text'])}")
+
+
+def publish(args: argparse.Namespace) -> None:
+    publisher = quizbot.publisher
+    if not ObjectId.is_valid(args.post_id):
+        raise SystemExit(f"Invalid post ID {args.post_id}")
+    try:
+        with open(args.chats_file) as f:
+            chat_ids = [publisher.parse_chat_id(line) for line in f if line.strip()]
+        send_at = publisher.parse_send_at(args.at) if args.at else datetime.datetime.utcnow()
+        post = quizbot.db.models.find_post(args.post_id)
+    except ValueError as error:
+        raise SystemExit(str(error))
+
+    quizbot.db.models.ensure_indexes()
+    job_id = quizbot.db.models.create_publish_job(post['_id'], post['author'], chat_ids, send_at)
+    print(f"Job {job_id} sends post {post['_id']} to {len(chat_ids)} chats "
+          f"at {send_at:%Y-%m-%d %H:%M} UTC")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m quizbot.manage')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('migrate-answers',
+                                  help="Move answers from `users.posts_clicked` "
+                                       "to the `answers` collection")
+    command.add_argument('--drop-legacy', action='store_true',
+                         help="Remove `posts_clicked` from user documents afterwards")
+    command.set_defaults(func=migrate_answers)
+
+    command = commands.add_parser('migrate-persistence',
+                                  help="Copy user data and conversation states from "
+                                       "a `PicklePersistence` file to MongoDB")
+    command.add_argument('filename')
+    command.set_defaults(func=migrate_persistence)
+
+    command = commands.add_parser('migrate-buttons',
+                                  help="Convert buttons of posts keyed by text to arrays")
+    command.set_defaults(func=migrate_buttons)
+
+    command = commands.add_parser('rebuild-user-stats',
+                                  help="Recompute authors' total clicks from their posts")
+    command.add_argument('--check', action='store_true',
+                         help="Only report drifted totals, exit with 1 if there are any")
+    command.set_defaults(func=rebuild_user_stats)
+
+    command = commands.add_parser('check-query-plans',
+                                  help="Explain the queries of the data layer on seeded data "
+                                       "in a scratch database")
+    command.add_argument('--max-wasted-docs', type=int, default=quizbot.db.plans.MAX_WASTED_DOCS,
+                         help="Documents a query may examine on top of the ones it returns")
+    command.set_defaults(func=check_query_plans)
+
+    command = commands.add_parser('import-quizzes',
+                                  help="Create quizzes from a CSV or JSON file")
+    command.add_argument('filename')
+    command.add_argument('--author', type=int, required=True,
+                         help="Telegram ID of the user the posts are created for")
+    command.add_argument('--bot-username', default='<bot>',
+                         help="Username of the bot in the printed inline queries")
+    command.set_defaults(func=import_quizzes)
+
+    command = commands.add_parser('roll-up-clicks',
+                                  help="Add per-minute click buckets of finished hours "
+                                       "to the per-hour ones")
+    command.set_defaults(func=roll_up_clicks)
+
+    command = commands.add_parser('archive-posts',
+                                  help="Move posts which haven't been clicked for a while "
+                                       "to the archive")
+    command.add_argument('--idle-days', type=float, required=True,
+                         help="Days without clicks after which a post is archived")
+    command.add_argument('--batch-size', type=int, default=quizbot.db.archive.ARCHIVE_BATCH)
+    command.add_argument('--dry-run', action='store_true',
+                         help="Only count the posts to archive")
+    command.set_defaults(func=archive_posts)
+
+    command = commands.add_parser('export',
+                                  help="Stream posts, button counters or answers to a file")
+    command.add_argument('table', choices=quizbot.db.export.TABLES)
+    command.add_argument('output', help="File, or directory of Parquet files")
+    command.add_argument('--format', choices=quizbot.db.export.FORMATS, default='csv',
+                         help="`parquet` needs pyarrow")
+    command.add_argument('--author', type=int, help="Telegram ID of the posts' author")
+    command.add_argument('--since', type=datetime.datetime.fromisoformat,
+                         help="Posts created or answers given since (UTC), "
+                              "e.g. 2019-10-01 or 2019-10-01T12:00")
+    command.add_argument('--until', type=datetime.datetime.fromisoformat,
+                         help="Same as --since, exclusive")
+    command.add_argument('--checkpoint',
+                         help="File to save the progress to and resume from")
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.set_defaults(func=export)
+
+    command = commands.add_parser('publish',
+                                  help="Schedule sending a post to the chats of a file, "
+                                       "by the running bot")
+    command.add_argument('post_id')
+    command.add_argument('--chats-file', required=True,
+                         help="File with a chat ID or @channel per line")
+    command.add_argument('--at', help="Time to send at (UTC), e.g. 2019-10-01T12:00; now "
+                                      "if not given")
+    command.set_defaults(func=publish)
+
+    return parser
+
+
+def main() -> None:
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+    args = get_parser().parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""
+In-process metrics exported in the Prometheus text format.
+
+Metrics are cheap enough to be always on: recording a value takes a dict
+lookup and an uncontended lock. The exporter is only started when
+`METRICS_PORT` is set, and serves `http://<METRICS_HOST>:<METRICS_PORT>/metrics`.
+
+A metric created again under the same name, e.g. a gauge of the state of a
+bot set up twice in a process, replaces the earlier one.
+"""
+
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from pymongo import monitoring
+
+
+LOGGER = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str, quotes: bool = True) -> str:
+    """Escapes a label value, or a help text, which keeps its double quotes."""
+    value = value.replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"') if quotes else value
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], **extra: str) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ''
+    labels = ','.join(f'{name}="{_escape(str(value))}"' for name, value in pairs)
+    return '{' + labels + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        description = _escape(self.description, quotes=False)
+        return '\n'.join([f'# HELP {self.name} {description}',
+                          f'# TYPE {self.name} {self.kind}',
+                          *self.samples()])
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}'
+                for key, value in values]
+
+
+class Gauge(Metric):
+    """A value which is either set directly or read from `func` on export."""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str,
+                 func: Optional[Callable[[], float]] = None, kind: str = 'gauge'):
+        super().__init__(name, description)
+        self.kind = kind
+        self.func = func
+        self._value = 0.0
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def set_function(self, func: Callable[[], float]) -> None:
+        self.func = func
+
+    def value(self) -> float:
+        return self.func() if self.func is not None else self._value
+
+    def samples(self) -> List[str]:
+        try:
+            return [f'{self.name} {self.value()}']
+        except Exception:
+            LOGGER.exception(f"Failed to read gauge {self.name}")
+            return []
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., count above the last bucket, sum]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, **labels: str) -> int:
+        counts = self._values.get(self._key(labels))
+        return int(sum(counts[:-1])) if counts else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+
+        samples = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, le=str(bound))
+                samples.append(f'{self.name}_bucket{labels} {cumulative}')
+            samples.append(f'{self.name}_sum{_format_labels(self.labels, key)} {counts[-1]}')
+            samples.append(f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}')
+        return samples
+
+
+# name -> metric
+REGISTRY: Dict[str, Metric] = {}
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in list(REGISTRY.values())) + '\n'
+
+
+HANDLER_DURATION = Histogram('quizbot_handler_duration_seconds',
+                             'Time spent in update handlers', labels=['handler'])
+HANDLER_ERRORS = Counter('quizbot_handler_errors_total',
+                         'Exceptions raised by update handlers', labels=['handler'])
+MONGO_COMMAND_DURATION = Histogram('quizbot_mongo_command_duration_seconds',
+                                   'MongoDB command round trip time', labels=['command'])
+MONGO_COMMAND_ERRORS = Counter('quizbot_mongo_command_errors_total',
+                               'Failed MongoDB commands', labels=['command'])
+UPDATE_QUEUE_SIZE = Gauge('quizbot_update_queue_size',
+                          'Updates waiting to be dispatched')
+ASYNC_QUEUE_SIZE = Gauge('quizbot_async_queue_size',
+                         'Handler calls waiting for a free worker')
+
+
+def timed_handler(func: Callable) -> Callable:
+    """Records latency and errors of an update handler callback, either sync or async."""
+    name = func.__name__
+
+    if asyncio.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=name)
+                raise
+            finally:
+                HANDLER_DURATION.observe(time.perf_counter() - start, handler=name)
+
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - start, handler=name)
+
+    return wrapper
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        MONGO_COMMAND_DURATION.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        MONGO_COMMAND_DURATION.observe(event.duration_micros / 1e6, command=event.command_name)
+        MONGO_COMMAND_ERRORS.inc(command=event.command_name)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+_exporter: Optional[ThreadingHTTPServer] = None
+
+
+def start_exporter() -> Optional[ThreadingHTTPServer]:
+    """Starts serving the metrics unless it's already done."""
+    global _exporter
+    if 'METRICS_PORT' not in os.environ or _exporter is not None:
+        return _exporter
+
+    host = os.environ.get('METRICS_HOST', '127.0.0.1')
+    port = int(os.environ['METRICS_PORT'])
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-exporter', daemon=True).start()
+    LOGGER.info(f"Serving metrics on http://{host}:{port}/metrics")
+    _exporter = server
+    return server
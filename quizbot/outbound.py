@@ -0,0 +1,342 @@
+"""
+Scheduler of outgoing Bot API calls.
+
+Calls are queued in lanes by priority: callback query answers first, since
+Telegram only accepts them for a few seconds after the click, then inline
+query answers, then messages, then the other calls (e.g. `getFile` or
+`editMessageText`). Messages also take a token from the global and their
+chat's token bucket, matching Telegram's limits of about 30 messages per
+second overall and one per second per chat; the global limit is split
+between the `WORKER_PROCESSES` processes sending them. A call hitting the
+flood limit anyway is requeued at the head of its lane, and the lane (or the
+chat, for a message) pauses for `retry_after` seconds.
+
+Callback query answers sent with the same `merge_key` (e.g. repeated taps on
+a button by one user) while the first one is still queued are merged into
+it: a single answer with the latest parameters is sent for all of them.
+
+`OutboundQueue` runs the scheduler with sender threads in place of
+python-telegram-bot's `Request`, see `quizbot.aio.bot` for the asyncio mode.
+Handlers wrapped with `without_waiting` only queue their calls: the
+conversation runs in the dispatcher thread, and waiting there for a chat's
+token bucket would hold up every update received after it.
+"""
+
+from collections import deque
+from functools import wraps
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+import logging
+import os
+import threading
+import time
+
+from telegram.error import RetryAfter
+from telegram.utils.request import Request
+
+from quizbot import metrics
+
+
+LOGGER = logging.getLogger(__name__)
+
+CALLBACK_ANSWER, INLINE_ANSWER, MESSAGE, OTHER = range(4)
+LANES = {'answerCallbackQuery': CALLBACK_ANSWER, 'answerInlineQuery': INLINE_ANSWER}
+LANE_NAMES = ['callback_answer', 'inline_answer', 'message', 'other']
+
+# calls sending a message to a chat, limited by the token buckets
+MESSAGE_METHODS = {
+    'sendMessage', 'forwardMessage', 'copyMessage', 'sendPhoto', 'sendAudio',
+    'sendDocument', 'sendVideo', 'sendAnimation', 'sendVoice', 'sendVideoNote',
+    'sendMediaGroup', 'sendLocation', 'sendVenue', 'sendContact', 'sendPoll', 'sendDice',
+    'sendSticker', 'sendInvoice', 'sendGame',
+}
+
+# long polling and bot setup calls bypass the scheduler
+UNSCHEDULED = {'getUpdates', 'getMe', 'setWebhook', 'deleteWebhook', 'getWebhookInfo'}
+
+# passed to `CallbackQuery.answer`, never sent to Telegram
+MERGE_KEY = 'merge_key'
+
+# set in the threads running a handler wrapped with `without_waiting`
+_not_waiting = threading.local()
+
+QUEUED_CALLS = metrics.Gauge('quizbot_outbound_queued_calls', 'Bot API calls waiting to be sent')
+MERGED_CALLS = metrics.Counter('quizbot_outbound_merged_total',
+                               'Callback query answers merged into a queued one')
+EXPIRED_CALLS = metrics.Counter('quizbot_outbound_expired_total',
+                                'Callback query answers dropped after the deadline')
+FLOOD_ERRORS = metrics.Counter('quizbot_outbound_flood_errors_total',
+                               'Bot API calls rejected by the flood limit', labels=['lane'])
+QUEUE_DURATION = metrics.Histogram('quizbot_outbound_queue_duration_seconds',
+                                   'Time Bot API calls wait in the queue', labels=['lane'])
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float, now: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        # `now` may have been read before the bucket was created
+        if now <= self.updated:
+            return
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Returns the time until a token is available."""
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.paused_until
+
+
+class Call:
+    def __init__(self, url: str, params: Dict, timeout: Optional[float], done: Any):
+        self.url = url
+        self.method = url.rsplit('/', 1)[-1]
+        self.params = params
+        self.timeout = timeout
+        self.merge_key: Optional[Hashable] = params.pop(MERGE_KEY, None)
+        self.chat_id = params.get('chat_id')
+        self.lane = LANES.get(self.method, MESSAGE if self.method in MESSAGE_METHODS else OTHER)
+        self.queued_at = time.monotonic()
+        # threading.Event or asyncio.Event, set once the call is complete
+        self.done = done
+        # nobody waits for the result, failures are only logged
+        self.detached = False
+        self.result: Any = None
+        self.error: Optional[Exception] = None
+
+    def complete(self, result: Any = None, error: Optional[Exception] = None) -> None:
+        self.result = result
+        self.error = error
+        self.done.set()
+
+
+class OutboundScheduler:
+    """Decides which call to send next, must be used under a lock by a single thread at a time."""
+
+    def __init__(self, messages_per_second: float, chat_messages_per_second: float,
+                 chat_burst: float, callback_answer_deadline: float):
+        self.lanes: List[Deque[Call]] = [deque() for _ in LANE_NAMES]
+        self.lane_paused_until = [0.0 for _ in LANE_NAMES]
+        self.messages = TokenBucket(messages_per_second, messages_per_second)
+        self.chat_messages_per_second = chat_messages_per_second
+        self.chat_burst = chat_burst
+        self.chats: Dict[Any, TokenBucket] = {}
+        self.callback_answer_deadline = callback_answer_deadline
+        self.merging: Dict[Hashable, Call] = {}
+        QUEUED_CALLS.set_function(lambda: sum(len(lane) for lane in self.lanes))
+
+    @classmethod
+    def from_env(cls) -> 'OutboundScheduler':
+        # every worker process sends messages, see `quizbot.supervisor`
+        processes = max(1, int(os.environ.get('WORKER_PROCESSES', '0')))
+        return cls(
+            messages_per_second=float(
+                os.environ.get('OUTBOUND_MESSAGES_PER_SECOND', '30')) / processes,
+            chat_messages_per_second=float(
+                os.environ.get('OUTBOUND_CHAT_MESSAGES_PER_SECOND', '1')),
+            chat_burst=float(os.environ.get('OUTBOUND_CHAT_BURST', '3')),
+            callback_answer_deadline=float(os.environ.get('CALLBACK_ANSWER_DEADLINE', '15')))
+
+    def __len__(self) -> int:
+        return sum(len(lane) for lane in self.lanes)
+
+    def push(self, call: Call) -> Call:
+        """Queues the call, returns the call to wait for, which is a queued one if merged."""
+        if call.merge_key is not None:
+            queued = self.merging.get(call.merge_key)
+            if queued is not None:
+                # answer the latest query in the place of the earlier one
+                queued.params = call.params
+                MERGED_CALLS.inc()
+                return queued
+            self.merging[call.merge_key] = call
+
+        self.lanes[call.lane].append(call)
+        return call
+
+    def chat_bucket(self, chat_id: Any, now: float) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) > 10000:
+                self.chats = {chat: bucket for chat, bucket in self.chats.items()
+                              if not bucket.is_idle(now)}
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_messages_per_second,
+                                                       self.chat_burst, now)
+        return bucket
+
+    def pop(self, now: float) -> Tuple[Optional[Call], Optional[float]]:
+        """Returns the next call to send, or the time to wait for one (None if none is queued)."""
+        wait = None
+        for lane, calls in enumerate(self.lanes):
+            if lane == CALLBACK_ANSWER:
+                while calls and now - calls[0].queued_at > self.callback_answer_deadline:
+                    self._taken(calls.popleft()).complete(result=False)
+                    EXPIRED_CALLS.inc()
+            if not calls:
+                continue
+
+            delay = self.lane_paused_until[lane] - now
+            if lane == MESSAGE:
+                delay = max(delay, self.messages.delay(now))
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+
+            if lane != MESSAGE:
+                return self._taken(calls.popleft()), None
+
+            for index, call in enumerate(calls):
+                bucket = self.chat_bucket(call.chat_id, now)
+                delay = bucket.delay(now)
+                if delay <= 0:
+                    del calls[index]
+                    bucket.take(now)
+                    self.messages.take(now)
+                    return self._taken(call), None
+                wait = delay if wait is None else min(wait, delay)
+
+        return None, wait
+
+    def _taken(self, call: Call) -> Call:
+        if call.merge_key is not None and self.merging.get(call.merge_key) is call:
+            del self.merging[call.merge_key]
+        QUEUE_DURATION.observe(time.monotonic() - call.queued_at, lane=LANE_NAMES[call.lane])
+        return call
+
+    def retry(self, call: Call, retry_after: float, now: float) -> None:
+        """Requeues the call rejected by the flood limit."""
+        FLOOD_ERRORS.inc(lane=LANE_NAMES[call.lane])
+        if call.lane == MESSAGE and call.chat_id is not None:
+            bucket = self.chat_bucket(call.chat_id, now)
+            bucket.paused_until = max(bucket.paused_until, now + retry_after)
+        else:
+            self.lane_paused_until[call.lane] = max(self.lane_paused_until[call.lane],
+                                                    now + retry_after)
+
+        self.lanes[call.lane].appendleft(call)
+        if call.merge_key is not None:
+            self.merging.setdefault(call.merge_key, call)
+
+
+def without_waiting(handler: Callable) -> Callable:
+    """
+    Wraps a handler not using the results of its Bot API calls, which are
+    queued without waiting for them to be sent and return True.
+    """
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        _not_waiting.enabled = True
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            _not_waiting.enabled = False
+
+    return wrapper
+
+
+class OutboundQueue:
+    """Stands in for the bot's `Request`, sending the scheduled calls with `senders` threads."""
+
+    def __init__(self, request: Request, senders: int, scheduler: OutboundScheduler):
+        self.request = request
+        self.scheduler = scheduler
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._threads = [threading.Thread(target=self._send, name=f'outbound-{index}',
+                                          daemon=True)
+                         for index in range(senders)]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def con_pool_size(self) -> int:
+        return self.request.con_pool_size
+
+    def get(self, url: str, timeout: Optional[float] = None) -> Any:
+        return self.request.get(url, timeout=timeout)
+
+    def download(self, url: str, filename: str, timeout: Optional[float] = None) -> None:
+        self.request.download(url, filename, timeout=timeout)
+
+    def retrieve(self, url: str, timeout: Optional[float] = None) -> bytes:
+        return self.request.retrieve(url, timeout=timeout)
+
+    def post(self, url: str, data: Dict, timeout: Optional[float] = None) -> Any:
+        if url.rsplit('/', 1)[-1] in UNSCHEDULED:
+            return self.request.post(url, data, timeout=timeout)
+        if getattr(_not_waiting, 'enabled', False):
+            # python-telegram-bot returns True as is in place of the sent message
+            self.post_later(url, data, timeout=timeout)
+            return True
+
+        call = Call(url, data, timeout, threading.Event())
+        with self._condition:
+            call = self.scheduler.push(call)
+            self._condition.notify()
+
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def post_later(self, url: str, data: Dict, timeout: Optional[float] = None) -> None:
+        """Queues the call without waiting for it to be sent, failures are logged."""
+        call = Call(url, data, timeout, threading.Event())
+        call.detached = True
+        with self._condition:
+            self.scheduler.push(call)
+            self._condition.notify()
+
+    def _next(self) -> Optional[Call]:
+        with self._condition:
+            while True:
+                call, wait = self.scheduler.pop(time.monotonic())
+                if call is not None:
+                    return call
+                if self._stopped and wait is None:
+                    return None
+                self._condition.wait(wait)
+
+    def _send(self) -> None:
+        while True:
+            call = self._next()
+            if call is None:
+                return
+
+            try:
+                result = self.request.post(call.url, call.params, timeout=call.timeout)
+            except RetryAfter as error:
+                LOGGER.warning(f"Flood limit exceeded on {call.method}, "
+                               f"retrying in {error.retry_after}s")
+                with self._condition:
+                    self.scheduler.retry(call, error.retry_after, time.monotonic())
+                    self._condition.notify()
+            except Exception as error:
+                if call.detached:
+                    LOGGER.warning(f"{call.method} failed: {error}")
+                call.complete(error=error)
+            else:
+                call.complete(result=result)
+
+    def stop(self) -> None:
+        """Sends the queued calls and stops."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self.request.stop()
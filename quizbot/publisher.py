@@ -0,0 +1,264 @@
+"""
+Sends publish jobs (see `quizbot.db.publish_jobs`) once they are due.
+
+A job thread claims due jobs one at a time and sends the post to the pending
+chats of the job in batches with `PUBLISH_SENDERS` threads. The calls go
+through the bot's outbound queue like any other, so publishing to thousands of
+chats keeps within the flood limits and doesn't delay answers to clicks.
+Progress is saved after each batch, so jobs resume after a restart.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import atexit
+import datetime
+import logging
+import os
+import threading
+import time
+
+from bson import ObjectId
+from telegram import Bot, InlineKeyboardMarkup
+from telegram.error import TelegramError
+
+from quizbot import metrics
+from quizbot.db import publish_jobs
+from quizbot.db.publish_jobs import ChatId
+import quizbot.db.models
+import quizbot.handlers.post as postutils
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Calls a Bot API method with the given parameters and returns the result
+ApiCall = Callable[[str, Dict], Any]
+
+PUBLISH_USAGE = "Usage: /publish <post id> [<time, UTC>] <chat id or @channel> ..."
+# statuses of a user in a chat letting them publish there
+PUBLISHING_STATUSES = {'creator', 'administrator', 'member'}
+# chats listed when refusing to publish
+FORBIDDEN_CHATS_LISTED = 10
+# jobs listed by /jobs
+JOBS_LISTED = 10
+
+PUBLISH_SENDS = metrics.Counter('quizbot_publish_sends_total',
+                                'Messages sent by publish jobs', labels=['result'])
+PUBLISH_SEND_RATE = metrics.Gauge('quizbot_publish_sends_per_second',
+                                  'Messages per second sent by the last batch of a publish job')
+
+
+class Publisher:
+    def __init__(self, senders: int, batch_size: int, poll_interval: float,
+                 lease: datetime.timedelta):
+        self.senders = senders
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._call: Optional[ApiCall] = None
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @classmethod
+    def from_env(cls) -> 'Publisher':
+        return cls(senders=int(os.environ.get('PUBLISH_SENDERS', '8')),
+                   batch_size=int(os.environ.get('PUBLISH_BATCH_SIZE', '100')),
+                   poll_interval=float(os.environ.get('PUBLISH_POLL_INTERVAL', '5')),
+                   lease=datetime.timedelta(seconds=300))
+
+    def start(self, call: ApiCall) -> None:
+        if self._thread is not None or self.senders <= 0:
+            return
+        self._call = call
+        self._stopped.clear()
+        self._executor = ThreadPoolExecutor(self.senders, thread_name_prefix='publish')
+        self._thread = threading.Thread(target=self._run, name='publisher', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """Waits for the batch being sent, the rest of the job is sent after a restart."""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        self._executor.shutdown()
+        self._executor = None
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                job = publish_jobs.claim_job(datetime.datetime.utcnow(), self.lease)
+                if job is None:
+                    self._stopped.wait(self.poll_interval)
+                    continue
+                self.run_job(job)
+            except Exception:
+                LOGGER.exception("Failed to run a publish job, retrying later")
+                self._stopped.wait(self.poll_interval)
+
+    def run_job(self, job: Dict) -> None:
+        job_id = job['_id']
+        try:
+            post = quizbot.db.models.find_post(job['post_id'])
+        except ValueError:
+            LOGGER.warning(f"Post {job['post_id']} of publish job {job_id} has been deleted")
+            publish_jobs.finish_job(job_id)
+            return
+        method, params = make_message(post)
+        LOGGER.info(f"Publishing post {post['_id']} to {job['chats_count']} chats, job {job_id}")
+
+        while True:
+            if self._stopped.is_set():
+                publish_jobs.release_job(job_id)
+                LOGGER.info(f"Publish job {job_id} interrupted, to be resumed")
+                return
+            if not publish_jobs.renew_lease(job_id, datetime.datetime.utcnow(), self.lease):
+                LOGGER.info(f"Publish job {job_id} cancelled")
+                return
+
+            deliveries = publish_jobs.find_pending_deliveries(job_id, self.batch_size)
+            if not deliveries:
+                break
+
+            start = time.perf_counter()
+            results = list(self._executor.map(
+                lambda delivery: self.send(delivery, method, params), deliveries))
+            publish_jobs.record_deliveries(job_id, results)
+            PUBLISH_SEND_RATE.set(len(results) / (time.perf_counter() - start))
+
+        publish_jobs.finish_job(job_id)
+        LOGGER.info(f"Publish job {job_id} done")
+
+    def send(self, delivery: Dict, method: str,
+             params: Dict) -> Tuple[str, Optional[int], Optional[str]]:
+        try:
+            message = self._call(method, {**params, 'chat_id': delivery['chat_id']})
+        except TelegramError as error:
+            # e.g. the bot was blocked by the user or isn't an admin of the channel
+            LOGGER.warning(f"Failed to publish to {delivery['chat_id']}: {error}")
+            PUBLISH_SENDS.inc(result='failed')
+            return delivery['_id'], None, str(error)
+        except Exception as error:
+            # the message may have been sent, so the delivery isn't retried: raising
+            # would lose the results of the whole batch, which would be sent again
+            LOGGER.exception(f"Failed to publish to {delivery['chat_id']}")
+            PUBLISH_SENDS.inc(result='failed')
+            return delivery['_id'], None, repr(error)
+
+        PUBLISH_SENDS.inc(result='sent')
+        return delivery['_id'], message['message_id'], None
+
+
+def bot_call(bot: Bot) -> ApiCall:
+    """Returns the `ApiCall` of a python-telegram-bot bot, waiting for its outbound queue."""
+    return lambda method, params: bot.request.post(f'{bot.base_url}/{method}', params,
+                                                   timeout=30)
+
+
+def member_params(chat_id: ChatId, telegram_id: int) -> Optional[Dict]:
+    """
+    Returns the `getChatMember` parameters checking that the user may publish to
+    the chat, or None for their own private chat, which needs no check.
+    """
+    if chat_id == telegram_id:
+        return None
+    return {'chat_id': chat_id, 'user_id': telegram_id}
+
+
+def is_publishing_member(member: Optional[Dict]) -> bool:
+    """`member` is the result of `getChatMember`, None if it failed, e.g. for an unknown chat."""
+    return member is not None and member.get('status') in PUBLISHING_STATUSES
+
+
+def find_forbidden_chats(chat_ids: List[ChatId], telegram_id: int,
+                         call: ApiCall) -> List[ChatId]:
+    """
+    Returns the chats the user may not publish to: the ones other than their
+    private chat which they are not a member of, or which the bot can't see.
+    """
+    forbidden = []
+    for chat_id in chat_ids:
+        params = member_params(chat_id, telegram_id)
+        if params is None:
+            continue
+        try:
+            member = call('getChatMember', params)
+        except TelegramError as error:
+            LOGGER.info(f"Failed to get user {telegram_id} in chat {chat_id}: {error}")
+            member = None
+        if not is_publishing_member(member):
+            forbidden.append(chat_id)
+    return forbidden
+
+
+def make_forbidden_text(chat_ids: List[ChatId]) -> str:
+    listed = ', '.join(str(chat_id) for chat_id in chat_ids[:FORBIDDEN_CHATS_LISTED])
+    if len(chat_ids) > FORBIDDEN_CHATS_LISTED:
+        listed += f" and {len(chat_ids) - FORBIDDEN_CHATS_LISTED} more"
+    return (f"Nothing scheduled: you can only publish to your chat with the bot and to "
+            f"chats you are a member of, which isn't the case of {listed}")
+
+
+def make_message(post: Dict) -> Tuple[str, Dict]:
+    """Returns the Bot API method and the parameters sending the post to a chat."""
+    markup = InlineKeyboardMarkup(postutils.get_post_keyboard(post['buttons'], post['_id']))
+    if postutils.post_type(post) == 'text':
+        return 'sendMessage', {'text': post['text'], 'reply_markup': markup.to_json()}
+    return 'sendPhoto', {'photo': post['photo'], 'reply_markup': markup.to_json()}
+
+
+def parse_chat_id(chat: str) -> ChatId:
+    """Chats are given as numeric IDs or `@username` of channels."""
+    chat = chat.strip()
+    if chat.lstrip('-').isdigit():
+        return int(chat)
+    if chat.startswith('@') and len(chat) > 1:
+        return chat
+    raise ValueError(f"Invalid chat {chat}, expected an ID or @username")
+
+
+def parse_send_at(value: str) -> datetime.datetime:
+    """Parses an ISO time in UTC, e.g. `2020-03-01T18:00`."""
+    try:
+        send_at = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid time {value}, expected e.g. 2020-03-01T18:00 (UTC)")
+    if send_at.tzinfo is not None:
+        send_at = send_at.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return send_at
+
+
+def parse_publish_args(args: List[str]) -> Tuple[str, datetime.datetime, List[ChatId]]:
+    """Parses `<post id> [<time>] <chat> ...` into the post ID, send time and chats."""
+    if len(args) < 2:
+        raise ValueError(PUBLISH_USAGE)
+    post_id, args = args[0], args[1:]
+    if not ObjectId.is_valid(post_id):
+        raise ValueError(f"Invalid post ID {post_id}")
+
+    send_at = datetime.datetime.utcnow()
+    if args[0][:1].isdigit() and ('-' in args[0] or ':' in args[0]) and len(args) > 1:
+        send_at = parse_send_at(args[0])
+        args = args[1:]
+    # the same chat given twice gets the post once
+    return post_id, send_at, list(dict.fromkeys(parse_chat_id(chat) for chat in args))
+
+
+def make_jobs_text(jobs: List[Dict]) -> str:
+    if not jobs:
+        return "You have no publish jobs"
+    lines = []
+    for job in jobs:
+        line = (f"`{job['_id']}` post `{job['post_id']}`: {job['status']}, "
+                f"{job['sent_count']}/{job['chats_count']} sent")
+        if job['failed_count']:
+            line += f", {job['failed_count']} failed"
+        if job['status'] == 'scheduled':
+            line += f", at {job['send_at']:%Y-%m-%d %H:%M} UTC"
+        lines.append(line)
+    return "Your publish jobs:\n" + '\n'.join(lines)
+
+
+publisher = Publisher.from_env()
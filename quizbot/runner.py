@@ -3,13 +3,23 @@ import logging
 import os
 from typing import Dict, List, Callable, Optional
 
+# Mongo imports
+from bson import ObjectId
+
 # Telegram imports
 from telegram.ext import Updater
-from telegram.ext import PicklePersistence
-from telegram import Update
+from telegram.utils.request import Request
+from telegram import Bot, Update
 
 # Custom imports
+from quizbot import metrics, startup
+from quizbot.ingress import IngressQueue, async_handlers, ingress
+from quizbot.outbound import OutboundQueue, OutboundScheduler
+from quizbot.publisher import bot_call, publisher
 from quizbot.utils import str2bool
+from quizbot.db import buffer, membership, timeseries
+from quizbot.db.persistence import MongoPersistence
+import quizbot.db.models
 
 
 LOGGER = logging.getLogger(__name__)
@@ -34,21 +44,138 @@ def get_socks_proxy_params() -> Optional[Dict]:
     return proxy_params
 
 
-def run_get_updates(token: str, handlers: List[Callable]) -> None:
+def register_state_metrics() -> None:
+    """Registers the gauges of the caches and filters, again replacing the earlier ones."""
+    caches = {'post': quizbot.db.models.post_cache, 'user_id': quizbot.db.models.user_id_cache}
+    for name, cache in caches.items():
+        metrics.Gauge(f'quizbot_{name}_cache_hits_total', f"Hits of the {name} cache",
+                      func=lambda cache=cache: cache.hits, kind='counter')
+        metrics.Gauge(f'quizbot_{name}_cache_misses_total', f"Misses of the {name} cache",
+                      func=lambda cache=cache: cache.misses, kind='counter')
+        metrics.Gauge(f'quizbot_{name}_cache_size', f"Entries in the {name} cache",
+                      func=lambda cache=cache: len(cache))
+    metrics.Gauge('quizbot_ingress_coalescing_clicks',
+                  "Button taps whose repeats are coalesced, see `quizbot.ingress`",
+                  func=lambda: len(ingress))
+    metrics.Gauge('quizbot_click_buffer_pending_ops', "Writes waiting in the click buffer",
+                  func=lambda: buffer.click_buffer.pending_ops)
+
+    answered = membership.answered_users
+    metrics.Gauge('quizbot_answered_filters', "Posts with a filter of the users who answered them",
+                  func=lambda: len(answered))
+    metrics.Gauge('quizbot_answered_filters_bytes', "Memory taken by the answered users filters",
+                  func=lambda: answered.nbytes)
+    metrics.Gauge('quizbot_answered_filter_negatives_total',
+                  "Clicks of users who certainly hadn't answered the post",
+                  func=lambda: answered.negatives, kind='counter')
+    metrics.Gauge('quizbot_answered_filter_positives_total',
+                  "Clicks of users who may have answered the post",
+                  func=lambda: answered.positives, kind='counter')
+    metrics.Gauge('quizbot_answered_filter_false_positives_total',
+                  "Clicks of users who may have answered the post, but hadn't",
+                  func=lambda: answered.false_positives, kind='counter')
+    metrics.Gauge('quizbot_answered_filter_false_positive_rate',
+                  "Observed false positive rate of the answered users filters",
+                  func=answered.false_positive_rate)
+    metrics.Gauge('quizbot_answered_filter_expected_false_positive_rate',
+                  "Mean expected false positive rate of the answered users filters",
+                  func=answered.expected_error_rate)
+
+
+def create_updater(token: str, handlers: List[Callable],
+                   post_filter: Optional[Callable[[ObjectId], bool]] = None) -> Updater:
+    """Sets up the bot, `post_filter` picks the posts to warm up the caches with."""
     proxy_params = get_socks_proxy_params()
-    persistence = PicklePersistence(os.environ['PERSISTENCE_DATA_FILE'])
+    persistence = MongoPersistence()
 
     if proxy_params is not None:
         LOGGER.warning(f"Using SOCKS5 proxy:\n{proxy_params}")
 
-    updater = Updater(token, request_kwargs=proxy_params,
-                      use_context=True, persistence=persistence)
+    # size of the thread pool running handlers decorated with `run_async`
+    workers = int(os.environ.get('TELEGRAM_WORKERS', '8'))
+    # e.g. a local Bot API server, defaults to https://api.telegram.org/bot
+    base_url = os.environ.get('TELEGRAM_BASE_URL')
+    # where sent documents are downloaded from, defaults to https://api.telegram.org/file/bot
+    base_file_url = os.environ.get('TELEGRAM_BASE_FILE_URL')
+    # threads sending the Bot API calls queued by handlers, see `quizbot.outbound`
+    senders = int(os.environ.get('OUTBOUND_SENDERS', '8'))
+
+    request = Request(con_pool_size=workers + 4 + senders, **(proxy_params or {}))
+    bot = Bot(token, base_url=base_url, base_file_url=base_file_url,
+              request=OutboundQueue(request, senders, OutboundScheduler.from_env()))
+    updater = Updater(bot=bot, workers=workers, use_context=True, persistence=persistence)
 
     dp = updater.dispatcher
+    # Updates wait in the bounded queue of `quizbot.ingress`, which only hands
+    # them over to the workers once they have room, see `AsyncHandlers`
+    updater.update_queue = dp.update_queue = IngressQueue(ingress)
+    async_handlers.start(workers)
 
     for handler in handlers:
         dp.add_handler(handler)
 
     dp.add_error_handler(log_error)
-    updater.start_polling()
+
+    metrics.UPDATE_QUEUE_SIZE.set_function(updater.update_queue.qsize)
+    metrics.ASYNC_QUEUE_SIZE.set_function(lambda: async_handlers.waiting)
+    register_state_metrics()
+    metrics.start_exporter()
+
+    ingress.start(lambda params: bot.request.post_later(f'{bot.base_url}/answerCallbackQuery',
+                                                        params, timeout=30))
+    membership.answered_users.start(quizbot.db.models.read_answered_users)
+    startup.prepare(post_filter)
+    if buffer.is_enabled():
+        buffer.click_buffer.on_missing('posts', quizbot.db.models.restore_archived_posts)
+        buffer.click_buffer.start()
+    timeseries.roll_up_job.start()
+    publisher.start(bot_call(bot))
+
+    return updater
+
+
+def idle(updater: Updater) -> None:
+    # On SIGINT/SIGTERM the updater stops fetching updates first and the
+    # dispatcher exits only after all queued updates have been handled
     updater.idle()
+
+    # the publisher sends through the outbound queue, so it stops first
+    publisher.stop()
+    updater.bot.request.stop()
+    timeseries.roll_up_job.stop()
+    buffer.click_buffer.stop()
+    membership.answered_users.stop()
+    LOGGER.info(f"Post cache stats: {quizbot.db.models.post_cache.stats()}")
+    LOGGER.info(f"Answered users filter stats: {membership.answered_users.stats()}")
+
+
+def run_get_updates(token: str, handlers: List[Callable]) -> None:
+    updater = create_updater(token, handlers)
+    updater.start_polling()
+    startup.report.finish()
+    idle(updater)
+
+
+def run_webhook(token: str, handlers: List[Callable]) -> None:
+    updater = create_updater(token, handlers)
+    start_webhook(updater)
+    startup.report.finish()
+    idle(updater)
+
+
+def start_webhook(updater: Updater) -> None:
+    listen = os.environ.get('TELEGRAM_WEBHOOK_LISTEN', '127.0.0.1')
+    port = int(os.environ.get('TELEGRAM_WEBHOOK_PORT', '8443'))
+    # Updates are only accepted at http://<listen>:<port>/<secret>, any other
+    # path is rejected with 404, so the secret must be hard to guess
+    secret = os.environ['TELEGRAM_WEBHOOK_SECRET']
+    # public HTTPS URL of a reverse proxy forwarding to the listen address;
+    # if not set, the webhook is not registered, which is handy to test locally
+    webhook_url = os.environ.get('TELEGRAM_WEBHOOK_URL')
+
+    updater.start_webhook(listen=listen, port=port, url_path=secret)
+    LOGGER.info(f"Listening for webhook updates on {listen}:{port}")
+
+    if webhook_url:
+        updater.bot.set_webhook(f"{webhook_url.rstrip('/')}/{secret}")
+        LOGGER.info(f"Webhook set to {webhook_url}")
@@ -0,0 +1,93 @@
+"""
+Startup sequence of the bot: wait for MongoDB, create the indexes and warm up
+the caches before receiving updates, timing each phase.
+
+The warm-up loads the posts clicked in the last `STARTUP_WARMUP_MINUTES` (up
+to `STARTUP_WARMUP_POSTS`, the most recently clicked first) into the post
+cache, with the filters of the users who answered them and their rendered
+inline query results, so that the clicks following a restart during a live
+quiz don't all go to the database at once.
+"""
+
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional, Tuple
+import datetime
+import logging
+import os
+import time
+
+from bson import ObjectId
+
+from quizbot import metrics
+from quizbot.db import timeseries
+from quizbot.db.mongo import wait_for_server
+import quizbot.db.models
+import quizbot.handlers.post as postutils
+
+
+LOGGER = logging.getLogger(__name__)
+
+MONGO_STARTUP_TIMEOUT = float(os.environ.get('MONGO_STARTUP_TIMEOUT', '60'))
+WARMUP_POSTS = int(os.environ.get('STARTUP_WARMUP_POSTS', '100'))
+WARMUP_PERIOD = datetime.timedelta(minutes=float(os.environ.get('STARTUP_WARMUP_MINUTES', '60')))
+
+STARTUP_DURATION = metrics.Gauge('quizbot_startup_duration_seconds',
+                                 'Time from starting the process until receiving updates')
+
+
+class StartupReport:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases: List[Tuple[str, float]] = []
+        self.notes: List[str] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.monotonic() - start))
+
+    def finish(self) -> None:
+        """Reports the startup as complete, once updates are being received."""
+        elapsed = time.monotonic() - self.started
+        STARTUP_DURATION.set(elapsed)
+        # the supervisor of the multi-process mode has no phases of its own
+        phases = ''.join(f"{', ' if index else ': '}{name} {duration:.2f}s"
+                         for index, (name, duration) in enumerate(self.phases))
+        LOGGER.info(f"Started in {elapsed:.2f}s{phases}" +
+                    ''.join(f"; {note}" for note in self.notes))
+
+
+def warm_up(post_filter: Optional[Callable[[ObjectId], bool]] = None) -> int:
+    """Loads the recently clicked posts accepted by `post_filter`, returns their number."""
+    if WARMUP_POSTS <= 0:
+        return 0
+    post_ids = timeseries.find_recently_clicked_posts(timeseries.utcnow() - WARMUP_PERIOD,
+                                                      WARMUP_POSTS)
+    if post_filter is not None:
+        post_ids = [post_id for post_id in post_ids if post_filter(post_id)]
+
+    posts = quizbot.db.models.load_posts(post_ids)
+    for post in posts:
+        postutils.get_inline_result(post)
+    return len(posts)
+
+
+def prepare(post_filter: Optional[Callable[[ObjectId], bool]] = None) -> None:
+    """Runs the startup phases using the database, with the synchronous client."""
+    with report.phase('database'):
+        wait_for_server(MONGO_STARTUP_TIMEOUT)
+    with report.phase('indexes'):
+        quizbot.db.models.ensure_indexes()
+    with report.phase('warm-up'):
+        try:
+            report.notes.append(f"{warm_up(post_filter)} posts warmed up")
+        except Exception:
+            # the caches fill up on the first clicks anyway
+            LOGGER.exception("Failed to warm up the caches")
+
+
+# started on import, which is about when the process starts
+report = StartupReport()
@@ -0,0 +1,238 @@
+"""
+Multi-process mode: a supervisor process receives updates (long polling or
+webhook) and routes each of them to one of `WORKER_PROCESSES` worker
+processes, each running the usual dispatcher.
+
+Updates are routed by a hash of the user, so all messages of a post creation
+conversation are handled in order by the same worker. Quiz button clicks are
+routed by the post instead, so the cached counters and the write-behind
+buffer of a post live in a single process. The supervisor restarts workers
+which have died, and on SIGINT/SIGTERM stops receiving updates, lets the
+workers handle the routed ones and waits for them to exit.
+
+At most `INGRESS_MAX_PENDING_UPDATES` updates wait for each worker, which
+takes the next one once there is room in its own update queue. An update
+routed to a worker with no room is left to Telegram, see `quizbot.ingress`.
+"""
+
+# Generic imports
+import logging
+import multiprocessing
+import multiprocessing.queues
+import os
+import queue
+import signal
+import threading
+import zlib
+from typing import Hashable, List, Optional
+
+# Telegram imports
+from telegram import Update
+from telegram.ext import Updater
+
+# Custom imports
+from quizbot import startup
+from quizbot.ingress import QueueFull, RECENT_UPDATES, RecentUpdates, ingress
+from quizbot.runner import create_updater, get_socks_proxy_params, start_webhook
+from quizbot.handlers.post import STATS_BUTTON, decode_callback_data
+from quizbot.db import buffer, timeseries
+from quizbot.publisher import publisher
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Workers are spawned rather than forked: the supervisor runs the updater's
+# threads, and forking a multi-threaded process may leave locks held forever
+mp = multiprocessing.get_context('spawn')
+
+
+def routing_key(update: Update) -> Hashable:
+    query = update.callback_query
+    if query is not None and query.data:
+        try:
+            post_id, button = decode_callback_data(query.data)
+        except ValueError:
+            pass
+        else:
+            if button != STATS_BUTTON:
+                return str(post_id)
+
+    if update.effective_user is not None:
+        return update.effective_user.id
+
+    return update.update_id
+
+
+def get_key_worker_index(key: Hashable, workers: int) -> int:
+    # unlike `hash`, the same in every process and run
+    return zlib.crc32(str(key).encode()) % workers
+
+
+def get_worker_index(update: Update, workers: int) -> int:
+    return get_key_worker_index(routing_key(update), workers)
+
+
+def run_worker(index: int, workers: int, token: str, updates: multiprocessing.queues.Queue,
+               supervisor_pid: int) -> None:
+    """Entry point of a worker process, handles updates until `None` is received."""
+    # the supervisor decides when to stop, e.g. on Ctrl+C sent to the process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    logging.basicConfig(format=f'%(asctime)s - worker {index} - %(name)s - %(levelname)s - '
+                               f'%(message)s\n', level=logging.INFO, force=True)
+
+    if 'METRICS_PORT' in os.environ:
+        os.environ['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + index)
+
+    if index:
+        # the roll-up of click buckets is safe but pointless to run in every worker
+        timeseries.roll_up_job.interval = 0
+        # publish jobs are sent by the first worker
+        publisher.senders = 0
+
+    from quizbot.handlers.handlers import handlers
+    # clicks on a post are routed to a single worker, which warms up with it
+    updater = create_updater(token, handlers, post_filter=lambda post_id: get_key_worker_index(
+        str(post_id), workers) == index)
+    dispatcher = updater.dispatcher
+    thread = threading.Thread(target=dispatcher.start, name='dispatcher')
+    thread.start()
+    startup.report.finish()
+    LOGGER.info(f"Worker {index} started")
+
+    while True:
+        try:
+            data = updates.get(timeout=1)
+        except queue.Empty:
+            if os.getppid() != supervisor_pid:
+                LOGGER.error(f"Supervisor has exited, stopping worker {index}")
+                break
+            continue
+
+        if data is None:
+            break
+        update = Update.de_json(data, updater.bot)
+        while True:
+            try:
+                updater.update_queue.put(update)
+                break
+            except QueueFull:
+                # the next updates wait in the supervisor meanwhile
+                updater.update_queue.wait_for_room(1)
+
+    # the dispatcher handles the queued updates before it stops
+    dispatcher.stop()
+    thread.join()
+    publisher.stop()
+    updater.bot.request.stop()
+    timeseries.roll_up_job.stop()
+    buffer.click_buffer.stop()
+    LOGGER.info(f"Worker {index} stopped")
+
+
+class Supervisor:
+    def __init__(self, token: str, workers: int):
+        self.token = token
+        self.queues: List[multiprocessing.queues.Queue] = [
+            mp.Queue(ingress.max_pending) for _ in range(workers)]
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.stopping = threading.Event()
+
+        # received updates are routed right away, the dispatcher has nothing to do
+        self.updater = Updater(token, base_url=os.environ.get('TELEGRAM_BASE_URL'),
+                               request_kwargs=get_socks_proxy_params(), workers=1,
+                               use_context=True)
+        self.updater.update_queue = RoutingQueue(self)
+        self._monitor = threading.Thread(target=self.monitor, name='supervisor', daemon=True)
+
+    def route(self, update: Update) -> None:
+        """Passes the update to its worker, raises `QueueFull` if it has no room."""
+        try:
+            self.queues[get_worker_index(update, len(self.queues))].put_nowait(update.to_dict())
+        except queue.Full:
+            ingress.reject(update)
+            raise QueueFull()
+
+    def start_worker(self, index: int) -> None:
+        process = mp.Process(target=run_worker, name=f'quizbot-worker-{index}',
+                             args=(index, len(self.processes), self.token, self.queues[index],
+                                   os.getpid()))
+        process.start()
+        self.processes[index] = process
+
+    def monitor(self) -> None:
+        """Restarts the workers which have died."""
+        while not self.stopping.wait(1):
+            for index, process in enumerate(self.processes):
+                if not process.is_alive() and not self.stopping.is_set():
+                    LOGGER.error(f"Worker {index} exited with code {process.exitcode}, "
+                                 f"restarting")
+                    self.replace_queue(index)
+                    self.start_worker(index)
+
+    def replace_queue(self, index: int) -> None:
+        # A worker killed while reading from its queue leaves the queue's lock
+        # acquired for good, so the updates routed to it but not read are lost
+        dead = self.queues[index]
+        self.queues[index] = mp.Queue(ingress.max_pending)
+        dead.cancel_join_thread()
+        dead.close()
+
+    def start(self) -> None:
+        for index in range(len(self.processes)):
+            self.start_worker(index)
+        self._monitor.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self._monitor.join()
+        for updates, process in zip(self.queues, self.processes):
+            # the queue of a worker which has died stays full
+            while process.is_alive():
+                try:
+                    updates.put(None, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+        for index, process in enumerate(self.processes):
+            process.join()
+            LOGGER.info(f"Worker {index} exited with code {process.exitcode}")
+
+    def idle(self) -> None:
+        # stops receiving updates and routes the received ones on SIGINT/SIGTERM
+        self.updater.idle()
+        self.stop()
+
+
+class RoutingQueue:
+    """Stands in for the update queue of the supervisor's updater, see `Supervisor.route`."""
+
+    def __init__(self, supervisor: Supervisor):
+        self.supervisor = supervisor
+        self._recent = RecentUpdates(RECENT_UPDATES)
+
+    def put(self, item, block=True, timeout=None) -> None:
+        if not isinstance(item, Update):
+            # errors of getting updates are logged by the updater
+            return
+        if item.update_id in self._recent:
+            return
+        self.supervisor.route(item)
+        self._recent.add(item.update_id)
+
+
+def run_get_updates(token: str, workers: int) -> None:
+    supervisor = Supervisor(token, workers)
+    supervisor.start()
+    supervisor.updater.start_polling()
+    startup.report.finish()
+    supervisor.idle()
+
+
+def run_webhook(token: str, workers: int) -> None:
+    supervisor = Supervisor(token, workers)
+    supervisor.start()
+    start_webhook(supervisor.updater)
+    startup.report.finish()
+    supervisor.idle()
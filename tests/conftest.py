@@ -0,0 +1,38 @@
+import mongomock
+import pytest
+
+from quizbot.db import mongo
+import quizbot.db.models
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """An empty in-memory database, used by every module through `quizbot.db.mongo`."""
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(mongo, 'get_client', lambda: client)
+    quizbot.db.models.post_cache.clear()
+    quizbot.db.models.user_id_cache.clear()
+    yield client[mongo.get_database_name()]
+    quizbot.db.models.post_cache.clear()
+    quizbot.db.models.user_id_cache.clear()
+
+
+BUTTONS = {'A': {'alert_text': 'Right', 'clicks_count': 0, 'is_correct': True},
+           'B': {'alert_text': 'Wrong', 'clicks_count': 0, 'is_correct': False}}
+
+
+@pytest.fixture
+def author(db):
+    return quizbot.db.models.find_or_create_user(1)
+
+
+@pytest.fixture
+def make_post(author):
+    """Creates a quiz of the author clicked by the given Telegram users, e.g. {10: 0, 11: 1}."""
+    def make_post(text='Question', clicks=None):
+        post_id = quizbot.db.models.create_post(text, None, dict(BUTTONS), author)
+        for telegram_id, button in (clicks or {}).items():
+            quizbot.db.models.record_click(post_id, telegram_id, button)
+        return post_id
+
+    return make_post
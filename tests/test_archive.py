@@ -0,0 +1,82 @@
+import datetime
+
+import pytest
+
+from quizbot.db import archive, timeseries
+import quizbot.db.models as models
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(archive, 'ANSWERS_CHUNK', 2)
+
+
+def answers(db, collection, post_id):
+    return sorted((answer['user_id'], answer['answer'], answer['timestamp'])
+                  for answer in db[collection].find({'post_id': post_id}))
+
+
+def test_post_and_answers_round_trip(db, author, make_post):
+    post_id = make_post(clicks={10: 0, 11: 1, 12: 0, 13: 0, 14: 1})
+    post = db.posts.find_one({'_id': post_id})
+    given = answers(db, 'answers', post_id)
+    created_at = db.users.find_one({'_id': author})['posts_created'][str(post_id)]['timestamp']
+
+    assert archive.archive_post(post)
+    assert db.posts.count_documents({}) == 0
+    assert db.answers.count_documents({}) == 0
+    assert db[archive.ANSWERS_COLLECTION].count_documents({}) == 3
+    archived = db[archive.POSTS_COLLECTION].find_one({'_id': post_id})
+    assert archived['created_at'] == created_at
+    assert archived['clicks_count'] == 5
+
+    # archived posts are still found, e.g. to show their statistics
+    models.post_cache.clear()
+    assert models.find_post(post_id)['clicks_count'] == 5
+
+    assert archive.restore_post(post_id)
+    assert db.posts.find_one({'_id': post_id}) == post
+    assert answers(db, 'answers', post_id) == given
+    assert db[archive.POSTS_COLLECTION].count_documents({}) == 0
+    assert db[archive.ANSWERS_COLLECTION].count_documents({}) == 0
+    user = db.users.find_one({'_id': author})
+    assert user['posts_created'][str(post_id)]['timestamp'] == created_at
+    assert not archive.restore_post(post_id)
+
+
+def test_click_restores_archived_post(db, make_post):
+    post_id = make_post(clicks={10: 0, 11: 1})
+    archive.archive_post(db.posts.find_one({'_id': post_id}))
+    models.post_cache.clear()
+
+    repeated = models.record_click(post_id, 10, 1)
+    assert not repeated.recorded and repeated.answer == 'A'
+    assert models.record_click(post_id, 12, 0).recorded
+    assert db.posts.find_one({'_id': post_id})['clicks_count'] == 3
+    assert db.answers.count_documents({'post_id': post_id}) == 3
+    assert db[archive.POSTS_COLLECTION].count_documents({}) == 0
+
+
+def test_post_clicked_while_archiving_stays(db, make_post):
+    post_id = make_post(clicks={10: 0})
+    post = db.posts.find_one({'_id': post_id})
+    models.record_click(post_id, 11, 0)
+
+    assert not archive.archive_post(post)
+    assert db.posts.find_one({'_id': post_id})['clicks_count'] == 2
+    assert db[archive.POSTS_COLLECTION].count_documents({}) == 0
+    assert db[archive.ANSWERS_COLLECTION].count_documents({}) == 0
+
+
+def test_only_idle_posts_are_archived(db, make_post, monkeypatch):
+    idle = make_post('Idle', clicks={10: 0})
+    clicked = make_post('Clicked', clicks={10: 0})
+    later = timeseries.utcnow() + datetime.timedelta(days=2)
+    monkeypatch.setattr(timeseries, 'utcnow', lambda: later)
+    db[timeseries.MINUTES_COLLECTION].update_many({'post_id': clicked}, {'$set': {'start': later}})
+
+    assert archive.archive_idle_posts(idle_days=1, dry_run=True) == 1
+    assert db[archive.POSTS_COLLECTION].count_documents({}) == 0
+    assert archive.archive_idle_posts(idle_days=1) == 1
+    assert [post['_id'] for post in db.posts.find()] == [clicked]
+    assert [post['_id'] for post in db[archive.POSTS_COLLECTION].find()] == [idle]
@@ -0,0 +1,127 @@
+from pymongo.errors import AutoReconnect, BulkWriteError
+import pytest
+
+from quizbot.db import buffer
+from quizbot.db.buffer import WriteBehindBuffer
+
+
+class FailingCollection:
+    """Fails the updates of the documents with the given error codes, applies the others."""
+
+    def __init__(self, collection, codes):
+        self.collection = collection
+        self.codes = codes
+
+    def bulk_write(self, ops, ordered):
+        errors = []
+        for index, op in enumerate(ops):
+            code = self.codes.get(op._filter['_id'])
+            if code is not None:
+                errors.append({'index': index, 'code': code, 'errmsg': 'failed', 'op': {}})
+            else:
+                self.collection.update_one(op._filter, op._doc)
+        raise BulkWriteError({'writeErrors': errors, 'writeConcernErrors': [], 'nInserted': 0,
+                              'nUpserted': 0, 'nMatched': len(ops) - len(errors),
+                              'nModified': 0, 'nRemoved': 0, 'upserted': []})
+
+
+class DownCollection:
+    def bulk_write(self, ops, ordered):
+        raise AutoReconnect('primary stepped down')
+
+
+@pytest.fixture
+def posts(db):
+    db.posts.insert_many([{'_id': doc_id, 'clicks_count': 0} for doc_id in (1, 2, 3)])
+    return db.posts
+
+
+def counts(posts):
+    return {post['_id']: post['clicks_count'] for post in posts.find()}
+
+
+def test_flush_coalesces_updates(posts):
+    click_buffer = WriteBehindBuffer(flush_interval=1, max_ops=1000, max_retries=3)
+    for doc_id in (1, 1, 2):
+        click_buffer.inc('posts', doc_id, {'clicks_count': 1})
+    click_buffer.set('posts', 3, {'clicks_count': 5})
+
+    assert click_buffer.pending_ops == 4
+    assert click_buffer.pending_incs('posts', 1) == {'clicks_count': 2}
+    assert click_buffer.flush() == 3
+    assert counts(posts) == {1: 2, 2: 1, 3: 5}
+    assert click_buffer.pending_ops == 0
+    assert click_buffer.pending_incs('posts', 1) == {}
+
+
+def test_transient_errors_are_requeued(posts, monkeypatch):
+    click_buffer = WriteBehindBuffer(flush_interval=1, max_ops=1000, max_retries=3)
+    click_buffer.inc('posts', 1, {'clicks_count': 1})
+    monkeypatch.setattr(buffer, 'get_collection', lambda name: DownCollection())
+    assert click_buffer.flush() == 0
+    assert click_buffer.pending_incs('posts', 1) == {'clicks_count': 1}
+
+    click_buffer.inc('posts', 1, {'clicks_count': 1})
+    monkeypatch.setattr(buffer, 'get_collection', lambda name: posts)
+    assert click_buffer.flush() == 1
+    assert counts(posts)[1] == 2
+
+
+def test_failed_writes_are_requeued_or_dropped(posts, monkeypatch):
+    click_buffer = WriteBehindBuffer(flush_interval=1, max_ops=1000, max_retries=3)
+    for doc_id in (1, 2, 3):
+        click_buffer.inc('posts', doc_id, {'clicks_count': 1})
+
+    # ShutdownInProgress may pass once retried, BadValue won't
+    failing = FailingCollection(posts, {2: 91, 3: 2})
+    monkeypatch.setattr(buffer, 'get_collection', lambda name: failing)
+    assert click_buffer.flush() == 1
+    assert click_buffer.pending_incs('posts', 2) == {'clicks_count': 1}
+    assert click_buffer.pending_incs('posts', 3) == {}
+
+    monkeypatch.setattr(buffer, 'get_collection', lambda name: posts)
+    assert click_buffer.flush() == 1
+    assert counts(posts) == {1: 1, 2: 1, 3: 0}
+
+
+def test_retries_are_limited(posts, monkeypatch):
+    click_buffer = WriteBehindBuffer(flush_interval=1, max_ops=1000, max_retries=2)
+    click_buffer.inc('posts', 1, {'clicks_count': 1})
+    monkeypatch.setattr(buffer, 'get_collection', lambda name: DownCollection())
+    for _ in range(2):
+        click_buffer.flush()
+        assert click_buffer.pending_incs('posts', 1) == {'clicks_count': 1}
+
+    click_buffer.flush()
+    assert click_buffer.pending_incs('posts', 1) == {}
+
+
+def test_updates_being_flushed_stay_visible(posts, monkeypatch):
+    click_buffer = WriteBehindBuffer(flush_interval=1, max_ops=1000, max_retries=3)
+    click_buffer.inc('posts', 1, {'clicks_count': 1})
+    seen = []
+
+    class ReadingCollection:
+        def bulk_write(self, ops, ordered):
+            seen.append(click_buffer.pending_incs('posts', 1))
+            return posts.bulk_write(ops, ordered=ordered)
+
+    monkeypatch.setattr(buffer, 'get_collection', lambda name: ReadingCollection())
+    click_buffer.flush()
+    assert seen == [{'clicks_count': 1}]
+    assert click_buffer.pending_incs('posts', 1) == {}
+
+
+def test_missing_documents_are_recreated(posts):
+    click_buffer = WriteBehindBuffer(flush_interval=1, max_ops=1000, max_retries=3)
+
+    def recreate(doc_ids):
+        posts.insert_many([{'_id': doc_id, 'clicks_count': 10} for doc_id in doc_ids])
+        return doc_ids
+
+    click_buffer.on_missing('posts', recreate)
+    click_buffer.inc('posts', 4, {'clicks_count': 1})
+    click_buffer.flush()
+    assert click_buffer.pending_incs('posts', 4) == {'clicks_count': 1}
+    click_buffer.flush()
+    assert counts(posts)[4] == 11
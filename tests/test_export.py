@@ -0,0 +1,84 @@
+import csv
+import json
+
+import pytest
+
+from quizbot.db import archive, export
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def posts(db, monkeypatch, make_post):
+    """10 posts answered 3 times each."""
+    monkeypatch.setattr(archive, 'ANSWERS_CHUNK', 2)
+    return [make_post(f'Question {number}',
+                      clicks={telegram_id: telegram_id % 2
+                              for telegram_id in range(100, 130) if telegram_id % 10 == number})
+            for number in range(10)]
+
+
+def read_rows(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+
+def interrupt_after(monkeypatch, table, batches):
+    rows = export.ROWS[table]
+    calls = []
+
+    def interrupted_rows(documents):
+        calls.append(len(documents))
+        if len(calls) > batches:
+            raise Interrupted()
+        return rows(documents)
+
+    monkeypatch.setitem(export.ROWS, table, interrupted_rows)
+
+
+@pytest.mark.parametrize('table', export.TABLES)
+def test_interrupted_export_is_resumed(posts, tmp_path, monkeypatch, table):
+    expected = export.export(table, str(tmp_path / 'full.csv'), batch_size=4)
+    output, checkpoint = str(tmp_path / 'export.csv'), str(tmp_path / 'export.json')
+
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, table, 1)
+        with pytest.raises(Interrupted):
+            export.export(table, output, batch_size=4, checkpoint_path=checkpoint)
+    with open(checkpoint) as f:
+        assert json.load(f)['rows'] == len(read_rows(output)) > 0
+
+    assert export.export(table, output, batch_size=4, checkpoint_path=checkpoint) == expected
+    assert read_rows(output) == read_rows(str(tmp_path / 'full.csv'))
+    # a finished export isn't run again
+    assert export.export(table, output, batch_size=4, checkpoint_path=checkpoint) == expected
+
+
+def test_export_is_resumed_in_the_archive(db, posts, tmp_path, monkeypatch):
+    for post_id in posts[2:6]:
+        assert archive.archive_post(db.posts.find_one({'_id': post_id}))
+    export.export('answers', str(tmp_path / 'full.csv'), batch_size=4)
+    expected = read_rows(str(tmp_path / 'full.csv'))
+    output, checkpoint = str(tmp_path / 'export.csv'), str(tmp_path / 'export.json')
+
+    # the 18 answers of the posts left are in 5 batches, the next ones are archived
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, 'answers', 6)
+        with pytest.raises(Interrupted):
+            export.export('answers', output, batch_size=4, checkpoint_path=checkpoint)
+    with open(checkpoint) as f:
+        assert json.load(f)['source'] == 1
+
+    assert export.export('answers', output, batch_size=4, checkpoint_path=checkpoint) == 30
+    rows = read_rows(output)
+    assert len({row['answer_id'] for row in rows}) == 30
+    assert rows == expected
+
+
+def test_checkpoint_of_another_export(posts, tmp_path):
+    output, checkpoint = str(tmp_path / 'export.csv'), str(tmp_path / 'export.json')
+    export.export('posts', output, checkpoint_path=checkpoint)
+    with pytest.raises(ValueError):
+        export.export('buttons', output, checkpoint_path=checkpoint)
@@ -0,0 +1,145 @@
+from bson import ObjectId
+import pytest
+from telegram import Update
+
+from quizbot.handlers.post import STATS_BUTTON, encode_callback_data
+from quizbot.ingress import BUSY_TEXT, RETRY_TEXT, Ingress, IngressQueue, QueueFull
+
+
+class FakeBot:
+    """Stands in for `telegram.Bot`, records the answers to callback queries."""
+
+    def __init__(self):
+        self.answers = []
+
+    def answerCallbackQuery(self, callback_query_id, **params):
+        self.answers.append({'callback_query_id': callback_query_id, **params})
+
+
+@pytest.fixture
+def bot():
+    return FakeBot()
+
+
+@pytest.fixture
+def sent():
+    """Answers queued by the ingress with `send_answer`."""
+    return []
+
+
+@pytest.fixture
+def ingress(sent):
+    ingress = Ingress(max_pending=4, shed_threshold=0.5, coalesce_window=2)
+    ingress.start(sent.append)
+    return ingress
+
+
+def message(bot, update_id, text='Hello'):
+    return Update.de_json({'update_id': update_id,
+                           'message': {'message_id': update_id, 'date': 0, 'text': text,
+                                       'chat': {'id': 1, 'type': 'private'}}}, bot)
+
+
+def click(bot, update_id, data, user_id=5):
+    return Update.de_json({'update_id': update_id,
+                           'callback_query': {'id': str(update_id), 'data': data,
+                                              'chat_instance': '1',
+                                              'from': {'id': user_id, 'is_bot': False,
+                                                       'first_name': 'User'}}}, bot)
+
+
+def inline_query(bot, update_id):
+    return Update.de_json({'update_id': update_id,
+                           'inline_query': {'id': str(update_id), 'query': '', 'offset': '',
+                                            'from': {'id': 5, 'is_bot': False,
+                                                     'first_name': 'User'}}}, bot)
+
+
+def test_full_queue_raises(bot, ingress):
+    updates = IngressQueue(ingress)
+    for update_id in range(4):
+        updates.put(message(bot, update_id))
+
+    with pytest.raises(QueueFull) as error:
+        updates.put(message(bot, 4))
+    assert error.value.status_code == 503
+    assert updates.qsize() == 4
+    assert not updates.wait_for_room(0.01)
+
+    updates.get()
+    assert updates.wait_for_room(0.01)
+    updates.put(message(bot, 4))
+    assert updates.qsize() == 4
+
+
+def test_received_again_updates_are_skipped(bot, ingress):
+    updates = IngressQueue(ingress)
+    updates.put(message(bot, 1))
+    updates.put(message(bot, 1))
+    assert updates.qsize() == 1
+
+
+def test_low_priority_updates_are_shed(bot, ingress, sent):
+    updates = IngressQueue(ingress)
+    stats_button = encode_callback_data(ObjectId(), STATS_BUTTON)
+    updates.put(inline_query(bot, 1))
+    updates.put(message(bot, 2, '/stats'))
+    assert updates.qsize() == 2
+
+    # half of the queue is full from now on
+    updates.put(inline_query(bot, 3))
+    updates.put(message(bot, 4, '/stats'))
+    updates.put(click(bot, 5, stats_button))
+    assert updates.qsize() == 2
+    assert sent == [{'callback_query_id': '5', 'text': BUSY_TEXT, 'show_alert': False}]
+
+    updates.put(message(bot, 6, '/start'))
+    updates.put(click(bot, 7, encode_callback_data(ObjectId(), 0)))
+    assert updates.qsize() == 4
+
+
+def test_repeated_taps_are_coalesced(bot, ingress, sent):
+    updates = IngressQueue(ingress)
+    data = encode_callback_data(ObjectId(), 0)
+    first = click(bot, 1, data)
+    updates.put(first)
+    updates.put(click(bot, 2, data))
+    updates.put(click(bot, 3, data, user_id=6))
+    assert updates.qsize() == 2
+
+    # the tap waiting for the first one gets its answer
+    ingress.answer(first.callback_query, text='Right', show_alert=True)
+    assert bot.answers == [{'callback_query_id': '1', 'text': 'Right', 'show_alert': True}]
+    assert sent == [{'callback_query_id': '2', 'text': 'Right', 'show_alert': True}]
+
+    # and so does a tap within the window, without being dispatched
+    updates.put(click(bot, 4, data))
+    assert updates.qsize() == 2
+    assert sent[-1] == {'callback_query_id': '4', 'text': 'Right', 'show_alert': True}
+
+
+def test_taps_waiting_for_a_failed_one_are_released(bot, ingress, sent):
+    updates = IngressQueue(ingress)
+    data = encode_callback_data(ObjectId(), 0)
+    first = click(bot, 1, data)
+    updates.put(first)
+    updates.put(click(bot, 2, data))
+
+    ingress.release(first.callback_query)
+    assert sent == [{'callback_query_id': '2', 'text': RETRY_TEXT, 'show_alert': False}]
+    # the next tap is handled again
+    updates.put(click(bot, 3, data))
+    assert updates.qsize() == 2
+
+
+def test_rejected_tap_is_not_coalesced_away(bot, ingress):
+    updates = IngressQueue(ingress)
+    for update_id in range(4):
+        updates.put(message(bot, update_id))
+    data = encode_callback_data(ObjectId(), 0)
+    with pytest.raises(QueueFull):
+        updates.put(click(bot, 4, data))
+
+    updates.get()
+    updates.put(click(bot, 4, data))
+    assert updates.qsize() == 4
@@ -0,0 +1,100 @@
+import threading
+
+import pytest
+
+from quizbot.outbound import CALLBACK_ANSWER, MERGE_KEY, OTHER, Call, OutboundScheduler
+
+
+def call(method, **params):
+    return Call(f'https://api.telegram.org/bot123:TOKEN/{method}', params, None,
+                threading.Event())
+
+
+@pytest.fixture
+def scheduler():
+    return OutboundScheduler(messages_per_second=30, chat_messages_per_second=1, chat_burst=3,
+                             callback_answer_deadline=15)
+
+
+def pop_all(scheduler, now):
+    calls = []
+    while True:
+        next_call, wait = scheduler.pop(now)
+        if next_call is None:
+            return calls, wait
+        calls.append(next_call)
+
+
+def test_lanes_are_sent_by_priority(scheduler):
+    message = scheduler.push(call('sendMessage', chat_id=1))
+    other = scheduler.push(call('getFile', file_id='file'))
+    inline = scheduler.push(call('answerInlineQuery', inline_query_id='1'))
+    answer = scheduler.push(call('answerCallbackQuery', callback_query_id='1'))
+
+    calls, wait = pop_all(scheduler, answer.queued_at)
+    assert calls == [answer, inline, message, other]
+    assert wait is None
+
+
+def test_chat_messages_are_limited(scheduler):
+    now = call('getMe').queued_at
+    first = [scheduler.push(call('sendMessage', chat_id=1)) for _ in range(4)]
+    second = scheduler.push(call('sendMessage', chat_id=2))
+
+    calls, wait = pop_all(scheduler, now)
+    # the burst of the first chat doesn't hold up the second one
+    assert calls == first[:3] + [second]
+    assert wait == pytest.approx(1)
+    assert scheduler.pop(now + 1)[0] is first[3]
+
+
+def test_global_message_limit(scheduler):
+    now = call('getMe').queued_at
+    for chat_id in range(40):
+        scheduler.push(call('sendMessage', chat_id=chat_id))
+    scheduler.push(call('editMessageText', chat_id=1, text='Edited'))
+
+    calls, wait = pop_all(scheduler, now)
+    assert sum(sent.method == 'sendMessage' for sent in calls) == 30
+    # calls which aren't messages don't take tokens
+    assert calls[-1].method == 'editMessageText' and calls[-1].lane == OTHER
+    assert wait == pytest.approx(1 / 30)
+
+
+def test_late_callback_answers_expire(scheduler):
+    answer = scheduler.push(call('answerCallbackQuery', callback_query_id='1'))
+    assert scheduler.pop(answer.queued_at + 16) == (None, None)
+    assert answer.done.is_set() and answer.result is False
+
+
+def test_repeated_answers_are_merged(scheduler):
+    first = scheduler.push(call('answerCallbackQuery', callback_query_id='1', text='One',
+                                **{MERGE_KEY: 'tap'}))
+    merged = scheduler.push(call('answerCallbackQuery', callback_query_id='2', text='Two',
+                                 **{MERGE_KEY: 'tap'}))
+    assert merged is first
+    assert len(scheduler) == 1
+
+    sent, _ = scheduler.pop(first.queued_at)
+    assert sent.params == {'callback_query_id': '2', 'text': 'Two'}
+    # answered, so a new tap is queued again
+    assert scheduler.push(call('answerCallbackQuery', callback_query_id='3',
+                               **{MERGE_KEY: 'tap'})) is not first
+
+
+def test_flood_limit_pauses_the_chat_or_the_lane(scheduler):
+    now = call('getMe').queued_at
+    message = scheduler.push(call('sendMessage', chat_id=1))
+    other_chat = scheduler.push(call('sendMessage', chat_id=2))
+    assert scheduler.pop(now)[0] is message
+    scheduler.retry(message, 5, now)
+    assert scheduler.pop(now)[0] is other_chat
+    assert scheduler.pop(now) == (None, pytest.approx(5))
+    assert scheduler.pop(now + 5)[0] is message
+
+    answer = scheduler.push(call('answerCallbackQuery', callback_query_id='1'))
+    assert scheduler.pop(now)[0] is answer
+    scheduler.retry(answer, 2, now)
+    assert scheduler.lane_paused_until[CALLBACK_ANSWER] == now + 2
+    assert scheduler.pop(now) == (None, pytest.approx(2))
+    assert scheduler.pop(now + 2)[0] is answer
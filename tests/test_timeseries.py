@@ -0,0 +1,72 @@
+import datetime
+
+from bson import ObjectId
+import pytest
+
+from quizbot.db import timeseries
+
+NOW = datetime.datetime(2019, 10, 1, 12, 30)
+
+
+def click(db, post_id, at, is_correct=True, clicks=1):
+    """Counts clicks in the minute bucket of `at`, as `timeseries.count_click` does."""
+    _id, inc, fields = timeseries.click_bucket_update(post_id, is_correct, at)
+    for _ in range(clicks):
+        db[timeseries.MINUTES_COLLECTION].update_one(
+            {'_id': _id}, {'$inc': inc, '$setOnInsert': fields, '$set': {'rolled_up': False}},
+            upsert=True)
+
+
+def hour_clicks(db, post_id):
+    return {bucket['start'].hour: (bucket['clicks_count'], bucket['correct_clicks_count'])
+            for bucket in db[timeseries.HOURS_COLLECTION].find({'post_id': post_id})}
+
+
+@pytest.fixture
+def post_id(db):
+    post_id = ObjectId()
+    click(db, post_id, NOW.replace(hour=10, minute=5), clicks=2)
+    click(db, post_id, NOW.replace(hour=10, minute=59), is_correct=False)
+    click(db, post_id, NOW.replace(hour=11, minute=0))
+    # the current hour isn't over yet
+    click(db, post_id, NOW.replace(minute=10))
+    return post_id
+
+
+def test_finished_hours_are_rolled_up(db, post_id):
+    before = timeseries.get_trend(post_id, NOW)
+    assert timeseries.roll_up(NOW) == 3
+    assert hour_clicks(db, post_id) == {10: (3, 2), 11: (1, 1)}
+    assert timeseries.get_trend(post_id, NOW) == before
+    assert db[timeseries.MINUTES_COLLECTION].count_documents({'rolled_up': False}) == 1
+
+
+def test_roll_up_can_be_rerun(db, post_id):
+    timeseries.roll_up(NOW)
+    # e.g. interrupted before the minute buckets were marked
+    db[timeseries.MINUTES_COLLECTION].update_many({}, {'$unset': {'rolled_up': 1}})
+    timeseries.roll_up(NOW)
+    assert hour_clicks(db, post_id) == {10: (3, 2), 11: (1, 1)}
+
+
+def test_late_clicks_are_rolled_up_again(db, post_id):
+    timeseries.roll_up(NOW)
+    # e.g. a click which has waited in the write-behind buffer
+    click(db, post_id, NOW.replace(hour=10, minute=5), is_correct=False, clicks=2)
+    assert sum(timeseries.get_trend(post_id, NOW).hours) == 7
+
+    assert timeseries.roll_up(NOW) == 1
+    assert hour_clicks(db, post_id) == {10: (5, 2), 11: (1, 1)}
+    assert sum(timeseries.get_trend(post_id, NOW).hours) == 7
+    assert timeseries.roll_up(NOW) == 0
+
+
+def test_expired_buckets_are_deleted(db, post_id):
+    timeseries.roll_up(NOW)
+    later = NOW + timeseries.MINUTE_BUCKETS_RETENTION + datetime.timedelta(hours=1)
+    timeseries.roll_up(later)
+    assert db[timeseries.MINUTES_COLLECTION].count_documents({}) == 0
+    assert hour_clicks(db, post_id) == {10: (3, 2), 11: (1, 1), 12: (1, 1)}
+
+    timeseries.roll_up(NOW + timeseries.HOUR_BUCKETS_RETENTION + datetime.timedelta(hours=1))
+    assert hour_clicks(db, post_id) == {}